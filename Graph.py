@@ -1,33 +1,228 @@
 #!/usr/bin/env python3
 
+from collections import OrderedDict, deque
+import functools
+from heapq import heappush, heappop
+import random
+import threading
+import time
 from utilClasses import BiLink, Intent
+from topoCore import TopologyCore, EdgeData, PathBatch, CongestionIndex, CAP_VIRTUAL, CAP_MAX, CAP_REMAINING, SINGLE_NODE_CAPACITY
+import numpy as np
 import networkx as nx
 from networkx.utils import pairwise
 import graphUtilities
+import metrics
+import tracing
 
-CAP_VIRTUAL = "virtual_capacity"
-CAP_MAX = "max_capacity"
-CAP_REMAINING = "remaining_capacity"
+INF = float("inf")
+
+ASTAR_ITERATIVE = "iterative"
+ASTAR_RECURSIVE = "recursive"
+
+BEST_SOLUTION_WIDEST = "widest"
+BEST_SOLUTION_SEARCH = "search"
+
+def synchronized(method):
+    # Runs the method under the graph lock, so a StateThread mutation and a
+    # snapshot commit never interleave
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class HopCache:
+    # Per-destination hop distance tables, evicted in LRU order once the total
+    # number of cached distances exceeds MAX_ENTRIES
+    MAX_ENTRIES = 1000000
+
+    def __init__(self, max_entries=None):
+        self.max_entries = self.MAX_ENTRIES if max_entries is None else max_entries
+        self._tables = OrderedDict()
+        self._size = 0
+
+    def __len__(self):
+        return len(self._tables)
+
+    def __contains__(self, destination):
+        return destination in self._tables
+
+    def get(self, destination):
+        table = self._tables.get(destination)
+        if table is not None:
+            self._tables.move_to_end(destination)
+        return table
+
+    def put(self, destination, table):
+        self.discard(destination)
+        self._tables[destination] = table
+        self._size += len(table)
+        while self._size > self.max_entries and len(self._tables) > 1:
+            _, evicted = self._tables.popitem(last=False)
+            self._size -= len(evicted)
+
+    def discard(self, destination):
+        table = self._tables.pop(destination, None)
+        if table is not None:
+            self._size -= len(table)
+
+    def clear(self):
+        self._tables.clear()
+        self._size = 0
+
+    def edge_added(self, u, v):
+        for destination, table in list(self._tables.items()):
+            du, dv = table.get(u), table.get(v)
+            if du is None and dv is None:
+                continue    # both endpoints are unreachable from destination
+            if du is not None and dv is not None and abs(du - dv) <= 1:
+                continue    # the new edge is not a shortcut
+            self.discard(destination)
+
+    def edge_removed(self, graph, u, v):
+        # Called after the edge is gone from graph
+        for destination, table in list(self._tables.items()):
+            du, dv = table.get(u), table.get(v)
+            if du is None or dv is None or du == dv:
+                continue
+            far = u if du > dv else v
+            # far keeps its distance if another neighbour is one hop closer
+            if any(table.get(w) == table[far] - 1 for w in graph[far]):
+                continue
+            self.discard(destination)
 
-class Graph(nx.Graph):
 
-    hops = None
+class CandidatePaths:
+    def __init__(self, graph, paths):
+        self.paths = paths  # None when the pair has too many shortest paths
+        self.batch = None if paths is None else graph.encode_paths(paths)
+        self.edges = set()
+        self.nodes = set()
+        for path in paths or ():
+            self.edges.update(frozenset(e) for e in pairwise(path))
+            self.nodes.update(path)
+
+
+class PathCache:
+    # All shortest paths per (src, dst) switch pair regardless of capacity,
+    # enumerated on first use, so they stay valid until the topology changes.
+    # Pairs with more than MAX_PATHS shortest paths are not enumerated.
+    MAX_PATHS = 32
+    MAX_PAIRS = 100000
+
+    def __init__(self, max_paths=None, max_pairs=None):
+        self.max_paths = self.MAX_PATHS if max_paths is None else max_paths
+        self.max_pairs = self.MAX_PAIRS if max_pairs is None else max_pairs
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, pair):
+        return pair in self._entries
+
+    def entry(self, graph, src, dst):
+        entry = self._entries.get((src, dst))
+        if entry is not None:
+            self._entries.move_to_end((src, dst))
+            return entry
+        if graph.count_shortest_paths(src, dst, self.max_paths + 1) > self.max_paths:
+            entry = CandidatePaths(graph, None)
+        else:
+            entry = CandidatePaths(graph, list(graph.all_shortest_paths(src, dst)))
+        self._entries[(src, dst)] = entry
+        if len(self._entries) > self.max_pairs:
+            self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        self._entries.clear()
+
+    def edge_added(self, hops, u, v):
+        # Called before hops learns the edge. A pair changes only if the edge,
+        # crossed from the endpoint further from dst (far), closes a path from
+        # src no longer than the cached ones: always when far is on one of
+        # them, never when it is off them and just one hop further out than
+        # near. Otherwise the distance from src to far decides, if its table
+        # is cached.
+        for (src, dst), entry in list(self._entries.items()):
+            table = hops.get(dst)
+            if table is not None and src in table:
+                du, dv = table.get(u), table.get(v)
+                if du is None or dv is None or du == dv:
+                    continue    # the edge is on no shortest path to dst
+                far, near = (u, v) if du > dv else (v, u)
+                if entry.paths is None or far not in entry.nodes:
+                    if entry.paths is not None and table[far] - table[near] == 1:
+                        continue
+                    around = hops.get(src)  # distances to src are those from it
+                    if around is not None and around.get(far, INF) + 1 + table[near] > table[src]:
+                        continue
+            del self._entries[(src, dst)]
+
+    def edge_removed(self, u, v):
+        # Pairs whose shortest paths all avoid the edge keep the same set
+        edge = frozenset((u, v))
+        for pair, entry in list(self._entries.items()):
+            if edge in entry.edges:
+                del self._entries[pair]
+
+
+class Graph(nx.Graph):
+    # Capacities live in self.core, edge attribute dicts proxy the CAP_* keys
+    edge_attr_dict_factory = EdgeData
+    # Search engine used by astar, either ASTAR_ITERATIVE or ASTAR_RECURSIVE
+    ASTAR_MODE = ASTAR_ITERATIVE
+    USE_PATH_CACHE = True
+    # How find_best_solution computes counter-offers, BEST_SOLUTION_WIDEST or
+    # BEST_SOLUTION_SEARCH (binary search over full re-plans)
+    BEST_SOLUTION_MODE = BEST_SOLUTION_WIDEST
+    # Wall-clock budget in seconds for anytime_allocate
+    ALLOCATION_BUDGET = 0.2
 
     def __init__(self, file=None) -> None:
+        self.core = TopologyCore()
+        self.lock = threading.RLock()
+        self.generation = 0     # bumped by every change to the real state
+        self.plans_dropped = 0  # plans _commit_plan found stale
         super(Graph, self).__init__()
-        self.hops = None
+        self.hops = HopCache()
+        self.path_cache = PathCache()
+        self.congestion = CongestionIndex(self.core)
+        self.footprints = {}    # intent id -> edge ids of its flow
         if file is not None:
             self.read_edgelist(file)
 
     def draw(self):
-        graphUtilities.draw(self, labels=True)
+        graphUtilities.draw(self.to_networkx(), labels=True)
 
+    def to_networkx(self):
+        # Plain networkx copy with the capacities as edge attributes
+        g = nx.Graph()
+        g.add_nodes_from(self.nodes)
+        for u, v, data in self.edges(data=True):
+            eid = dict.__getitem__(data, "eid")
+            attr = {key: int(getattr(self.core, key)[eid]) for key in (CAP_MAX, CAP_REMAINING, CAP_VIRTUAL)}
+            g.add_edge(u, v, bilink=data["bilink"], **attr)
+        return g
 
+    @synchronized
     def assign_capacities(self):
+        self.generation += 1
         for s, d in self.edges:
             cap = self[s][d]["bilink"].capacity
-            self[s][d][CAP_MAX] = cap
-            self[s][d][CAP_REMAINING] = cap
+            eid = self[s][d]["eid"]
+            self.core.writable(CAP_MAX)[eid] = cap
+            self.core.writable(CAP_REMAINING)[eid] = cap
+        self.congestion.rebuild()
+
+    @staticmethod
+    def _endpoints(intent):
+        if type(intent.src_host) is str:
+            return intent.src_host, intent.dst_host
+        return intent.src_host.switchport.device, intent.dst_host.switchport.device
 
     def _get_capacity_key(self, use_virtual):
         capacity_key = CAP_REMAINING
@@ -35,12 +230,20 @@ class Graph(nx.Graph):
             capacity_key = CAP_VIRTUAL
         return capacity_key
 
+    def _capacities(self, use_virtual=False):
+        return getattr(self.core, self._get_capacity_key(use_virtual))
+
+    def path_edges(self, path):
+        return np.fromiter((self[u][v]["eid"] for u, v in pairwise(path)),
+                           dtype=np.intp, count=len(path) - 1)
+
     def sorted_edgelist(self, node, destination, dec = False, use_virtual=False):
-        capacity_key = self._get_capacity_key(use_virtual)
+        caps = self._capacities(use_virtual)
+        hops = self.hop_distances(destination)
         l = []
-        for u in self[node]:
-            cost = self.hops[destination][u]
-            cap = self[node][u][capacity_key]
+        for u, attr in self[node].items():
+            cost = hops.get(u, INF)
+            cap = caps[attr["eid"]]
             l.append((u, cap, cost))
         return sorted(l, key=lambda x: (x[2], x[1]), reverse=dec) 
         
@@ -53,43 +256,43 @@ class Graph(nx.Graph):
                 s, d, cap = edge.split()
                 cap = int(cap)
                 self.add_edge(s, d, bilink=BiLink(s, d, cap))
-        self.hops = dict.fromkeys(self.nodes)
-        for key in self.hops:
-            self.hops[key] = dict.fromkeys(self.nodes, None)
         return self.edges
 
+    @synchronized
     def add_edge(self, u_of_edge, v_of_edge, **attr):
         link:BiLink = attr["bilink"]
-        attr[CAP_MAX] = link.capacity        
-        attr[CAP_REMAINING] = link.capacity        
-        return super().add_edge(u_of_edge, v_of_edge, **attr)
+        self.generation += 1
+        is_new = not self.has_edge(u_of_edge, v_of_edge)
+        ret = super().add_edge(u_of_edge, v_of_edge, **attr)
+        data = self._adj[u_of_edge][v_of_edge]
+        data.core = self.core
+        dict.__setitem__(data, "eid", self.core.add_edge(u_of_edge, v_of_edge, link.capacity))
+        self.congestion.update(data["eid"])
+        if is_new:
+            self.path_cache.edge_added(self.hops, u_of_edge, v_of_edge)
+            self.hops.edge_added(u_of_edge, v_of_edge)
+        return ret
 
     def init_hops_from_edgelist(self):
-        self.hops = dict.fromkeys(self.nodes())
-        for key in self.hops:
-            self.hops[key] = dict.fromkeys(self.nodes, None)
+        self.hops.clear()
 
     def bfs(self, source):
-        q = [source]
-        vis = dict.fromkeys(self.nodes, False)
-        self.hops[source][source] = 0
-        cost = 0
-        vis[source] = True
-        while len(q) != 0:
-            size = len(q)
-            while size > 0:
-                s = q[0]
-                size -= 1
-                q = q[1:]
-                for d in self[s]:
-                    if vis[d]:
-                        continue
-                    self.hops[source][d] = cost + 1
-                    vis[d] = True
-                    q.append(d)
-            cost += 1
+        if source not in self.core.node_index:
+            hops = {source: 0}
+        else:
+            dist = self.core.hop_distances(source)
+            reached = np.flatnonzero(dist >= 0)
+            nodes = self.core.nodes
+            hops = dict(zip([nodes[i] for i in reached.tolist()], dist[reached].tolist()))
+        self.hops.put(source, hops)
+        return hops
 
-        return self.hops[source]
+    def hop_distances(self, destination):
+        # Nodes that cannot reach destination are absent from the table
+        hops = self.hops.get(destination)
+        if hops is None:
+            hops = self.bfs(destination)
+        return hops
 
     
     def _astar(self, source, destination, min_link, use_virtual=False):
@@ -112,10 +315,61 @@ class Graph(nx.Graph):
         self._vis[source] = False
         return False
 
-    def astar(self, source, destination, min_link, use_virtual=False):
+    def _astar_iterative(self, source, destination, min_link, use_virtual=False):
+        # Best-first search on hop count, with the BFS hop distance to
+        # destination as the (consistent) heuristic. Links below min_link are
+        # pruned, so the first time destination is popped its path is a
+        # shortest feasible one. Ties prefer nodes closer to destination, then
+        # the tightest link, like sorted_edgelist does.
+        caps = self._capacities(use_virtual)
+        hops = self.hop_distances(destination)
+        if source not in hops:
+            return None
+        cost = {source: 0}
+        parent = {source: None}
+        closed = set()
+        counter = 0
+        heap = [(hops[source], hops[source], 0, counter, source)]
+        while heap:
+            _, _, _, _, node = heappop(heap)
+            if node in closed:
+                continue
+            if node == destination:
+                tracing.annotate(nodes_expanded=len(closed))
+                path = []
+                while node is not None:
+                    path.append(node)
+                    node = parent[node]
+                return list(reversed(path))
+            closed.add(node)
+            next_cost = cost[node] + 1
+            for d, attr in self[node].items():
+                if d in closed:
+                    continue
+                cap = caps[attr["eid"]]
+                if cap < min_link:
+                    continue
+                h = hops.get(d)
+                if h is None or next_cost >= cost.get(d, INF):
+                    continue
+                cost[d] = next_cost
+                parent[d] = node
+                counter += 1
+                heappush(heap, (next_cost + h, h, cap, counter, d))
+        tracing.annotate(nodes_expanded=len(closed))
+        return None
+
+    def astar(self, source, destination, min_link, use_virtual=False, mode=None):
+        tracing.annotate(bw=min_link)
+        if mode is None:
+            mode = self.ASTAR_MODE
+        if mode == ASTAR_ITERATIVE:
+            return self._astar_iterative(source, destination, min_link, use_virtual=use_virtual)
+        if mode != ASTAR_RECURSIVE:
+            raise ValueError(f"Unknown astar mode {mode}")
+
         self._vis = dict.fromkeys(self.nodes, False)
         self._path = dict.fromkeys(self.nodes, None)
-        self.bfs(destination)
         
         res = self._astar(source, destination, min_link, use_virtual=use_virtual)
         if not res:
@@ -128,180 +382,622 @@ class Graph(nx.Graph):
             node = self._path[node]
         return list(reversed(path))
 
-    def astar_greedy_alloc(self, intents):
-        # raise NotImplementedError("Not implemented to use virtual capacities")
-        intents = sorted(intents, key=lambda x: x.required_bw, reverse=True)
-        flows = []
+    def _plan_virtual(self, intents, use_astar=False, unplaced=None, ordered=False):
+        # Greedy placement on the virtual capacities. Returns {intent id: path}
+        # without touching the intents, or None if one of them does not fit.
+        # With an unplaced list, intents that do not fit are appended to it and
+        # the partial plan is returned instead. Intents go by decreasing
+        # required_bw unless ordered is set.
+        if not ordered:
+            intents = sorted(intents, key=lambda x: x.required_bw, reverse=True)
+        tracing.annotate(intents=len(intents))
+        plan = {}
         self.reset_capacities(use_virtual=True)
         for intent in intents:
-            if type(intent.src_host) is str:
-                source = intent.src_host
-                destination = intent.dst_host
-            else:
-                source = intent.src_host.switchport.device
-                destination = intent.dst_host.switchport.device
+            source, destination = self._endpoints(intent)
             req = intent.required_bw
-            path = self.astar(source, destination, req, use_virtual=True)
+            if use_astar:
+                path = self.astar(source, destination, req, use_virtual=True)
+            else:
+                path = self.get_shortest_path(source, destination, req, use_virtual=True)
             if path is None:
-                return None # No Solution
-            intent.path = path.copy()
-            self.allocate_flow(intent, use_virtual=True)
-            flows.append(intent)
-        self.reset_capacities()
+                if unplaced is None:
+                    return None # No Solution
+                unplaced.append(intent)
+                continue
+            self._allocate_path(path, req, CAP_VIRTUAL)
+            plan[intent.id] = path
+        return plan
+
+    @synchronized
+    def _commit_plan(self, intents, plan, generation):
+        # generation: the graph's when the plan was made. A plan made on a
+        # graph that changed since is dropped, counted in plans_dropped, and
+        # None returned.
+        flows = sorted(intents, key=lambda x: x.required_bw, reverse=True)
+        tracing.annotate(intents=len(flows))
+        snapshot = self.fork(clean=True)
+        snapshot.generation = generation
         for intent in flows:
-            self.allocate_flow(intent)
+            snapshot.allocate(intent, plan[intent.id])
+        if not snapshot.commit():
+            self.plans_dropped += 1
+            metrics.PLANS_DROPPED.inc()
+            return None
         return flows
+
+    @metrics.timed(metrics.ALLOCATION_SECONDS, method="astar_greedy_alloc")
+    def astar_greedy_alloc(self, intents):
+        intents = list(intents)
+        tracing.annotate(intents=len(intents))
+        generation = self.generation
+        plan = self._plan_virtual(intents, use_astar=True)
+        if plan is None:
+            return None
+        return self._commit_plan(intents, plan, generation)
     
-    def topk_greedy_allocate(self, intents, full_virtual=False):
-        intents = sorted(intents, key=lambda x: x.required_bw, reverse=True)
-        flows = []
-        self.reset_capacities(use_virtual=True)
-        for intent in intents:
-            if type(intent.src_host) is str:
-                source = intent.src_host
-                destination = intent.dst_host
-            else:
-                source = intent.src_host.switchport.device
-                destination = intent.dst_host.switchport.device
-            req = intent.required_bw
-            path = self.get_shortest_path(source, destination, req, use_virtual=True)
+    def _rip_up_and_reroute(self, target, route, plan, plan_edges, unplaced, intents_by_id, rng):
+        # Place target on route, evicting intents from the links that are too
+        # full for it (those on the hottest links in self.congestion first),
+        # then reroute the evicted intents on what is left
+        caps = self.core.virtual_capacity
+        req = target.required_bw
+        eids = self.path_edges(route)
+        blocking = eids[caps[eids] < req]
+        blocked = np.zeros(len(caps), dtype=bool)
+        blocked[blocking] = True
+        victims = [intent_id for intent_id, edges in plan_edges.items() if blocked[edges].any()]
+        # Intents crossing the most utilized links go first, at random among
+        # equally utilized ones
+        utilization = self.congestion.utilization
+        victims.sort(key=lambda intent_id: (-max(map(utilization, plan_edges[intent_id].tolist())),
+                                            rng.random()))
+        ripped = []
+        for intent_id in victims:
+            if (caps[blocking] >= req).all():
+                break
+            intent = intents_by_id[intent_id]
+            caps[plan_edges.pop(intent_id)] += intent.required_bw
+            del plan[intent_id]
+            ripped.append(intent)
+        caps[eids] -= req
+        plan[target.id] = route
+        plan_edges[target.id] = eids
+        unplaced.remove(target)
+        for intent in sorted(ripped, key=lambda x: x.required_bw, reverse=True):
+            source, destination = self._endpoints(intent)
+            path = self.get_shortest_path(source, destination, intent.required_bw, use_virtual=True)
             if path is None:
+                unplaced.append(intent)
+                continue
+            plan[intent.id] = path
+            plan_edges[intent.id] = self.path_edges(path)
+            caps[plan_edges[intent.id]] -= intent.required_bw
+
+    @metrics.timed(metrics.ALLOCATION_SECONDS, method="anytime_allocate")
+    def anytime_allocate(self, intents, budget=None, seed=None):
+        # Greedy pass first. If it leaves intents out, keep ripping up the
+        # intents on the most congested links of an unplaced intent's route and
+        # rerouting them until everything fits or the budget (seconds) runs
+        # out. Returns the committed flows like topk_greedy_allocate, or None.
+        if budget is None:
+            budget = self.ALLOCATION_BUDGET
+        deadline = time.perf_counter() + budget
+        intents = list(intents)
+        tracing.annotate(intents=len(intents))
+        generation = self.generation
+        unplaced = []
+        plan = self._plan_virtual(intents, unplaced=unplaced)
+        if unplaced:
+            for intent in unplaced:
+                # Does not fit even on an empty network
+                source, destination = self._endpoints(intent)
+                if self._tightest_shortest_path(source, destination, intent.required_bw,
+                                                self.core.max_capacity) is None:
+                    return None
+            rng = random.Random(seed)
+            caps = self.core.virtual_capacity
+            intents_by_id = {intent.id: intent for intent in intents}
+            plan_edges = {intent_id: self.path_edges(path) for intent_id, path in plan.items()}
+            while unplaced and time.perf_counter() < deadline:
+                saved = (caps.copy(), dict(plan), dict(plan_edges), list(unplaced))
+                target = rng.choice(unplaced)
+                source, destination = self._endpoints(target)
+                _, route = self.widest_path(source, destination, use_virtual=True)
+                if route is None or self.core.max_capacity[self.path_edges(route)].min() < target.required_bw:
+                    route = self._tightest_shortest_path(source, destination, target.required_bw,
+                                                         self.core.max_capacity)
+                self._rip_up_and_reroute(target, route, plan, plan_edges, unplaced, intents_by_id, rng)
+                if len(unplaced) > len(saved[3]):
+                    np.copyto(caps, saved[0])
+                    plan, plan_edges, unplaced = saved[1], saved[2], saved[3]
+            if unplaced:
                 return None
-            intent.path = path.copy()
-            if len(path) > 1:
-                self.allocate_flow(intent, use_virtual=True)
-            flows.append(intent)
+        return self._commit_plan(intents, plan, generation)
+
+    @metrics.timed(metrics.ALLOCATION_SECONDS, method="topk_greedy_allocate")
+    def topk_greedy_allocate(self, intents, full_virtual=False):
+        intents = list(intents)
+        tracing.annotate(intents=len(intents))
+        generation = self.generation
+        plan = self._plan_virtual(intents)
+        if plan is None:
+            return None
 
         if full_virtual:
             return True
 
-        self.reset_capacities()
-        for intent in flows:
-            self.allocate_flow(intent)
-        return flows
+        return self._commit_plan(intents, plan, generation)
+
+    def encode_paths(self, paths):
+        return PathBatch(paths, [self.path_edges(path) for path in paths])
 
-    def filter_too_long(self, paths, required_bw, use_virtual=False):
-        best_path = None
-        min_cap = None
-        for path in paths:
-            cap = self.get_path_capacity(path, use_virtual)
-            if required_bw <= cap:
-                limit = len(path)
-                best_path = path
-                min_cap = cap
-                for candidate_path in paths:
-                    if len(candidate_path) > limit:
-                        return best_path
-                    candidate_cap = self.get_path_capacity(candidate_path, use_virtual)
-                    if candidate_cap < min_cap and candidate_cap >= required_bw:
-                        best_path = candidate_path
-                        min_cap = candidate_cap
-        return best_path
-
-    # TODO: Reimplement `shortest_simple_paths` to calculate capacity
     def get_path_capacity(self, path, use_virtual=False):
-        capacity_key = self._get_capacity_key(use_virtual)
         if len(path) == 1:
-            return 10**10
+            return SINGLE_NODE_CAPACITY
         if len(path) < 2:
             raise Exception("Invalid path")
-        u, v = path[0], path[1]
-        min_edge = self[u][v][capacity_key]
-        for u, v in pairwise(path):
-            min_edge = min(min_edge, self[u][v][capacity_key])
+        return int(self._capacities(use_virtual)[self.path_edges(path)].min())
+
+    def _pruned_bfs(self, source, min_link, caps, max_depth=INF):
+        dist = {source: 0}
+        parent = {source: None}
+        q = deque([source])
+        while q:
+            node = q.popleft()
+            if dist[node] >= max_depth:
+                break
+            for d, attr in self[node].items():
+                if d in dist:
+                    continue
+                if min_link is not None and caps[attr["eid"]] < min_link:
+                    continue
+                dist[d] = dist[node] + 1
+                parent[d] = node
+                q.append(d)
+        return dist, parent
+
+    def _tightest_shortest_path(self, src, dst, required_capacity, caps):
+        # Shortest path over links with enough capacity, with the smallest
+        # bottleneck among all of them. Every link (a, b) with
+        # dist_src[a] + 1 + dist_dst[b] == length lies on such a path, so the
+        # tightest of those links decides; two BFS instead of enumerating paths.
+        if src == dst:
+            return [src]
+        dist_src, parent_src = self._pruned_bfs(src, required_capacity, caps)
+        if dst not in dist_src:
+            return None
+        length = dist_src[dst]
+        dist_dst, parent_dst = self._pruned_bfs(dst, required_capacity, caps, length - 1)
+        best = None
+        min_cap = INF
+        for a, da in dist_src.items():
+            if da >= length:
+                continue
+            for b, attr in self[a].items():
+                if dist_dst.get(b) != length - da - 1:
+                    continue
+                cap = caps[attr["eid"]]
+                if required_capacity is not None and cap < required_capacity:
+                    continue
+                if cap < min_cap:
+                    min_cap = cap
+                    best = (a, b)
+        a, b = best
+        path = []
+        while a is not None:
+            path.append(a)
+            a = parent_src[a]
+        path.reverse()
+        while b is not None:
+            path.append(b)
+            b = parent_dst[b]
+        return path
+
+    def count_shortest_paths(self, src, dst, limit=INF):
+        # Number of shortest paths from src to dst ignoring capacity, capped at limit
+        hops = self.hop_distances(dst)
+        if src not in hops:
+            return 0
+        counts = {src: 1}
+        while counts:
+            if dst in counts:
+                return counts[dst]
+            level = {}
+            for node, count in counts.items():
+                h = hops[node] - 1
+                for d in self[node]:
+                    if hops.get(d) == h:
+                        level[d] = min(level.get(d, 0) + count, limit)
+            counts = level
+        return 0
+
+    def all_shortest_paths(self, src, dst):
+        # Every shortest path from src to dst ignoring capacity, walking the
+        # cached hop distances towards dst
+        hops = self.hop_distances(dst)
+        if src not in hops:
+            return
+        stack = [[src]]
+        while stack:
+            path = stack.pop()
+            node = path[-1]
+            if node == dst:
+                yield path
+                continue
+            h = hops[node] - 1
+            for d in self[node]:
+                if hops.get(d) == h:
+                    stack.append(path + [d])
 
-        return min_edge
+    def _cached_shortest_path(self, src, dst, required_capacity, caps):
+        # Among the cached shortest paths the tightest feasible one is the
+        # answer; if none fits the feasible paths are longer than those
+        entry = self.path_cache.entry(self, src, dst)
+        if entry.paths is not None:
+            tracing.annotate(candidates_examined=len(entry.paths))
+            best = entry.batch.select(caps, required_capacity)
+            if best is not None:
+                return entry.paths[best]
+        return self._tightest_shortest_path(src, dst, required_capacity, caps)
+
+    def shortest_path_on(self, src, dst, required_capacity, caps):
+        if self.USE_PATH_CACHE:
+            path = self._cached_shortest_path(src, dst, required_capacity, caps)
+            return None if path is None else list(path)
+        return self._tightest_shortest_path(src, dst, required_capacity, caps)
 
     def get_shortest_path(self, src, dst, required_capacity, use_virtual=False):
-        paths = nx.shortest_simple_paths(self, src, dst)
-        path = self.filter_too_long(paths, required_capacity, use_virtual)
+        tracing.annotate(bw=required_capacity)
+        path = self.shortest_path_on(src, dst, required_capacity, self._capacities(use_virtual))
+        if path is not None:
+            tracing.annotate(path_len=len(path))
         return path
 
+    def _allocate_path(self, path, req, capacity_key):
+        if capacity_key == CAP_REMAINING:
+            self.generation += 1
+        if len(path) > 1:
+            eids = self.path_edges(path)
+            self.core.writable(capacity_key)[eids] -= req
+            if capacity_key == CAP_REMAINING:
+                self.congestion.update(eids)
+
+    @synchronized
     def allocate_flow(self, intent:Intent, use_virtual=False):
-        capacity_key = self._get_capacity_key(use_virtual)
         path = intent.path
-        req = intent.required_bw
         intent_uuid = intent.id
+        self._allocate_path(path, intent.required_bw, self._get_capacity_key(use_virtual))
+        if not use_virtual:
+            self.footprints[intent_uuid] = self.path_edges(path)
         for s, d in pairwise(path):
-            self[s][d][capacity_key] -= req
             self[s][d]["bilink"].intents[intent_uuid] = intent
             
+    @metrics.timed(metrics.ALLOCATION_SECONDS, method="allocate_single")
     def allocate_single(self, intent: Intent):
-        if type(intent.src_host) is str:
-            source = intent.src_host
-            destination = intent.dst_host
-        else:
-            source = intent.src_host.switchport.device
-            destination = intent.dst_host.switchport.device
+        source, destination = self._endpoints(intent)
         req = intent.required_bw
+        tracing.annotate(intent=intent.id, bw=req)
         path = self.get_shortest_path(source, destination, req)
         if path is None:
             return None # No Solution
+        tracing.annotate(path_len=len(path))
         intent.path = path.copy()
         if len(path) == 1:
             return path
         self.allocate_flow(intent)
         return path
 
+    @metrics.timed(metrics.ALLOCATION_SECONDS, method="allocate_single_astar")
     def allocate_single_astar(self, intent: Intent):
-        if type(intent.src_host) is str:
-            source = intent.src_host
-            destination = intent.dst_host
-        else:
-            source = intent.src_host.switchport.device
-            destination = intent.dst_host.switchport.device
+        source, destination = self._endpoints(intent)
         req = intent.required_bw
+        tracing.annotate(intent=intent.id, bw=req)
         path = self.astar(source, destination, req)
         if path is None:
                 return None # No Solution
+        tracing.annotate(path_len=len(path))
         intent.path = path.copy()
         if len(path) == 1:
             return path
         self.allocate_flow(intent)
         return path
 
+    @synchronized
     def reset_capacities(self, use_virtual=False):
-        capacity_key = self._get_capacity_key(use_virtual)
-        for u, v in self.edges:
-            self[u][v][capacity_key] = self[u][v][CAP_MAX]
-            if not use_virtual:
+        self.core.reset(self._get_capacity_key(use_virtual))
+        if not use_virtual:
+            self.generation += 1
+            self.congestion.rebuild()
+            self.footprints.clear()
+            for u, v in self.edges:
                 self[u][v]["bilink"].intents.clear()
 
+    @synchronized
     def remove_edge(self, u, v, virtual=False):
+        self.generation += 1
         try:
             if virtual:
-                return super(Graph, self).remove_edge(u, v)
+                ret = super(Graph, self).remove_edge(u, v)
+                self.congestion.discard(self.core.remove_edge(u, v))
+                self.hops.edge_removed(self, u, v)
+                self.path_cache.edge_removed(u, v)
+                return ret
             removed_intents = set()
             if (u, v) in self.edges:
-                for intent in self[u][v]["bilink"].intents.values():
+                for intent in list(self[u][v]["bilink"].intents.values()):
                     self.remove_flow(intent)
                     removed_intents.add(intent.id)
             super(Graph, self).remove_edge(u, v)
+            self.congestion.discard(self.core.remove_edge(u, v))
+            self.hops.edge_removed(self, u, v)
+            self.path_cache.edge_removed(u, v)
             return removed_intents
         except:
             return None
 
+    @synchronized
+    def set_capacity(self, u, v, capacity):
+        # Changes a link's capacity keeping the flows on it. If they no longer
+        # fit, the largest ones are released until they do; returns their ids.
+        self.generation += 1
+        data = self[u][v]
+        eid = data["eid"]
+        bilink = data["bilink"]
+        delta = capacity - int(self.core.max_capacity[eid])
+        bilink.capacity = capacity
+        self.core.writable(CAP_MAX)[eid] = capacity
+        self.core.writable(CAP_REMAINING)[eid] += delta
+        released = set()
+        for intent in sorted(bilink.intents.values(), key=lambda x: x.required_bw, reverse=True):
+            if self.core.remaining_capacity[eid] >= 0:
+                break
+            self.remove_flow(intent)
+            released.add(intent.id)
+        self.congestion.update(eid)
+        return released
+
+    @metrics.timed(metrics.ALLOCATION_SECONDS, method="repair_intents")
+    @synchronized
+    def repair_intents(self, intents):
+        # Reroute intents whose flows were released (e.g. by remove_edge) on the
+        # remaining capacities, leaving every other intent where it is. All or
+        # nothing: returns the repaired intents, or None with nothing allocated.
+        tracing.annotate(intents=len(intents))
+        snapshot = self.fork()
+        placed = []
+        for intent in sorted(intents, key=lambda x: x.required_bw, reverse=True):
+            if snapshot.allocate(intent) is None:
+                snapshot.discard()
+                return None
+            placed.append(intent)
+        snapshot.commit()
+        return placed
+
+    def fork(self, clean=False):
+        # Copy-on-write view of the remaining capacities to allocate into.
+        # A clean fork starts from an empty network instead.
+        return CapacitySnapshot(self, clean)
+
+    @synchronized
     def remove_flow(self, intent:Intent):
+        self._allocate_path(intent.path, -intent.required_bw, CAP_REMAINING)
+        self.footprints.pop(intent.id, None)
         for u, v in pairwise(intent.path):
-            self[u][v][CAP_REMAINING] += intent.required_bw
             del self[u][v]["bilink"].intents[intent.id]
 
-    def find_best_solution(self, intents, new_intent_id):
-        temp_intents = intents.copy()
+    @synchronized
+    def hottest_links(self, k=10):
+        # [(u, v, utilization)] for the k most utilized links. Under the lock:
+        # the metrics thread calls it and hottest pops entries off the heap
+        names = self.core.nodes
+        return [(names[self.core.edge_ends[eid][0]], names[self.core.edge_ends[eid][1]], util)
+                for eid, util in self.congestion.hottest(k)]
+
+    @synchronized
+    def intent_footprint(self, intent_id):
+        # [(u, v, utilization)] along the links intent_id's flow uses
+        eids = self.footprints.get(intent_id)
+        if eids is None:
+            return []
+        names = self.core.nodes
+        return [(names[self.core.edge_ends[eid][0]], names[self.core.edge_ends[eid][1]],
+                 self.congestion.utilization(eid)) for eid in eids.tolist()]
+
+    def widest_path(self, src, dst, use_virtual=False):
+        # Maximum bottleneck path, fewest hops among equally wide ones.
+        # Returns (bottleneck, path), or (0, None) if nothing fits.
+        caps = self._capacities(use_virtual)
+        if src == dst:
+            return self.get_path_capacity([src]), [src]
+        width = {src: INF}
+        hops = {src: 0}
+        parent = {src: None}
+        done = set()
+        counter = 0
+        heap = [(-INF, 0, counter, src)]
+        while heap:
+            _, _, _, node = heappop(heap)
+            if node in done:
+                continue
+            if node == dst:
+                break
+            done.add(node)
+            for d, attr in self[node].items():
+                if d in done:
+                    continue
+                w = min(width[node], caps[attr["eid"]])
+                h = hops[node] + 1
+                if d in width and (w < width[d] or (w == width[d] and h >= hops[d])):
+                    continue
+                width[d] = w
+                hops[d] = h
+                parent[d] = node
+                counter += 1
+                heappush(heap, (-w, h, counter, d))
+        if dst not in width or width[dst] <= 0:
+            return 0, None
+        path = []
+        node = dst
+        while node is not None:
+            path.append(node)
+            node = parent[node]
+        tracing.annotate(width=int(width[dst]), path_len=len(path))
+        return int(width[dst]), list(reversed(path))
+
+    def max_admissible_bandwidth(self, intents, new_intent_id):
+        # Largest bandwidth (capped at the requested one) the new intent can get
+        # next to the existing intents, and the path carrying it. The existing
+        # intents are re-planned once on the virtual capacities and a single
+        # widest path pass runs on what is left; the current placement on the
+        # remaining capacities is tried as well. No intent is modified.
+        new_intent = intents[new_intent_id]
+        source, destination = self._endpoints(new_intent)
+        others = [intent for intent_id, intent in intents.items() if intent_id != new_intent_id]
+        best_bw, best_path = 0, None
+        if self._plan_virtual(others) is not None:
+            best_bw, best_path = self.widest_path(source, destination, use_virtual=True)
+        bw, path = self.widest_path(source, destination)
+        if bw > best_bw:
+            best_bw, best_path = bw, path
+        return min(best_bw, new_intent.required_bw), best_path
+
+    def _search_best_solution(self, intents, new_intent_id):
+        new_intent = intents[new_intent_id]
+        required_bw = new_intent.required_bw
         l = 0
-        r = intents[new_intent_id].required_bw
+        r = required_bw
         res = -1
-        while l<=r:
-            mid = (l + r)>>1
-            temp_intents[new_intent_id].required_bw = mid
-            can = self.topk_greedy_allocate(temp_intents.values(), full_virtual=True)
-            if can:
-                l = mid + 1
-                res = mid
-            else:
-                r = mid - 1
+        try:
+            while l<=r:
+                mid = (l + r)>>1
+                new_intent.required_bw = mid
+                can = self.topk_greedy_allocate(intents.values(), full_virtual=True)
+                if can:
+                    l = mid + 1
+                    res = mid
+                else:
+                    r = mid - 1
+        finally:
+            new_intent.required_bw = required_bw
         return res
 
+    @metrics.timed(metrics.ALLOCATION_SECONDS, method="find_best_solution")
+    def find_best_solution(self, intents, new_intent_id, mode=None):
+        tracing.annotate(intent=new_intent_id)
+        if mode is None:
+            mode = self.BEST_SOLUTION_MODE
+        if mode == BEST_SOLUTION_WIDEST:
+            return self.max_admissible_bandwidth(intents, new_intent_id)[0]
+        if mode != BEST_SOLUTION_SEARCH:
+            raise ValueError(f"Unknown best solution mode {mode}")
+        return self._search_best_solution(intents, new_intent_id)
+
+
+class CapacitySnapshot:
+    # Speculative allocation state over a Graph: the remaining capacities are
+    # shared with the graph until the first write here, and intent placements
+    # are only recorded. commit() applies everything at once, provided the
+    # graph did not change since the fork; discard() just drops it. Either
+    # ends the snapshot.
+    def __init__(self, graph, clean=False):
+        self.graph = graph
+        self.clean = clean
+        with graph.lock:
+            self.generation = graph.generation
+            self.capacities = graph.core.share(CAP_MAX if clean else CAP_REMAINING)
+        self._owned = False
+        self.placements = {}    # intent id -> (intent, path)
+        self.released = {}      # intent id -> intent whose graph flow is given back
+
+    def _writable(self):
+        if not self._owned:
+            self.capacities = self.capacities.copy()
+            self._owned = True
+        return self.capacities
+
+    def _add(self, path, amount):
+        if len(path) > 1:
+            self._writable()[self.graph.path_edges(path)] += amount
+
+    def _placed_on_graph(self, intent):
+        if self.clean or intent.id in self.released or not intent.path or len(intent.path) < 2:
+            return False
+        u, v = intent.path[0], intent.path[1]
+        return self.graph.has_edge(u, v) and intent.id in self.graph[u][v]["bilink"].intents
+
+    @property
+    def stale(self):
+        return self.generation != self.graph.generation
+
+    def path_capacity(self, path):
+        if len(path) < 2:
+            return SINGLE_NODE_CAPACITY
+        return int(self.capacities[self.graph.path_edges(path)].min())
+
+    def get_shortest_path(self, src, dst, required_capacity):
+        with self.graph.lock:
+            return self.graph.shortest_path_on(src, dst, required_capacity, self.capacities)
+
+    def allocate(self, intent, path=None):
+        # Places intent on path, or on the tightest shortest feasible path.
+        # Returns the path, or None if it does not fit.
+        if path is None:
+            source, destination = self.graph._endpoints(intent)
+            path = self.get_shortest_path(source, destination, intent.required_bw)
+            if path is None:
+                return None
+        self.release(intent)
+        self._add(path, -intent.required_bw)
+        self.placements[intent.id] = (intent, path)
+        return path
+
+    def release(self, intent):
+        # Gives back what intent holds here, its planned path if it has one,
+        # else its current flow on the graph
+        if intent.id in self.placements:
+            _, path = self.placements.pop(intent.id)
+            self._add(path, intent.required_bw)
+        elif self._placed_on_graph(intent):
+            self._add(intent.path, intent.required_bw)
+            self.released[intent.id] = intent
+
+    def headroom(self):
+        return self.graph.core.headroom(self.capacities)
+
+    def commit(self):
+        # Returns False, changing nothing, if the graph moved on since the fork
+        graph = self.graph
+        with graph.lock:
+            if self.stale:
+                return False
+            if self.clean:
+                graph.footprints.clear()
+                for u, v in graph.edges:
+                    graph[u][v]["bilink"].intents.clear()
+            for intent in self.released.values():
+                graph.footprints.pop(intent.id, None)
+                for u, v in pairwise(intent.path):
+                    del graph[u][v]["bilink"].intents[intent.id]
+            for intent, path in self.placements.values():
+                intent.path = path.copy()
+                graph.footprints[intent.id] = graph.path_edges(path)
+                for u, v in pairwise(path):
+                    graph[u][v]["bilink"].intents[intent.id] = intent
+            old = graph.core.remaining_capacity
+            graph.core.adopt(CAP_REMAINING, self._writable())
+            graph.congestion.update(np.flatnonzero(old != self.capacities))
+            graph.generation += 1
+        self.discard()
+        return True
+
+    def discard(self):
+        self.generation = None
+        self.capacities = None
+        self.placements.clear()
+        self.released.clear()
+
+
 def main(graph_file="g.graph", intents_file=None, online=False):
     if intents_file is None:
        intents = [Intent("h1", "h2", 7), Intent("3", "h1", 2)]
@@ -320,8 +1016,8 @@ def main(graph_file="g.graph", intents_file=None, online=False):
         if can is None:
             print("No Solution")
             return False
-        for u, v in g.edges:
-            print(f"{u}->{v}: {g[u][v]['remaining_capacity']}")
+        for u, v, util in g.hottest_links(len(g.edges)):
+            print(f"{u}->{v}: {g[u][v]['remaining_capacity']} ({util:.0%} used)")
         return True
 
     elif online:
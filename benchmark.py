@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+
+# Synthetic benchmarks of the Graph allocators.
+#
+#   ./benchmark.py --suite quick --output before.json
+#   ./benchmark.py --topology fat-tree --size 16 --workload hotspot --intents 500
+#   ./benchmark.py --compare before.json after.json
+#
+# Every (topology, workload, algorithm) run starts from a fresh graph and
+# reports wall time, peak memory (tracemalloc, measured in a separate run so
+# it does not skew the timing), admission ratio and the capacity left over.
+
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from Graph import Graph
+from utilClasses import BiLink, Intent
+
+DEFAULT_CAPACITY = 100
+
+TOPOLOGIES = ["fat-tree", "leaf-spine", "grid", "ring", "waxman"]
+WORKLOADS = ["uniform", "hotspot", "elephant-mouse"]
+ALGORITHMS = ["allocate_single", "allocate_single_astar", "topk_greedy_allocate", "astar_greedy_alloc",
+              "anytime_allocate", "find_best_solution"]
+
+# (topology, size, workload, intents); size is k for fat-tree, the number of
+# leaves for leaf-spine, the side for grid and the switches for ring/waxman
+SUITES = {
+    "quick": [
+        ("fat-tree", 4, "uniform", 50),
+        ("leaf-spine", 8, "hotspot", 100),
+        ("grid", 6, "elephant-mouse", 100),
+        ("ring", 20, "uniform", 40),
+        ("waxman", 50, "uniform", 100),
+    ],
+    "full": [
+        ("fat-tree", 16, "uniform", 1000),
+        ("fat-tree", 88, "hotspot", 100),               # 9680 switches, ~1 s per intent
+        ("leaf-spine", 256, "elephant-mouse", 2000),
+        ("grid", 100, "uniform", 500),                  # 10000 switches
+        ("ring", 1000, "uniform", 200),
+        ("waxman", 1000, "hotspot", 1000),
+        ("waxman", 10000, "uniform", 500),
+    ],
+}
+
+# find_best_solution is only asked about this many rejected intents per run
+FIND_BEST_LIMIT = 20
+# Compare mode ignores wall time changes of runs shorter than this (seconds)
+MIN_COMPARE_SECONDS = 0.01
+
+
+# Topologies: (edges [(u, v, capacity)], switches intents may start or end at)
+
+def fat_tree(k, capacity=DEFAULT_CAPACITY):
+    # k-ary fat-tree: (k/2)^2 core switches, k pods of k/2 aggregation and
+    # k/2 edge switches
+    if k % 2:
+        raise ValueError("A fat-tree needs an even k")
+    half = k // 2
+    edges = []
+    edge_switches = []
+    for pod in range(k):
+        for a in range(half):
+            agg = f"a{pod}_{a}"
+            for c in range(half):
+                edges.append((f"c{a * half + c}", agg, capacity))
+            for e in range(half):
+                edges.append((agg, f"e{pod}_{e}", capacity))
+        edge_switches.extend(f"e{pod}_{e}" for e in range(half))
+    return edges, edge_switches
+
+
+def leaf_spine(leaves, spines=None, capacity=DEFAULT_CAPACITY):
+    if spines is None:
+        spines = max(2, leaves // 4)
+    edges = [(f"s{s}", f"l{l}", capacity) for s in range(spines) for l in range(leaves)]
+    return edges, [f"l{l}" for l in range(leaves)]
+
+
+def grid(rows, cols=None, capacity=DEFAULT_CAPACITY):
+    if cols is None:
+        cols = rows
+    edges = []
+    for r in range(rows):
+        for c in range(cols):
+            if c + 1 < cols:
+                edges.append((f"{r}_{c}", f"{r}_{c + 1}", capacity))
+            if r + 1 < rows:
+                edges.append((f"{r}_{c}", f"{r + 1}_{c}", capacity))
+    return edges, [f"{r}_{c}" for r in range(rows) for c in range(cols)]
+
+
+def ring(n, capacity=DEFAULT_CAPACITY):
+    return [(str(i), str((i + 1) % n), capacity) for i in range(n)], [str(i) for i in range(n)]
+
+
+def waxman(n, degree=4, alpha=0.15, seed=0, capacity=DEFAULT_CAPACITY):
+    # Waxman random graph on the unit square: u and v are linked with
+    # probability beta * exp(-d(u, v) / (alpha * L)), beta picked for an
+    # average degree of about degree. Every switch is also linked to its
+    # nearest predecessor so the graph is connected.
+    rng = np.random.default_rng(seed)
+    points = rng.random((n, 2))
+    scale = alpha * math.sqrt(2)
+    sample = rng.integers(0, n, (min(n * n, 10000), 2))
+    mean = np.exp(-np.linalg.norm(points[sample[:, 0]] - points[sample[:, 1]], axis=1) / scale).mean()
+    beta = min(1.0, degree / max((n - 1) * mean, 1e-12))
+    edges = []
+    for i in range(1, n):
+        d = np.linalg.norm(points[:i] - points[i], axis=1)
+        linked = np.flatnonzero(rng.random(i) < beta * np.exp(-d / scale))
+        nearest = int(d.argmin())
+        if nearest not in linked:
+            linked = np.append(linked, nearest)
+        edges.extend((str(i), str(j), capacity) for j in linked.tolist())
+    return edges, [str(i) for i in range(n)]
+
+
+def read_graph(filename):
+    # A .graph file (src dst capacity per line); host lines are skipped
+    edges = []
+    with open(filename) as f:
+        for line in f:
+            if len(line.split()) != 3 or line.startswith("#"):
+                continue
+            s, d, cap = line.split()
+            if s.startswith("h") or d.startswith("h"):
+                continue
+            edges.append((s, d, int(cap)))
+    return edges, sorted({node for s, d, _ in edges for node in (s, d)})
+
+
+def write_graph(edges, filename):
+    with open(filename, "w") as f:
+        for s, d, cap in edges:
+            f.write(f"{s} {d} {cap}\n")
+
+
+GENERATORS = {
+    "fat-tree": fat_tree,
+    "leaf-spine": leaf_spine,
+    "grid": grid,
+    "ring": ring,
+    "waxman": waxman,
+}
+
+
+def build_graph(edges):
+    g = Graph()
+    for s, d, cap in edges:
+        g.add_edge(s, d, bilink=BiLink(s, d, cap))
+    return g
+
+
+# Workloads: [(src, dst, required_bw)]
+
+def _pair(rng, sources, destinations):
+    src = rng.choice(sources)
+    dst = rng.choice(destinations)
+    while dst == src and len(destinations) > 1:
+        dst = rng.choice(destinations)
+    return src, dst
+
+
+def uniform(endpoints, n, max_bw=10, seed=0):
+    rng = random.Random(seed)
+    return [(*_pair(rng, endpoints, endpoints), rng.randint(1, max_bw)) for _ in range(n)]
+
+
+def hotspot(endpoints, n, max_bw=10, hot=0.05, share=0.8, seed=0):
+    # share of the intents end at the hot fraction of the endpoints
+    rng = random.Random(seed)
+    hot_endpoints = rng.sample(endpoints, max(1, int(len(endpoints) * hot)))
+    workload = []
+    for _ in range(n):
+        destinations = hot_endpoints if rng.random() < share else endpoints
+        workload.append((*_pair(rng, endpoints, destinations), rng.randint(1, max_bw)))
+    return workload
+
+
+def elephant_mouse(endpoints, n, max_bw=40, elephants=0.1, seed=0):
+    # A few elephants asking for max_bw / 2 to max_bw, mice for 1 or 2
+    rng = random.Random(seed)
+    workload = []
+    for _ in range(n):
+        if rng.random() < elephants:
+            bw = rng.randint(max(1, max_bw // 2), max_bw)
+        else:
+            bw = rng.randint(1, 2)
+        workload.append((*_pair(rng, endpoints, endpoints), bw))
+    return workload
+
+
+WORKLOAD_GENERATORS = {
+    "uniform": uniform,
+    "hotspot": hotspot,
+    "elephant-mouse": elephant_mouse,
+}
+
+
+def _run_algorithm(g, algorithm, intents):
+    # Number of intents admitted
+    if algorithm in ("allocate_single", "allocate_single_astar"):
+        allocate = getattr(g, algorithm)
+        return sum(allocate(intent) is not None for intent in intents)
+    if algorithm in ("topk_greedy_allocate", "astar_greedy_alloc", "anytime_allocate"):
+        # All or nothing
+        return len(intents) if getattr(g, algorithm)(intents) is not None else 0
+    if algorithm == "find_best_solution":
+        # Counter-offers for the intents allocate_single turns down
+        placed = {}
+        asked = 0
+        for intent in intents:
+            if g.allocate_single(intent) is not None:
+                placed[intent.id] = intent
+            elif asked < FIND_BEST_LIMIT:
+                asked += 1
+                g.find_best_solution(dict(placed, **{intent.id: intent}), intent.id)
+        return len(placed)
+    raise ValueError(f"Unknown algorithm {algorithm}")
+
+
+def run_one(edges, workload, algorithm, memory=True):
+    intents = [Intent(src, dst, bw) for src, dst, bw in workload]
+    g = build_graph(edges)
+    start = time.perf_counter()
+    admitted = _run_algorithm(g, algorithm, intents)
+    wall = time.perf_counter() - start
+
+    eids = g.core.edge_ids()
+    capacity = int(g.core.max_capacity[eids].sum())
+    min_headroom, residual = g.core.headroom(g.core.remaining_capacity)
+    result = {
+        "algorithm": algorithm,
+        "wall_s": wall,
+        "admitted": admitted,
+        "admission_ratio": admitted / len(intents) if intents else 1.0,
+        "min_headroom": min_headroom,
+        "residual_ratio": residual / capacity if capacity else 1.0,
+        "peak_kb": None,
+    }
+    if memory:
+        intents = [Intent(src, dst, bw) for src, dst, bw in workload]
+        g = build_graph(edges)
+        tracemalloc.start()
+        try:
+            _run_algorithm(g, algorithm, intents)
+            result["peak_kb"] = tracemalloc.get_traced_memory()[1] / 1024
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def run_case(topology, size, workload, n_intents, algorithms=ALGORITHMS, seed=0, memory=True, graph_file=None):
+    if graph_file is not None:
+        edges, endpoints = read_graph(graph_file)
+        topology = os.path.basename(graph_file)
+    elif topology == "waxman":
+        edges, endpoints = waxman(size, seed=seed)
+    else:
+        edges, endpoints = GENERATORS[topology](size)
+    intents = WORKLOAD_GENERATORS[workload](endpoints, n_intents, seed=seed)
+    switches = len({node for s, d, _ in edges for node in (s, d)})
+    results = []
+    for algorithm in algorithms:
+        result = run_one(edges, intents, algorithm, memory=memory)
+        result.update(topology=topology, size=size, switches=switches, links=len(edges),
+                      workload=workload, intents=n_intents)
+        results.append(result)
+        print(f"{topology:>10} {size:>6} {workload:>14} {algorithm:>22}: {result['wall_s'] * 1000:10.1f} ms "
+              f"admitted {result['admission_ratio']:6.1%} min headroom {result['min_headroom']:5.2f}"
+              + (f" peak {result['peak_kb']:9.0f} KiB" if result["peak_kb"] is not None else ""),
+              file=sys.stderr)
+    return results
+
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(cases, algorithms=ALGORITHMS, seed=0, memory=True, graph_file=None):
+    results = []
+    for topology, size, workload, n_intents in cases:
+        results.extend(run_case(topology, size, workload, n_intents, algorithms, seed, memory, graph_file))
+    return {
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "seed": seed,
+        "results": results,
+    }
+
+
+def _key(result):
+    return (result["topology"], result["size"], result["workload"], result["intents"], result["algorithm"])
+
+
+def compare(old, new, tolerance=0.25):
+    # Regressions of new against old: a run more than tolerance slower, or
+    # admitting fewer intents. Returns [(key, what, old value, new value)].
+    before = {_key(result): result for result in old["results"]}
+    regressions = []
+    for result in new["results"]:
+        base = before.get(_key(result))
+        if base is None:
+            continue
+        if (max(base["wall_s"], result["wall_s"]) >= MIN_COMPARE_SECONDS
+                and result["wall_s"] > base["wall_s"] * (1 + tolerance)):
+            regressions.append((_key(result), "wall_s", base["wall_s"], result["wall_s"]))
+        if result["admission_ratio"] < base["admission_ratio"]:
+            regressions.append((_key(result), "admission_ratio", base["admission_ratio"],
+                                result["admission_ratio"]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Graph allocators on synthetic topologies")
+    parser.add_argument("--suite", choices=sorted(SUITES), help="run a predefined set of cases")
+    parser.add_argument("--topology", choices=TOPOLOGIES, default="fat-tree")
+    parser.add_argument("--graph", help="use a .graph file instead of a generated topology")
+    parser.add_argument("--size", type=int, default=4)
+    parser.add_argument("--workload", choices=WORKLOADS, default="uniform")
+    parser.add_argument("--intents", type=int, default=100)
+    parser.add_argument("--algorithms", default=",".join(ALGORITHMS), help="comma separated")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc runs")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="compare two result files, exit 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown in compare mode")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        regressions = compare(old, new, args.tolerance)
+        for key, what, before, after in regressions:
+            print(f"REGRESSION {' '.join(map(str, key))}: {what} {before:.4g} -> {after:.4g}")
+        print(f"{len(regressions)} regressions ({old.get('commit')} -> {new.get('commit')})")
+        return 1 if regressions else 0
+
+    algorithms = [algorithm for algorithm in args.algorithms.split(",") if algorithm]
+    for algorithm in algorithms:
+        if algorithm not in ALGORITHMS:
+            parser.error(f"Unknown algorithm {algorithm}")
+    if args.suite:
+        cases = SUITES[args.suite]
+    else:
+        cases = [(args.topology, args.size, args.workload, args.intents)]
+    report = run(cases, algorithms, args.seed, not args.no_memory, args.graph)
+    data = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(data)
+    else:
+        print(data)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
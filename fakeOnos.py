@@ -0,0 +1,515 @@
+#!/usr/bin/env python3
+
+# Stand-in for the parts of the ONOS REST API BWO (and hostIntentApp) talks
+# to, for load tests without ONOS or Mininet:
+#
+#   ./fakeOnos.py serve --graph g.graph --port 8181 --latency 0.005 --fail 30:1-2
+#   ./fakeOnos.py load --graph topology1.graph --intents 500 --error-rate 0.01
+#
+# Topologies come from .graph files and are laid out like mntopo.py does it:
+# switch n is device of:<n in 16 hex digits>, the port of a switch link is
+# the number of the switch at the other end, hosts hang off the next free
+# ports and host n has MAC n. Flow rules are kept in memory per device.
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import random
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
+
+import requests
+
+REST_APP_ID = "org.onosproject.rest"
+
+
+def device_id(number):
+    return "of:" + format(number, "016x")
+
+
+def host_mac(number):
+    return ":".join(format(number, "012x")[i:i + 2] for i in range(0, 12, 2))
+
+
+class FakeOnos:
+    # Every request waits latency seconds (plus up to jitter more) and fails
+    # with error_status with probability error_rate. Links go down and up
+    # with fail_link/restore_link or on the schedule given to start(); with
+    # event_url the change is also POSTed there as topoEvents events.
+    BASE_PATH = "/onos/v1"
+
+    def __init__(self, host="127.0.0.1", port=8181, latency=0, jitter=0, error_rate=0, error_status=503,
+                 seed=None, event_url=None, configured=True):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.event_url = event_url
+        # Annotate the links with their .graph bandwidth without waiting for
+        # a POST to network/configuration
+        self.configured = configured
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.numbers = {}   # {switch name: number}
+        self.links = {}     # {(name, name): (src device, src port, dst device, dst port, bandwidth)}
+        self.down = set()   # keys of self.links
+        self.hosts = {}     # {hostId: host JSON}
+        self.config = {"links": {}}
+        self.flows = {}     # {deviceId: {flowId: flow JSON}}
+        self.stats = {"requests": 0, "errors": 0, "flows_installed": 0, "flows_deleted": 0}
+        self._server = None
+        self._stop = threading.Event()
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}{self.BASE_PATH}"
+
+    # Topology
+
+    def _number(self, name):
+        number = self.numbers.get(name)
+        if number is None:
+            number = int(name) if name.isdigit() and int(name) not in self.numbers.values() else \
+                max(list(self.numbers.values()) + [0]) + 1
+            self.numbers[name] = number
+            self.flows.setdefault(device_id(number), {})
+        return number
+
+    def add_link(self, u, v, bandwidth):
+        nu, nv = self._number(u), self._number(v)
+        self.links[(u, v)] = (device_id(nu), str(nv), device_id(nv), str(nu), int(bandwidth))
+
+    def add_host(self, number, switch):
+        # On the next free port of switch
+        device = device_id(self._number(switch))
+        used = [int(link[1]) for link in self.links.values() if link[0] == device]
+        used += [int(link[3]) for link in self.links.values() if link[2] == device]
+        used += [int(host["locations"][0]["port"]) for host in self.hosts.values()
+                 if host["locations"][0]["elementId"] == device]
+        mac = host_mac(number)
+        host_id = f"{mac.upper()}/None"
+        self.hosts[host_id] = {
+            "id": host_id,
+            "mac": mac.upper(),
+            "vlan": "None",
+            "ipAddresses": [f"10.0.{number // 256}.{number % 256}"],
+            "locations": [{"elementId": device, "port": str(max(used + [0]) + 1)}],
+        }
+        return host_id
+
+    def load_graph(self, filename, hosts_per_switch=1):
+        # Hosts are taken from the h<n> lines; a file without any gets
+        # hosts_per_switch hosts on every switch
+        hosts = []
+        with open(filename) as f:
+            for line in f:
+                if len(line.split()) != 3 or line.startswith("#"):
+                    continue
+                s, d, bw = line.split()
+                if s.startswith("h"):
+                    hosts.append((int(s[1:]), d))
+                else:
+                    self.add_link(s, d, bw)
+        if not hosts:
+            switches = sorted(self.numbers, key=self.numbers.get)
+            hosts = [(i + 1, switch) for i, switch in enumerate(switches * hosts_per_switch)]
+        for number, switch in hosts:
+            self.add_host(number, switch)
+
+    def _link_json(self, src, src_port, dst, dst_port, bandwidth):
+        link = {"src": {"device": src, "port": src_port}, "dst": {"device": dst, "port": dst_port},
+                "type": "DIRECT", "state": "ACTIVE"}
+        config = self.config["links"].get(f"{src}/{src_port}-{dst}/{dst_port}", {}).get("basic", {})
+        if "bandwidth" in config:
+            link["annotations"] = {"bandwidth": str(config["bandwidth"])}
+        elif self.configured:
+            link["annotations"] = {"bandwidth": str(bandwidth)}
+        return link
+
+    def links_json(self):
+        links = []
+        for key, (src, src_port, dst, dst_port, bandwidth) in self.links.items():
+            if key not in self.down:
+                links.append(self._link_json(src, src_port, dst, dst_port, bandwidth))
+                links.append(self._link_json(dst, dst_port, src, src_port, bandwidth))
+        return links
+
+    def _link_key(self, u, v):
+        key = (u, v) if (u, v) in self.links else (v, u)
+        if key not in self.links:
+            raise KeyError(f"No link {u}-{v}")
+        return key
+
+    def _set_link(self, u, v, up):
+        with self.lock:
+            key = self._link_key(u, v)
+            if up:
+                self.down.discard(key)
+            else:
+                self.down.add(key)
+            src, src_port, dst, dst_port, bandwidth = self.links[key]
+            events = [{"type": "LINK_ADDED" if up else "LINK_REMOVED", "link": link}
+                      for link in (self._link_json(src, src_port, dst, dst_port, bandwidth),
+                                   self._link_json(dst, dst_port, src, src_port, bandwidth))]
+        if self.event_url is not None:
+            try:
+                requests.post(self.event_url, json=events, timeout=5)
+            except requests.RequestException as e:
+                print(f"Failed to push link events: {e}")
+
+    def fail_link(self, u, v):
+        self._set_link(u, v, False)
+
+    def restore_link(self, u, v):
+        self._set_link(u, v, True)
+
+    def ports(self, device):
+        # A link port is disabled while the link is down
+        ports = {}
+        for key, (src, src_port, dst, dst_port, _) in self.links.items():
+            for end, port in ((src, src_port), (dst, dst_port)):
+                if end == device:
+                    ports[port] = key not in self.down
+        for host in self.hosts.values():
+            if host["locations"][0]["elementId"] == device:
+                ports[host["locations"][0]["port"]] = True
+        return [{"element": device, "port": port, "isEnabled": enabled, "type": "copper"}
+                for port, enabled in sorted(ports.items(), key=lambda item: int(item[0]))]
+
+    def paths(self, src, dst):
+        # Shortest paths by hop count between two devices (or the devices of
+        # two hosts), like GET /paths/{src}/{dst}
+        devices = {}
+        for host in self.hosts.values():
+            devices[host["id"]] = host["locations"][0]["elementId"]
+        src, dst = devices.get(src, src), devices.get(dst, dst)
+        adjacent = {}
+        for link in self.links_json():
+            adjacent.setdefault(link["src"]["device"], []).append(link)
+        parents = {src: None}
+        frontier = [src]
+        while frontier and dst not in parents:
+            following = []
+            for device in frontier:
+                for link in adjacent.get(device, ()):
+                    if link["dst"]["device"] not in parents:
+                        parents[link["dst"]["device"]] = link
+                        following.append(link["dst"]["device"])
+            frontier = following
+        if dst not in parents or src == dst:
+            return []
+        links = []
+        device = dst
+        while parents[device] is not None:
+            links.append(parents[device])
+            device = parents[device]["src"]["device"]
+        return [{"cost": float(len(links)), "links": list(reversed(links))}]
+
+    # Flow rules
+
+    @staticmethod
+    def flow_id(flow, app_id):
+        # Like ONOS, the id only depends on where the rule goes and what it
+        # matches, so installing the same selector again replaces the rule
+        key = json.dumps([flow["deviceId"], flow.get("priority"), app_id,
+                          sorted(json.dumps(c, sort_keys=True) for c in flow.get("selector", {}).get("criteria", []))])
+        return str(int.from_bytes(hashlib.blake2b(key.encode(), digest_size=7).digest(), "big"))
+
+    def install(self, flows, app_id=REST_APP_ID):
+        # [(deviceId, flowId)]; unknown devices fail the whole batch
+        with self.lock:
+            for flow in flows:
+                if flow.get("deviceId") not in self.flows:
+                    raise KeyError(f"Device {flow.get('deviceId')} not found")
+            installed = []
+            for flow in flows:
+                flow_id = self.flow_id(flow, app_id)
+                self.flows[flow["deviceId"]][flow_id] = dict(flow, id=flow_id, appId=app_id, state="ADDED")
+                installed.append((flow["deviceId"], flow_id))
+            self.stats["flows_installed"] += len(installed)
+            return installed
+
+    def remove(self, entries):
+        with self.lock:
+            for device, flow_id in entries:
+                if self.flows.get(device, {}).pop(str(flow_id), None) is not None:
+                    self.stats["flows_deleted"] += 1
+
+    def flow_count(self):
+        with self.lock:
+            return sum(len(flows) for flows in self.flows.values())
+
+    # REST
+
+    def handle(self, method, url, body):
+        # (status, payload, headers)
+        split = urlsplit(url)
+        if not split.path.startswith(self.BASE_PATH):
+            return 404, {"code": 404, "message": "Not found"}, {}
+        parts = [unquote(part) for part in split.path[len(self.BASE_PATH):].split("/") if part]
+        app_id = parse_qs(split.query).get("appId", [REST_APP_ID])[0]
+        try:
+            if method == "GET" and parts == ["hosts"]:
+                with self.lock:
+                    return 200, {"hosts": list(self.hosts.values())}, {}
+            if method == "GET" and len(parts) == 2 and parts[0] == "hosts":
+                with self.lock:
+                    if parts[1] not in self.hosts:
+                        return 404, {"code": 404, "message": f"Host {parts[1]} not found"}, {}
+                    return 200, self.hosts[parts[1]], {}
+            if method == "GET" and len(parts) == 3 and parts[0] == "devices" and parts[2] == "ports":
+                with self.lock:
+                    if parts[1] not in self.flows:
+                        return 404, {"code": 404, "message": f"Device {parts[1]} not found"}, {}
+                    return 200, {"id": parts[1], "ports": self.ports(parts[1])}, {}
+            if method == "GET" and parts == ["links"]:
+                with self.lock:
+                    return 200, {"links": self.links_json()}, {}
+            if method == "GET" and len(parts) == 3 and parts[0] == "paths":
+                with self.lock:
+                    return 200, {"paths": self.paths(parts[1], parts[2])}, {}
+            if parts == ["network", "configuration"]:
+                if method == "GET":
+                    return 200, self.config, {}
+                if method == "POST":
+                    with self.lock:
+                        for subject, entries in (body or {}).items():
+                            self.config.setdefault(subject, {}).update(entries)
+                    return 200, None, {}
+            if parts and parts[0] == "flows":
+                return self._handle_flows(method, parts[1:], body, app_id)
+        except KeyError as e:
+            return 400, {"code": 400, "message": str(e).strip("'\"")}, {}
+        except (TypeError, ValueError) as e:
+            return 400, {"code": 400, "message": f"Malformed request: {e}"}, {}
+        return 404, {"code": 404, "message": f"No route for {method} {split.path}"}, {}
+
+    def _handle_flows(self, method, parts, body, app_id):
+        if method == "GET":
+            with self.lock:
+                if not parts:
+                    return 200, {"flows": [flow for flows in self.flows.values() for flow in flows.values()]}, {}
+                flows = self.flows.get(parts[0])
+                if flows is None:
+                    return 404, {"code": 404, "message": f"Device {parts[0]} not found"}, {}
+                if len(parts) == 2:
+                    if parts[1] not in flows:
+                        return 404, {"code": 404, "message": f"Flow {parts[1]} not found"}, {}
+                    return 200, {"flows": [flows[parts[1]]]}, {}
+                return 200, {"flows": list(flows.values())}, {}
+        if method == "POST" and not parts:
+            installed = self.install(body["flows"], app_id)
+            return 200, {"flows": [{"deviceId": device, "flowId": flow_id} for device, flow_id in installed]}, {}
+        if method == "POST" and len(parts) == 1:
+            ((device, flow_id),) = self.install([dict(body, deviceId=parts[0])], app_id)
+            return 201, None, {"Location": f"{self.url}/flows/{device}/{flow_id}"}
+        if method == "DELETE" and not parts:
+            self.remove([(entry["deviceId"], entry["flowId"]) for entry in body["flows"]])
+            return 204, None, {}
+        if method == "DELETE" and len(parts) == 2:
+            self.remove([(parts[0], parts[1])])
+            return 204, None, {}
+        return 404, {"code": 404, "message": f"No route for {method} flows"}, {}
+
+    def _inject(self):
+        # Delay the request; returns the status to fail it with, or None
+        with self.lock:
+            self.stats["requests"] += 1
+            delay = self.latency + (self.rng.uniform(0, self.jitter) if self.jitter else 0)
+            fail = self.error_rate and self.rng.random() < self.error_rate
+            if fail:
+                self.stats["errors"] += 1
+        if delay:
+            time.sleep(delay)
+        return self.error_status if fail else None
+
+    def start(self, schedule=()):
+        # schedule: [(seconds after start, "down" or "up", switch, switch)]
+        onos = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive like ONOS; headers and body go out as separate
+            # writes, Nagle would hold the body back for a delayed ACK
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def _serve(self):
+                length = int(self.headers.get("Content-Length", 0))
+                raw = self.rfile.read(length) if length else b""
+                status = onos._inject()
+                headers = {}
+                if status is not None:
+                    payload = {"code": status, "message": "Injected failure"}
+                else:
+                    try:
+                        body = json.loads(raw) if raw else None
+                    except ValueError as e:
+                        status, payload = 400, {"code": 400, "message": str(e)}
+                    else:
+                        status, payload, headers = onos.handle(self.command, self.path, body)
+                data = b"" if payload is None else json.dumps(payload).encode()
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                if data:
+                    self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_DELETE = _serve
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_port
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        if schedule:
+            threading.Thread(target=self._run_schedule, args=(sorted(schedule),), daemon=True).start()
+
+    def _run_schedule(self, schedule):
+        start = time.monotonic()
+        for at, action, u, v in schedule:
+            if self._stop.wait(max(0, start + at - time.monotonic())):
+                return
+            print(f"Link {u}-{v} {action} at {at}s")
+            self._set_link(u, v, action == "up")
+
+    def stop(self):
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))] if values else None
+
+
+def load_test(graph_file, intents=100, max_bw=5, seed=0, hosts_per_switch=1, schedule=(), quiet=True,
+              **faults):
+    # Adds intents one after the other through a StateManager running
+    # against a FakeOnos, the way the prompt or the API would, and reports
+    # the install latency and throughput
+    import intentapp
+    import utilClasses
+
+    onos = FakeOnos(port=0, seed=seed, **faults)
+    onos.load_graph(graph_file, hosts_per_switch)
+    onos.start(schedule)
+    base_url = utilClasses.BASE_URL
+    utilClasses.set_base_url(onos.url)
+    rng = random.Random(seed)
+    latencies = []
+    try:
+        output = io.StringIO() if quiet else sys.stdout
+        with contextlib.redirect_stdout(output):
+            manager = intentapp.StateManager()
+            manager.retrieve_topo_from_ONOS(draw=False)
+            hosts = sorted(manager.hosts)
+            start = time.perf_counter()
+            for _ in range(intents):
+                src, dst = rng.sample(hosts, 2)
+                intent = utilClasses.Intent(manager.hosts[src], manager.hosts[dst], rng.randint(1, max_bw))
+                began = time.perf_counter()
+                try:
+                    manager.add_intent(intent)
+                except Exception as e:
+                    print(f"Adding {intent} failed: {e}")
+                latencies.append(time.perf_counter() - began)
+                if schedule:
+                    manager.update_topo_from_ONOS()
+            elapsed = time.perf_counter() - start
+    finally:
+        utilClasses.set_base_url(base_url)
+        onos.stop()
+    return {
+        "graph": graph_file,
+        "intents": intents,
+        "admitted": len(manager.intents),
+        "seconds": elapsed,
+        "throughput": intents / elapsed if elapsed else None,
+        "latency_ms": {
+            "mean": statistics.mean(latencies) * 1000 if latencies else None,
+            "p50": _percentile(latencies, 50) * 1000 if latencies else None,
+            "p95": _percentile(latencies, 95) * 1000 if latencies else None,
+            "p99": _percentile(latencies, 99) * 1000 if latencies else None,
+        },
+        "rules": onos.flow_count(),
+        "onos": dict(onos.stats),
+    }
+
+
+def _schedule(args):
+    schedule = []
+    for action, specs in (("down", args.fail), ("up", args.restore)):
+        for spec in specs or ():
+            at, link = spec.split(":")
+            u, v = link.split("-")
+            schedule.append((float(at), action, u, v))
+    return schedule
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fake ONOS REST API for load testing BWO")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve = commands.add_parser("serve", help="serve a topology")
+    load = commands.add_parser("load", help="load test a StateManager against a fake ONOS")
+    for command in (serve, load):
+        command.add_argument("--graph", default="g.graph")
+        command.add_argument("--hosts-per-switch", type=int, default=1,
+                             help="hosts per switch for .graph files without host lines")
+        command.add_argument("--latency", type=float, default=0, help="seconds added to every request")
+        command.add_argument("--jitter", type=float, default=0, help="up to this many more seconds")
+        command.add_argument("--error-rate", type=float, default=0, help="fraction of requests failing")
+        command.add_argument("--error-status", type=int, default=503)
+        command.add_argument("--seed", type=int, default=None)
+        command.add_argument("--fail", action="append", metavar="SECONDS:U-V", help="take link U-V down")
+        command.add_argument("--restore", action="append", metavar="SECONDS:U-V", help="bring link U-V up")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8181)
+    serve.add_argument("--event-url", help="POST link events here, e.g. http://127.0.0.1:8765/events")
+    serve.add_argument("--unconfigured", action="store_true",
+                       help="only annotate link bandwidths POSTed to network/configuration")
+    load.add_argument("--intents", type=int, default=100)
+    load.add_argument("--max-bw", type=int, default=5)
+    load.add_argument("--verbose", action="store_true", help="show the controller output")
+    args = parser.parse_args(argv)
+
+    faults = {"latency": args.latency, "jitter": args.jitter, "error_rate": args.error_rate,
+              "error_status": args.error_status}
+    if args.command == "load":
+        report = load_test(args.graph, args.intents, args.max_bw, args.seed or 0, args.hosts_per_switch,
+                           _schedule(args), quiet=not args.verbose, **faults)
+        print(json.dumps(report, indent=2))
+        return 0
+
+    onos = FakeOnos(args.host, args.port, seed=args.seed, event_url=args.event_url,
+                    configured=not args.unconfigured, **faults)
+    onos.load_graph(args.graph, args.hosts_per_switch)
+    onos.start(_schedule(args))
+    print(f"Fake ONOS serving {len(onos.numbers)} switches and {len(onos.hosts)} hosts on {onos.url}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        onos.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
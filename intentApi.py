@@ -0,0 +1,100 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+# Longest ?wait= a request may ask for (seconds)
+MAX_WAIT = 60
+
+
+class IntentApi:
+    # Local HTTP/JSON front end to the StateThread command queue. Every
+    # request is queued as a command and answered with its job:
+    #   POST   /intents          {"src": h1, "dst": h2, "bw": 5}
+    #   POST   /intents/batch    {"intents": [{"src": h1, "dst": h2, "bw": 5}, ...]}
+    #   GET    /intents
+    #   DELETE /intents/<intentId or all>
+    #   POST   /commands         {"command": "add 1 2 5"}
+    #   GET    /jobs/<jobId>
+    # 202 while the job is queued or running, 200 once it is done. With
+    # ?wait=<seconds> the answer waits for the job to finish first.
+    def __init__(self, state_thread, host="127.0.0.1", port=8766):
+        self.state_thread = state_thread
+        self.host = host
+        self.port = port
+        self._server = None
+
+    def route(self, method, path, body):
+        # Returns the command to queue, None if nothing is served at path.
+        # A malformed body raises KeyError, TypeError or ValueError.
+        parts = [part for part in path.split("/") if part]
+        if parts == ["intents"] and method == "POST":
+            return f"add {body['src']} {body['dst']} {int(body['bw'])}"
+        if parts == ["intents", "batch"] and method == "POST":
+            return "add-batch " + " ".join(f"{intent['src']} {intent['dst']} {int(intent['bw'])}"
+                                           for intent in body["intents"])
+        if parts == ["intents"] and method == "GET":
+            return "list"
+        if len(parts) == 2 and parts[0] == "intents" and method == "DELETE":
+            return f"rm {parts[1]}"
+        if parts == ["commands"] and method == "POST":
+            return str(body["command"])
+        return None
+
+    def handle(self, method, url, body):
+        # (status, payload)
+        split = urlsplit(url)
+        query = parse_qs(split.query)
+        parts = [part for part in split.path.split("/") if part]
+        if len(parts) == 2 and parts[0] == "jobs" and method == "GET":
+            job = self.state_thread.get_job(parts[1])
+            if job is None:
+                return 404, {"error": f"Job {parts[1]} not found"}
+        else:
+            try:
+                command = self.route(method, split.path, body)
+            except KeyError as e:
+                return 400, {"error": f"Missing field {e}"}
+            except (TypeError, ValueError) as e:
+                return 400, {"error": f"Malformed request: {e}"}
+            if command is None:
+                return 404, {"error": f"No route for {method} {split.path}"}
+            job = self.state_thread.submit(command)
+        if "wait" in query:
+            job.wait(min(float(query["wait"][0]), MAX_WAIT))
+        return (200 if job.finished is not None else 202), job.json()
+
+    def start(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _serve(self):
+                body = None
+                length = int(self.headers.get("Content-Length", 0))
+                try:
+                    if length:
+                        body = json.loads(self.rfile.read(length))
+                    status, payload = api.handle(self.command, self.path, body)
+                except ValueError as e:
+                    status, payload = 400, {"error": str(e)}
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_DELETE = _serve
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.port = self._server.server_port
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
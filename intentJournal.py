@@ -0,0 +1,94 @@
+import json
+import os
+import threading
+
+OP_PUT = "put"          # full state of an intent: endpoints, bandwidth, path, flow rules
+OP_REMOVE = "remove"
+
+
+class IntentJournal:
+    # Append-only log of the intents: every change is appended to journal.log
+    # (one JSON record per line) and fsynced right away, removals before the
+    # rules are deleted. Every COMPACT_EVERY records the replayed state is
+    # written out as snapshot.json and the log starts over, so replay stays
+    # short.
+    COMPACT_EVERY = 1000
+    FSYNC = True
+    LOG = "journal.log"
+    SNAPSHOT = "snapshot.json"
+
+    def __init__(self, directory, compact_every=None):
+        self.directory = directory
+        self.compact_every = self.COMPACT_EVERY if compact_every is None else compact_every
+        os.makedirs(directory, exist_ok=True)
+        self.log_path = os.path.join(directory, self.LOG)
+        self.snapshot_path = os.path.join(directory, self.SNAPSHOT)
+        self._lock = threading.Lock()
+        self.state = self._replay()     # {intentId: latest put record}
+        self._log = open(self.log_path, "a")
+        self._appended = 0
+
+    def _replay(self):
+        state = {}
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path) as f:
+                state = json.load(f)
+        if os.path.exists(self.log_path):
+            with open(self.log_path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break   # torn write at the end of the log
+                    self._apply(state, record)
+        return state
+
+    @staticmethod
+    def _apply(state, record):
+        if record["op"] == OP_PUT:
+            state[record["id"]] = record
+        elif record["op"] == OP_REMOVE:
+            state.pop(record["id"], None)
+
+    def _sync(self, f):
+        f.flush()
+        if self.FSYNC:
+            os.fsync(f.fileno())
+
+    def append(self, records):
+        if not records:
+            return
+        with self._lock:
+            for record in records:
+                self._log.write(json.dumps(record, separators=(",", ":")) + "\n")
+                self._apply(self.state, record)
+            self._sync(self._log)
+            self._appended += len(records)
+            if self._appended >= self.compact_every:
+                self._compact()
+
+    def put(self, record):
+        self.append([dict(record, op=OP_PUT)])
+
+    def remove(self, intent_ids):
+        self.append([{"op": OP_REMOVE, "id": intent_id} for intent_id in intent_ids])
+
+    def _compact(self):
+        tmp = self.snapshot_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.state, f, separators=(",", ":"))
+            self._sync(f)
+        os.replace(tmp, self.snapshot_path)
+        # The snapshot covers everything logged so far
+        self._log.close()
+        self._log = open(self.log_path, "w")
+        self._sync(self._log)
+        self._appended = 0
+
+    def compact(self):
+        with self._lock:
+            self._compact()
+
+    def close(self):
+        with self._lock:
+            self._log.close()
@@ -2,19 +2,52 @@
 
 import time
 import json
-import requests
+import hashlib
+from collections import OrderedDict, deque
+import queue
 import threading
 import traceback
 import os
 import uuid
 
 from utilClasses import *
+from onosClient import OnosError
 from Graph import Graph
+import portfolio
+import metrics
+import tracing
+import topoEvents
+import intentApi
+from intentJournal import IntentJournal, OP_PUT
 
 
 # BASE_URL = 'http://localhost:8181/onos/v1'
 # AUTH = ('onos', 'rocks')
 
+# (host, port) the topology event webhook listens on, e.g. ('127.0.0.1', 8765),
+# None to only poll ONOS
+EVENT_WEBHOOK = None
+# (host, port) of the local intent JSON API, e.g. ('127.0.0.1', 8766),
+# None to only use the prompt
+INTENT_API = None
+
+# (host, port) of the Prometheus metrics endpoint, e.g. ('127.0.0.1', 9105),
+# None to keep metrics off
+METRICS_ENDPOINT = None
+# Record nested timing spans around the allocator and the control loop,
+# see tracing.py; off by default
+TRACING = False
+# Directory of the intent journal for warm restarts, e.g. 'journal'. None
+# starts from scratch on every run and clears the flows on exit.
+JOURNAL_DIR = None
+# appId ONOS gives the rules installed through its REST API
+REST_APP_ID = 'org.onosproject.rest'
+
+# Flow programming state of an intent, see StateManager.programming
+PROGRAM_PENDING = "pending"
+PROGRAM_INSTALLED = "installed"
+PROGRAM_FAILED = "failed"       # rolled back, ONOS only has the rules of its previous path, if any
+
 def convert_num_to_hostid(num):   # num should <= 255, e.g. convert '14' to '00:00:00:00:00:0e/None'
     num_hex = format(int(num), '02x')
     hostid = '00:00:00:00:00:' + num_hex + '/None'
@@ -41,129 +74,351 @@ def gen_linksconfig_fromfile(filename):
 def config_links_ONOS():
     print("\nConfiguring link capacities in ONOS...\n")
     
-    url = '{}/network/configuration'.format(BASE_URL)
-    response = requests.post(url, auth=AUTH, json=gen_linksconfig_fromfile("g.graph"))
+    response = get_client().post('network/configuration', gen_linksconfig_fromfile("g.graph"))
     print(response.text)
 
 
+def bilink_from_json(link):
+    # (src device, dst device, BiLink) for an ONOS /links entry
+    sw1 = SwitchPort(link['src'])
+    sw2 = SwitchPort(link['dst'])
+    if 'annotations' in link and 'bandwidth' in link['annotations']:
+        bw = int(link['annotations']['bandwidth'])
+    else:
+        bw = BiLink.DEFAULT_CAPACITY
+    return sw1.device, sw2.device, BiLink(sw1, sw2, bw)
+
+
 class StateManager():
+    # Worker processes planning several intent orderings in parallel on
+    # recalculate, 0 to only use the sequential allocator
+    PORTFOLIO_WORKERS = 0
+    # Share destination-keyed rules between intents whose paths lead the same
+    # way towards a host, instead of exact rules per intent and hop
+    AGGREGATE_RULES = False
+    # Attempts at placing a batch when the graph keeps changing before the
+    # placement is committed
+    COMMIT_RETRIES = 3
+
     def __init__(self):
         self.graph = None
         self.hosts = dict()     # {hostId: <Host>}
         self.intents = {}       # a map of Intent
+        self.repair_events = deque(maxlen=100)
+        self.programming = {}   # {intentId: PROGRAM_*}
+        self.reconcile_stats = None     # what the last program_intents did
+        self._fingerprints = {}  # {ONOS resource: digest of the last response applied}
+        self._seen_hosts = {}   # {hostId: host JSON last applied}
+        self.journal = None     # IntentJournal, see restore_intents
+        # Aggregation mode: every installed rule once, with its users
+        self.rule_table = {}    # {rule key: Flow}
+        self.rule_refs = {}     # {rule key: {intentId}}
+        self.aggregation_stats = None   # rules saved by sharing, see _program_aggregated
 
 
-    def retrieve_topo_from_ONOS(self):
+    def retrieve_topo_from_ONOS(self, draw=True):
         print("\nInitiating Graph...\n")
         graph = Graph()
         # graph.edgelist format: {switch1_Id: {switch2_Id: <BiLink>}, switch2_Id: {switch1_Id: <BiLink>}}, the same BiLink will appear twice in this mapping
         
         # Get hosts
-        url = '{}/hosts'.format(BASE_URL)
-        response = requests.get(url, auth=AUTH).json()
+        response = get_client().get('hosts')
         if 'hosts' in response:
             for host in response['hosts']:
                 self.hosts[host['id']] = Host(host)
+                self._seen_hosts[host['id']] = host
         
         # Initiate graph.edgelist
         # Get links: "Does not return links connected to hosts"
-        url = '{}/links'.format(BASE_URL)
-        response = requests.get(url, auth=AUTH).json()
+        response = get_client().get('links')
         if 'links' in response:
             for link in response['links']:
-                src_swId = link['src']['device']
-                dst_swId = link['dst']['device']
-                # # if BiLink btw src_swId and dst_swId already created
-                # if dst_swId in swlinkmap and src_swId in swlinkmap[dst_swId]:
-                #     bilink = swlinkmap[dst_swId][src_swId]
-                if True:
-                    sw1 = SwitchPort(link['src'])
-                    sw2 = SwitchPort(link['dst'])
-                    if 'annotations' in link and 'bandwidth' in link['annotations']:
-                        bw = int(link['annotations']['bandwidth'])
-                    else:
-                        bw = BiLink.DEFAULT_CAPACITY
-                    
-                    bilink = BiLink(sw1, sw2, bw)
-                    # associate BiLink with link <src_swId -- dst_swId>
+                # associate BiLink with link <src_swId -- dst_swId>
+                src_swId, dst_swId, bilink = bilink_from_json(link)
                 graph.add_edge(src_swId, dst_swId, bilink=bilink)
 
         # Initiate graph.hops
         graph.init_hops_from_edgelist()
         graph.assign_capacities()
         self.graph = graph
-        self.graph.draw()
+        if draw:
+            self.graph.draw()
     
-    def update_topo_from_ONOS(self):
-        # print(f"\nUpdating Graph...\n")
+    def _fetch(self, resource):
+        # (parsed ONOS response, its digest), the response being None if it is
+        # byte for byte the one last applied
+        body = get_client().request('GET', resource).content
+        digest = hashlib.blake2b(body, digest_size=16).digest()
+        if self._fingerprints.get(resource) == digest:
+            metrics.TOPOLOGY_SYNC_SKIPPED.inc(resource=resource)
+            return None, digest
+        return (json.loads(body) if body else {}), digest
 
-        # Update self.hosts
-        hosts_list = list(self.hosts.keys())    # make a list of current host ids
-        # Get hosts
-        url = '{}/hosts'.format(BASE_URL)
-        response = requests.get(url, auth=AUTH).json()
-        if 'hosts' in response:
-            for host in response['hosts']:
-                if host['id'] in hosts_list:
-                    hosts_list.remove(host['id'])
-                else:
-                    self.hosts[host['id']] = Host(host)
-        
-        if hosts_list:
+    def _sync_hosts(self, hosts):
+        current = {host['id']: host for host in hosts}
+        removed = self.hosts.keys() - current.keys()
+        if removed:
             # some host disconnected
-            print("hosts disconnected ", hosts_list)
-            for host in hosts_list:
-                del self.hosts[host]
-        # Update self.graph.edgelist
-        # swlinkmap = self.graph.edgelist
-        # # make a copy of current links
-        # swlinkmap_copy = dict.fromkeys(swlinkmap.keys())
-        # for key in swlinkmap.keys():
-        #     swlinkmap_copy[key] = dict.fromkeys(swlinkmap[key].keys())
-        
-        # Get links
-        url = '{}/links'.format(BASE_URL)
-        response = requests.get(url, auth=AUTH).json()
-        temp_graph = Graph()
-        temp_graph.add_edges_from(self.graph.edges)
-        if 'links' in response:
-            for link in response['links']:
-                src_swId = link['src']['device']
-                dst_swId = link['dst']['device']
-
-
-                if True:
-                    # if BiLink btw src_swId and dst_swId already created in self.graph.edgelist
-                    if (src_swId, dst_swId) in self.graph.edges:
-                        bilink = self.graph[dst_swId][src_swId]["bilink"]
-                        temp_graph.remove_edge(src_swId, dst_swId, virtual=True)
-                    else:   # create a new BiLink
-                        sw1 = SwitchPort(link['src'])
-                        sw2 = SwitchPort(link['dst'])
-
-                        if 'annotations' in link and 'bandwidth' in link['annotations']:
-                            bw = int(link['annotations']['bandwidth'])
-                        else:
-                            bw = BiLink.DEFAULT_CAPACITY
-                        print(f"Link {src_swId}--{dst_swId} Discovered")
-                        bilink = BiLink(sw1, sw2, bw)
-                        self.graph.add_edge(sw1, sw2, bilink=bilink)
+            print("hosts disconnected ", list(removed))
+            for host_id in removed:
+                del self.hosts[host_id]
+                self._seen_hosts.pop(host_id, None)
+        for host_id, host in current.items():
+            if self._seen_hosts.get(host_id) != host:
+                self.hosts[host_id] = Host(host)
+                self._seen_hosts[host_id] = host
+
+    def _sync_links(self, links):
+        # Set difference between the links ONOS reports and the graph edges,
+        # both keyed by their (sorted) device ids
+        start = time.perf_counter()
+        current = {}
+        for link in links:
+            src_swId, dst_swId, bilink = bilink_from_json(link)
+            current.setdefault(tuple(sorted((src_swId, dst_swId))), (src_swId, dst_swId, bilink))
+        known = {tuple(sorted(edge)) for edge in self.graph.edges}
 
         removed_intents = set()
-        for edge in temp_graph.edges:
+        for key in current.keys() - known:
+            src_swId, dst_swId, bilink = current[key]
+            print(f"Link {src_swId}--{dst_swId} Discovered")
+            self.graph.add_edge(src_swId, dst_swId, bilink=bilink)
+        changed = [key for key in current.keys() & known
+                   if self.graph[key[0]][key[1]]["bilink"].capacity != current[key][2].capacity]
+        for u, v in changed:
+            capacity = current[(u, v)][2].capacity
+            print(f"Link {u}--{v} capacity changed to {capacity}")
+            removed_intents.update(self.graph.set_capacity(u, v, capacity))
+        removed_links = list(known - current.keys())
+        for edge in removed_links:
             print(f"Link: {edge} disconnected")
-            intents = self.graph.remove_edge(*edge)
-            for intent in intents:
-                removed_intents.add(intent)
+            removed_intents.update(self.graph.remove_edge(*edge) or ())
+
+        # Reroute the intents affected by the removed edges as one batch
+        if removed_intents or removed_links:
+            self.repair_intents(removed_intents, removed_links, start, changed)
+
+    def update_topo_from_ONOS(self):
+        # Applies only what changed since the last poll. Unchanged responses
+        # are skipped without parsing, otherwise hosts and links are diffed
+        # as sets against the current state.
+        with metrics.TOPOLOGY_SYNC_SECONDS.time():
+            for resource, sync in (('hosts', self._sync_hosts), ('links', self._sync_links)):
+                response, digest = self._fetch(resource)
+                if response is not None:
+                    sync(response.get(resource, []))
+                    # only once applied, a failed sync is tried again on the next poll
+                    self._fingerprints[resource] = digest
+
+    def _links_on_port(self, device, port):
+        if device not in self.graph:
+            return []
+        return [(device, neighbour) for neighbour, data in self.graph[device].items()
+                if str(data["bilink"].get_port_of_switch(device)) == str(port)]
+
+    def apply_topology_events(self, events):
+        # Applies pushed topology events (see topoEvents) as they arrive. The
+        # intents on every link lost in the batch are repaired together.
+        start = time.perf_counter()
+        tracing.annotate(events=len(events))
+        self._fingerprints.clear()  # the next sweep compares against the graph again
+        removed_links = []
+        changed_links = []
+        removed_intents = set()
+        for event in events:
+            kind = event["type"]
+            metrics.TOPOLOGY_EVENTS.inc(type=kind)
+            lost = []
+            if kind in (topoEvents.LINK_ADDED, topoEvents.LINK_UPDATED):
+                src_swId, dst_swId, bilink = bilink_from_json(event["link"])
+                if not self.graph.has_edge(src_swId, dst_swId):
+                    print(f"Link {src_swId}--{dst_swId} Discovered")
+                    self.graph.add_edge(src_swId, dst_swId, bilink=bilink)
+                elif self.graph[src_swId][dst_swId]["bilink"].capacity != bilink.capacity:
+                    print(f"Link {src_swId}--{dst_swId} capacity changed to {bilink.capacity}")
+                    released = self.graph.set_capacity(src_swId, dst_swId, bilink.capacity)
+                    if released:
+                        changed_links.append((src_swId, dst_swId))
+                        removed_intents.update(released)
+            elif kind == topoEvents.LINK_REMOVED:
+                lost = [(event["link"]["src"]["device"], event["link"]["dst"]["device"])]
+            elif kind == topoEvents.PORT_REMOVED or (kind == topoEvents.PORT_UPDATED
+                                                      and not event["port"].get("isEnabled", True)):
+                lost = self._links_on_port(event["port"]["device"], event["port"]["port"])
+            elif kind in (topoEvents.HOST_ADDED, topoEvents.HOST_UPDATED):
+                self.hosts[event["host"]["id"]] = Host(event["host"])
+            elif kind == topoEvents.HOST_REMOVED:
+                print("hosts disconnected ", [event["host"]["id"]])
+                self.hosts.pop(event["host"]["id"], None)
+            for edge in lost:
+                if not self.graph.has_edge(*edge):
+                    continue    # the other direction of a link already removed
+                print(f"Link: {edge} disconnected")
+                removed_links.append(edge)
+                removed_intents.update(self.graph.remove_edge(*edge) or ())
+        if removed_links or changed_links:
+            self.repair_intents(removed_intents, removed_links, start, changed_links)
+
+    def _journal_put(self, intents):
+        if self.journal is None:
+            return
+        self.journal.append([{
+            "op": OP_PUT,
+            "id": intent.id,
+            "src": intent.src_host.id,
+            "dst": intent.dst_host.id,
+            "bw": intent.required_bw,
+            "path": intent.path,
+            "flows": [[*self._rule_key(rule), rule.id] for rule in intent.flowRules or ()],
+        } for intent in intents])
 
-        # Recalculate intents affected by the removed edges
-        for intent_id in removed_intents:
-            print(f"reinstalling intent {self.intents[intent_id]}")
-            self.add_intent(self.intents[intent_id])
-        del temp_graph
+    def _forget(self, intent_ids):
+        if self.journal is not None:
+            self.journal.remove(intent_ids)
+        for intent_id in intent_ids:
+            self.intents.pop(intent_id, None)
+            self.programming.pop(intent_id, None)
+
+    def restore_intents(self):
+        # Warm restart: rebuilds the intents recorded in the journal on the
+        # current topology and adopts the rules ONOS still has for them, so
+        # only missing rules are installed and traffic keeps flowing. Intents
+        # whose path is gone are repaired. Rules of ours the journal does not
+        # know (left behind by a crash) are deleted.
+        if self.journal is None or not self.journal.state:
+            return
+        start = time.perf_counter()
+        response = get_client().get('flows')
+        ours = {(flow['deviceId'], str(flow['id'])) for flow in response.get('flows', [])
+                if flow.get('appId') == REST_APP_ID
+                and flow.get('priority') in (Flow.priority, Flow.aggregate_priority)}
+        adopted = set()
+        restored, broken, dropped = [], [], []
+        for record in list(self.journal.state.values()):
+            if record["src"] not in self.hosts or record["dst"] not in self.hosts:
+                print(f"Intent {record['id']} lost its hosts, dropping it")
+                dropped.append(record["id"])
+                continue
+            intent = Intent(self.hosts[record["src"]], self.hosts[record["dst"]], record["bw"])
+            intent.id = record["id"]
+            intent.path = record["path"]
+            intent.flowRules = []
+            for device, src_mac, dst_mac, in_port, out_port, flow_id in record["flows"]:
+                rule = Flow(device, src_mac, dst_mac, in_port, out_port)
+                if (device, flow_id) in ours:
+                    rule.id = flow_id
+                    adopted.add((device, flow_id))
+                intent.flowRules.append(rule)
+            if self.AGGREGATE_RULES:
+                intent.flowRules = self._hold_rules(intent.id, [rule for rule in intent.flowRules
+                                                                if rule.id is not None])
+            self.intents[intent.id] = intent
+            path = intent.path
+            if (path and all(self.graph.has_edge(u, v) for u, v in zip(path, path[1:]))
+                    and self.graph.get_path_capacity(path) >= intent.required_bw):
+                self.graph.allocate_flow(intent)
+                restored.append(intent)
+            else:
+                broken.append(intent.id)
+
+        orphans = []
+        for device, flow_id in ours - adopted:
+            rule = Flow(device, None, None, None, None)
+            rule.id = flow_id
+            orphans.append(rule)
+        get_client().delete_flows(orphans)
+        self._forget(dropped)
+        self.program_intents(restored)
+        if broken:
+            self.repair_intents(broken)
+        print(f"Restored {len(self.intents)} intents from the journal in "
+              f"{(time.perf_counter() - start) * 1000:.1f} ms: {len(adopted)} rules adopted, "
+              f"{len(orphans)} orphan rules deleted, {len(broken)} intents rerouted, {len(dropped)} dropped")
+
+    def _hold_rules(self, intent_id, rules):
+        # Registers intent_id as a user of rules, returns the shared copies
+        held = []
+        for rule in rules:
+            key = self._rule_key(rule)
+            held.append(self.rule_table.setdefault(key, rule))
+            self.rule_refs.setdefault(key, set()).add(intent_id)
+        return held
+
+    def _release_rules(self, intent_id, rules):
+        # Drops intent_id from the users of rules, returns those left unused
+        unused = []
+        for rule in rules:
+            key = self._rule_key(rule)
+            users = self.rule_refs.get(key)
+            if users is None:
+                continue
+            users.discard(intent_id)
+            if not users:
+                del self.rule_refs[key]
+                unused.append(self.rule_table.pop(key))
+        return unused
+
+    def _delete_flowrules(self, intent):
+        rules = intent.flowRules
+        if rules is not None and self.AGGREGATE_RULES:
+            rules = self._release_rules(intent.id, rules)
+        if rules is not None:
+            get_client().delete_flows(rules)
+        intent.flowRules = None
+
+    def repair_intents(self, intent_ids, removed_links=(), start=None, changed_links=()):
+        # Intents whose links disappeared or shrank (changed_links) are
+        # rerouted on the remaining capacities without touching the others;
+        # only if that fails is the whole network re-planned
+        if start is None:
+            start = time.perf_counter()
+        affected = [self.intents[intent_id] for intent_id in intent_ids if intent_id in self.intents]
+        tracing.annotate(intents=len(affected), links=len(removed_links), changed=len(changed_links))
+
+        escalated = False
+        dropped = []
+        to_program = self.graph.repair_intents(affected)
+        if to_program is None:
+            escalated = True
+            print(f"Batch repair of {len(affected)} intents failed, re-planning all intents")
+            stale = self.graph.plans_dropped
+            flows = self.graph.anytime_allocate(self.intents.values())
+            self._report_dropped_plans(stale)
+            if flows is not None:
+                to_program = flows
+            else:
+                to_program = []
+                for intent in affected:
+                    if self.graph.allocate_single(intent) is None:
+                        print(f"Intent {intent} cannot be restored, removing it")
+                        self._forget([intent.id])
+                        self._delete_flowrules(intent)
+                        dropped.append(intent.id)
+                    else:
+                        to_program.append(intent)
+
+        failed = self._program_moved(to_program)
+
+        event = {
+            "links": removed_links,
+            "changed": changed_links,
+            "affected": len(affected),
+            "dropped": len(dropped),
+            "failed": len(failed),
+            "escalated": escalated,
+            "latency_ms": (time.perf_counter() - start) * 1000,
+        }
+        self.repair_events.append(event)
+        metrics.REPAIRS.inc(escalated=str(escalated).lower())
+        print(f"Repaired {len(affected) - len(dropped) - len(failed)}/{len(affected)} intents after "
+              f"{len(removed_links)} link failures and {len(changed_links)} capacity changes "
+              f"in {event['latency_ms']:.1f} ms"
+              f"{' (global re-plan)' if escalated else ''}")
+        return event
 
     def add_intent(self, newIntent: Intent):
         print(f"\nAdding {newIntent}...\n")
+        tracing.annotate(intent=newIntent.id, bw=newIntent.required_bw)
 
         if newIntent.id not in self.intents:
             self.intents[newIntent.id] = newIntent
@@ -172,12 +427,101 @@ class StateManager():
         if path is None:
             print("No immediate solution found, recalculating")
             self.recalculate(newIntent.id)
-            return
-        self.intents[newIntent.id].path = path.copy()
-        self.gen_flowrules_from_path(newIntent.id)
+        else:
+            self.intents[newIntent.id].path = path.copy()
+            if self.program_intents([newIntent]):
+                self.graph.remove_flow(newIntent)
+                self._forget([newIntent.id])
+        if newIntent.id in self.intents:
+            metrics.INTENTS_ADMITTED.inc()
+        else:
+            metrics.INTENTS_REJECTED.inc()
+
+    def _place(self, intents):
+        # Places intents on the remaining capacities, largest first, and
+        # commits them if they all fit, planning again if the graph changed
+        # meanwhile. Returns the intents that were not placed.
+        for _ in range(self.COMMIT_RETRIES):
+            snapshot = self.graph.fork()
+            rejected = [intent for intent in sorted(intents, key=lambda x: x.required_bw, reverse=True)
+                        if snapshot.allocate(intent) is None]
+            if rejected:
+                snapshot.discard()
+                return rejected
+            if snapshot.commit():
+                return []
+        print("The network kept changing while placing the batch, rejecting it")
+        return list(intents)
+
+    def add_intents(self, newIntents):
+        # Admits a batch of intents in one pass: the batch is placed on the
+        # remaining capacities (largest first); if some do not fit, the whole
+        # network is re-planned with them, and failing that the greedy plan
+        # admitting the most of them is kept. Rejected intents get a counter
+        # offer, the widest path left for each on its own. All rules are
+        # programmed together at the end. Returns a result per intent.
+        newIntents = list(newIntents)
+        tracing.annotate(intents=len(newIntents))
+        print(f"\nAdding a batch of {len(newIntents)} intents...\n")
+        existing = list(self.intents.values())
+
+        rejected = self._place(newIntents)
+        to_program = newIntents
+        stale = self.graph.plans_dropped
+        if rejected:
+            flows = self.graph.anytime_allocate(existing + newIntents)
+            if flows is not None:
+                rejected = []
+                to_program = flows
+            else:
+                unplaced = []
+                generation = self.graph.generation
+                plan = self.graph._plan_virtual(existing + newIntents, unplaced=unplaced)
+                flows = None
+                if len(unplaced) < len(rejected) and all(intent in newIntents for intent in unplaced):
+                    placed = [intent for intent in existing + newIntents if intent.id in plan]
+                    flows = self.graph._commit_plan(placed, plan, generation)
+                if flows is not None:
+                    rejected = unplaced
+                    to_program = flows
+                else:
+                    # Same placement as the first pass
+                    rejected += self._place([intent for intent in newIntents if intent not in rejected])
+        self._report_dropped_plans(stale)
+
+        rejected_ids = {intent.id for intent in rejected}
+        for intent in newIntents:
+            if intent.id not in rejected_ids:
+                self.intents[intent.id] = intent
+        self._program_moved([intent for intent in to_program if intent.id not in rejected_ids],
+                            {intent.id for intent in newIntents})
+
+        results = []
+        for intent in newIntents:
+            admitted = intent.id in self.intents
+            result = {"intent": intent.id, "bw": intent.required_bw, "admitted": admitted,
+                      "path": intent.path if admitted else None, "offer": None}
+            if not admitted:
+                source, destination = self.graph._endpoints(intent)
+                result["offer"] = min(self.graph.widest_path(source, destination)[0], intent.required_bw)
+            results.append(result)
+        admitted = sum(result['admitted'] for result in results)
+        metrics.INTENTS_ADMITTED.inc(admitted)
+        metrics.INTENTS_REJECTED.inc(len(results) - admitted)
+        print(f"Admitted {admitted}/{len(results)} intents")
+        return results
 
     def recalculate(self, new_intent_id):
-        flows = self.graph.topk_greedy_allocate(self.intents.values())
+        tracing.annotate(intent=new_intent_id, intents=len(self.intents))
+        stale = self.graph.plans_dropped
+        flows = None
+        if self.PORTFOLIO_WORKERS:
+            flows = portfolio.portfolio_allocate(self.graph, self.intents.values(),
+                                                 workers=self.PORTFOLIO_WORKERS)
+        if flows is None:
+            flows = self.graph.anytime_allocate(self.intents.values())
+        self._report_dropped_plans(stale)
+        metrics.RECALCULATIONS.inc(outcome="failure" if flows is None else "success")
         if flows is None:
             res = self.graph.find_best_solution(self.intents, new_intent_id)
             
@@ -185,44 +529,96 @@ class StateManager():
                 print("No solution can be found for this intent")
             else:
                 print(f"This intent can be allocated with a maximum capacity of {res}")
-            del self.intents[new_intent_id]
+            self._forget([new_intent_id])
             return
             raise NotImplementedError("NO solution found, need to implement a resource sharing algorithm")
             # Do Resource Sharing
             return
         
-        self.clear_all_flows(soft_clear=True)
         for intent in flows:
             print(intent)
-            self.gen_flowrules_from_path(intent.id)
+        self._program_moved(flows, {new_intent_id})
+
+    def _report_dropped_plans(self, since):
+        # since: graph.plans_dropped before planning
+        if self.graph.plans_dropped > since:
+            print(f"The network changed while planning, {self.graph.plans_dropped - since} plans dropped")
+
+    def _program_moved(self, intents, new_ids=()):
+        # program_intents after a re-plan or a repair. A new intent (id in
+        # new_ids) whose rules do not get in is dropped. A moved one keeps the
+        # rules of its previous path and stays PROGRAM_FAILED, holding its
+        # new path in the graph, until it is programmed again. Returns the ids
+        # of those.
+        failed = self.program_intents(intents)
+        moved = []
+        for intent_id in failed:
+            if intent_id in new_ids:
+                self.graph.remove_flow(self.intents[intent_id])
+                self._forget([intent_id])
+            else:
+                moved.append(intent_id)
+        if moved:
+            print(f"{len(moved)} moved intents still forward over their previous path: {moved}")
+        return moved
 
     def clear_all_flows(self, soft_clear=False):
+        # Shared rules appear under several intents, each goes once
+        rules = {}
         for intent in self.intents.values():
-            if intent.flowRules is not None:
-                for rule in intent.flowRules:
-                    rule.delete()
+            for rule in intent.flowRules or ():
+                rules[self._rule_key(rule)] = rule
         if not soft_clear:
-            del self.intents
-            self.intents = {}
+            self._forget(list(self.intents))
+            self.rule_table.clear()
+            self.rule_refs.clear()
+        get_client().delete_flows(list(rules.values()))
+
+    def register_metrics(self):
+        # Points the controller's gauges at this manager
+        metrics.INTENTS.set_function(lambda: len(self.intents))
+        metrics.LINK_UTILIZATION.set_function(self._link_utilization)
+
+    def _link_utilization(self, k=10):
+        if self.graph is None:
+            return {}
+        return {(f"{u}-{v}",): round(util, 6) for u, v, util in self.graph.hottest_links(k)}
+
+    def intent_summaries(self):
+        return [{"id": intent.id,
+                 "src": getattr(intent.src_host, "id", intent.src_host),
+                 "dst": getattr(intent.dst_host, "id", intent.dst_host),
+                 "bw": intent.required_bw,
+                 "path": intent.path,
+                 "state": self.programming.get(intent.id, PROGRAM_PENDING)}
+                for intent in self.intents.values()]
 
     def list_intents(self):
         for intent in self.intents.values():
-            print(f"- {intent}")
+            print(f"- {intent} [{self.programming.get(intent.id, PROGRAM_PENDING)}]")
+        if self.aggregation_stats is not None:
+            print(f"{self.aggregation_stats['rules']} shared flow rules instead of "
+                  f"{self.aggregation_stats['per_intent']}")
     
     def remove_intent(self, intent_id):
         if intent_id not in self.intents:
             print(f"Intent {intent_id} not found")
             return
-        self.graph.remove_flow(self.intents[intent_id])
-        for flow in self.intents[intent_id].flowRules:
-            flow.delete()
-        del self.intents[intent_id]
+        intent = self.intents[intent_id]
+        tracing.annotate(intent=intent_id)
+        self.graph.remove_flow(intent)
+        self._forget([intent_id])
+        self._delete_flowrules(intent)
 
-    def gen_flowrules_from_path(self, intentUUID):
+    def build_flowrules(self, intentUUID, claimed=None):
         # path is a list of switch ids [<switch for intent.src_host>, <switch for intent.dst_host>]
+        # With claimed ({(device, dst mac): out port} of the destination-keyed
+        # rules in use) the rules are destination-keyed, except on a device
+        # where the destination is already forwarded through another port;
+        # claimed is updated with the new ones.
         intent = self.intents[intentUUID]
         path = intent.path
-        if path is None or len(path) == 0: return
+        if path is None or len(path) == 0: return []
         print(path)
         flowRules = []
         src_mac = intent.src_host.mac
@@ -252,114 +648,467 @@ class StateManager():
                 prevBiLink = self.graph[path[i]][path[i+1]]["bilink"]
                 out_port = prevBiLink.get_port_of_switch(path[i])
 
-            rule = Flow(path[i], src_mac, dst_mac, in_port, out_port)
-            flowRules.append(rule)
-            rule = Flow(path[i], dst_mac, src_mac, out_port, in_port)    
-            flowRules.append(rule)
-        
-        for rule in flowRules:
-            rule.apply()
-        
-        self.intents[intentUUID].flowRules = flowRules.copy()
+            if claimed is None:
+                rule = Flow(path[i], src_mac, dst_mac, in_port, out_port)
+                flowRules.append(rule)
+                rule = Flow(path[i], dst_mac, src_mac, out_port, in_port)    
+                flowRules.append(rule)
+                continue
+            for src, dst, port_in, port_out in ((src_mac, dst_mac, in_port, out_port),
+                                                (dst_mac, src_mac, out_port, in_port)):
+                port = claimed.setdefault((path[i], dst), str(port_out))
+                if port == str(port_out):
+                    flowRules.append(Flow(path[i], None, dst, None, port_out))
+                else:
+                    flowRules.append(Flow(path[i], src, dst, port_in, port_out))
+        return flowRules
+
+    @staticmethod
+    def _rule_key(rule):
+        in_port = None if rule.in_port is None else str(rule.in_port)
+        return (rule.deviceId, rule.src_mac, rule.dst_mac, in_port, str(rule.out_port))
+
+    def program_intents(self, intents):
+        # Brings the rules of every intent in line with its current path, make
+        # before break: the rules the path already has installed are kept, the
+        # missing ones go in first (all intents at once, fanned out per device)
+        # and only then are the stale ones deleted. An intent whose new rules
+        # do not all get in is rolled back, keeping its old rules.
+        # Returns the ids of those intents.
+        tracing.annotate(intents=len(intents))
+        if self.AGGREGATE_RULES:
+            return self._program_aggregated(intents)
+        groups = {}     # {intentId: rules to install}
+        overwrites = {} # {intentId: rules to install over an installed one with the same selector}
+        kept = {}       # {intentId: installed rules still wanted}
+        stale = {}      # {intentId: installed rules no longer wanted}
+        total = 0       # rule operations a delete-all and reinstall would take
+        for intent in intents:
+            rules = self.build_flowrules(intent.id)
+            old = {self._rule_key(rule): rule for rule in intent.flowRules or () if rule.id is not None}
+            total += len(old) + len(rules)
+            groups[intent.id] = []
+            kept[intent.id] = []
+            for rule in rules:
+                installed = old.pop(self._rule_key(rule), None)
+                if installed is None:
+                    groups[intent.id].append(rule)
+                else:
+                    kept[intent.id].append(installed)
+            stale[intent.id] = list(old.values())
+            selectors = {self._rule_key(rule)[:4] for rule in stale[intent.id]}
+            overwrites[intent.id] = [rule for rule in groups[intent.id] if self._rule_key(rule)[:4] in selectors]
+            groups[intent.id] = [rule for rule in groups[intent.id] if self._rule_key(rule)[:4] not in selectors]
+            self.programming[intent.id] = PROGRAM_PENDING
+
+        failed = []
+        to_delete = []
+        errors = get_client().install_groups(groups)
+        # ONOS overwrites a rule installed again with the same selector under
+        # its flowId, so those only go in once the rest of the new path is
+        # there, and a rollback taking the old rule along has to put it back
+        second = {intent_id: overwrites[intent_id] for intent_id, e in errors.items()
+                  if e is None and overwrites[intent_id]}
+        for intent_id, e in get_client().install_groups(second).items():
+            if e is not None:
+                errors[intent_id] = e
+                to_delete.extend(groups[intent_id])
+                self._restore_rules(self.intents[intent_id], overwrites[intent_id])
+        for intent_id, e in errors.items():
+            if e is None:
+                self.intents[intent_id].flowRules = kept[intent_id] + groups[intent_id] + overwrites[intent_id]
+                self.programming[intent_id] = PROGRAM_INSTALLED
+                # the old ones are already gone
+                replaced = {self._rule_key(rule)[:4] for rule in overwrites[intent_id]}
+                to_delete.extend(rule for rule in stale[intent_id] if self._rule_key(rule)[:4] not in replaced)
+            else:
+                print(f"Programming intent {intent_id} failed, rolled back: {e}")
+                self.programming[intent_id] = PROGRAM_FAILED
+                failed.append(intent_id)
+        self._journal_put([self.intents[intent_id] for intent_id in groups if intent_id in self.intents])
+        try:
+            get_client().delete_flows(to_delete)
+        except OnosError as e:
+            print(f"Failed to delete stale flow rules: {e}")
+
+        installed = sum(len(rules) for rules in groups.values()) + sum(len(rules) for rules in second.values())
+        self.reconcile_stats = {
+            "installed": installed,
+            "deleted": len(to_delete),
+            "saved": total - installed - len(to_delete),
+        }
+        metrics.RULES.inc(installed, op="install")
+        metrics.RULES.inc(len(to_delete), op="delete")
+        metrics.RULES_SAVED.inc(self.reconcile_stats["saved"])
+        if self.reconcile_stats["saved"]:
+            print(f"Reconciled {len(groups)} intents: {installed} rules installed, {len(to_delete)} "
+                  f"deleted, {self.reconcile_stats['saved']} rule operations saved")
+        return failed
+
+    def _restore_rules(self, intent, overwrites):
+        # Installs again the rules of intent that overwrites had replaced,
+        # after their rollback deleted them from ONOS
+        selectors = {self._rule_key(rule)[:4] for rule in overwrites}
+        rules = []
+        restored = []
+        for rule in intent.flowRules or ():
+            if rule.id is not None and self._rule_key(rule)[:4] in selectors:
+                rule = Flow(rule.deviceId, rule.src_mac, rule.dst_mac, rule.in_port, rule.out_port)
+                restored.append(rule)
+            rules.append(rule)
+        e = get_client().install_groups({intent.id: restored})[intent.id]
+        if e is not None:
+            print(f"Restoring the flow rules of intent {intent.id} failed, its path is broken: {e}")
+        intent.flowRules = rules
+
+    def _program_aggregated(self, intents):
+        # program_intents with shared rules: a rule is installed by the first
+        # intent needing it and deleted once its last user is gone. An intent
+        # fails with the one whose group was to install a rule it needs.
+        # Every destination-keyed rule in place is claimed, also those of
+        # intents in the batch: ONOS would overwrite one by a rule with the
+        # same selector, which a failed install could not give back.
+        claimed = {(key[0], key[2]): key[4] for key in self.rule_refs if key[1] is None}
+        wanted = {}     # {intentId: rules}
+        groups = {}     # {intentId: rules to install}
+        owner = {}      # {rule key: intentId installing it}
+        total = 0
+        for intent in intents:
+            wanted[intent.id] = self.build_flowrules(intent.id, claimed)
+            groups[intent.id] = []
+            total += len(intent.flowRules or ()) + len(wanted[intent.id])
+            for rule in wanted[intent.id]:
+                key = self._rule_key(rule)
+                if key not in self.rule_table and key not in owner:
+                    owner[key] = intent.id
+                    groups[intent.id].append(rule)
+            self.programming[intent.id] = PROGRAM_PENDING
+
+        errors = get_client().install_groups(groups)
+        failed = {intent_id for intent_id, e in errors.items() if e is not None}
+        for intent_id in failed:
+            print(f"Programming intent {intent_id} failed, rolled back: {errors[intent_id]}")
+        for intent_id, rules in wanted.items():
+            if intent_id not in failed and any(owner.get(self._rule_key(rule)) in failed for rule in rules):
+                print(f"Programming intent {intent_id} failed, a rule it shares did not get in")
+                failed.add(intent_id)
+
+        installed = {self._rule_key(rule): rule for intent_id, rules in groups.items()
+                     if errors[intent_id] is None for rule in rules}
+        unused = []
+        for intent in intents:
+            if intent.id in failed:
+                self.programming[intent.id] = PROGRAM_FAILED
+                continue
+            old = intent.flowRules or ()
+            intent.flowRules = self._hold_rules(intent.id, [installed.get(self._rule_key(rule), rule)
+                                                            for rule in wanted[intent.id]])
+            keep = {self._rule_key(rule) for rule in intent.flowRules}
+            unused.extend(self._release_rules(intent.id, [rule for rule in old if self._rule_key(rule) not in keep]))
+            self.programming[intent.id] = PROGRAM_INSTALLED
+        # Installed for intents that failed after all
+        unused.extend(rule for key, rule in installed.items() if key not in self.rule_refs)
+        self._journal_put([self.intents[intent_id] for intent_id in wanted if intent_id in self.intents])
+        # ONOS overwrites a rule installed again with the same selector
+        replaced = {key[:4] for key in installed}
+        to_delete = [rule for rule in unused if self._rule_key(rule)[:4] not in replaced
+                     or self._rule_key(rule) in installed]
+        try:
+            get_client().delete_flows(to_delete)
+        except OnosError as e:
+            print(f"Failed to delete stale flow rules: {e}")
+
+        self.reconcile_stats = {
+            "installed": len(installed),
+            "deleted": len(to_delete),
+            "saved": total - len(installed) - len(to_delete),
+        }
+        per_intent = sum(2 * len(intent.path) for intent in self.intents.values()
+                         if intent.flowRules and intent.path)
+        self.aggregation_stats = {
+            "rules": len(self.rule_table),
+            "per_intent": per_intent,
+            "saved": per_intent - len(self.rule_table),
+        }
+        metrics.RULES.inc(len(installed), op="install")
+        metrics.RULES.inc(len(to_delete), op="delete")
+        metrics.RULES_SAVED.inc(self.reconcile_stats["saved"])
+        print(f"Programmed {len(wanted)} intents: {len(installed)} rules installed, {len(to_delete)} deleted; "
+              f"{len(self.rule_table)} shared rules in place of {per_intent}")
+        return [intent_id for intent_id in wanted if intent_id in failed]
+
+    def gen_flowrules_from_path(self, intentUUID):
+        return self.program_intents([self.intents[intentUUID]])
+
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+
+class Job:
+    # Handle on a submitted command, see StateThread.submit
+    def __init__(self, command):
+        self.id = uuid.uuid4().hex
+        self.command = command
+        self.status = JOB_QUEUED
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.finished = None
+        self._done = threading.Event()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def finish(self, status, result=None, error=None):
+        self.status = status
+        self.result = result
+        self.error = error
+        self.finished = time.time()
+        self._done.set()
+
+    def json(self):
+        return {
+            "id": self.id,
+            "command": self.command,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "submitted": self.submitted,
+            "finished": self.finished,
+        }
 
 
 class StateThread(threading.Thread):
     POLLING_INTERVAL = 5
+    # With an event source, the full ONOS poll only runs as a consistency
+    # sweep this often (seconds)
+    SWEEP_INTERVAL = 60
+    # Finished jobs kept around for lookups
+    MAX_JOBS = 1000
 
-    def __init__(self, stateManager):
+    def __init__(self, stateManager, event_source=None):
         self._stopevent = threading.Event()
         self.stateManager:StateManager = stateManager
-        self._pendinginput = set()
+        self.event_source = event_source
+        # Commands (Job) and topology events (dict) in arrival order; the
+        # worker wakes up as soon as anything is put here
+        self.inbox = queue.Queue()
+        self.jobs = OrderedDict()   # {jobId: Job}
+        self._jobs_lock = threading.Lock()
         threading.Thread.__init__(self)
 
+    def submit(self, command):
+        job = Job(command)
+        with self._jobs_lock:
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.MAX_JOBS:
+                oldest = next(iter(self.jobs.values()))
+                if oldest.status not in (JOB_DONE, JOB_FAILED):
+                    break
+                self.jobs.popitem(last=False)
+        self.inbox.put(job)
+        return job
+
+    def get_job(self, job_id):
+        with self._jobs_lock:
+            return self.jobs.get(job_id)
+
+    def add_input(self, userinput):
+        return self.submit(userinput)
+
+    def _apply_events(self, events):
+        try:
+            self.stateManager.apply_topology_events(events)
+        except Exception as e:
+            print(f"Failed to apply {len(events)} topology events: " + str(e))
+            traceback.print_exc()
+
+    def _parse_intent(self, h1, h2, bw):
+        if not h1.endswith('/None'):    # treat h1 as a number
+            h1 = convert_num_to_hostid(h1)
+        if not h2.endswith('/None'):    # treat h2 as a number
+            h2 = convert_num_to_hostid(h2)
+        bw = int(bw)    # treat bw as a number
+        hosts = self.stateManager.hosts
+        assert (h1 in hosts), f"HostId {h1} is invalid"
+        assert (h2 in hosts), f"HostId {h2} is invalid"
+        return Intent(hosts[h1], hosts[h2], bw)
+
+    def execute(self, userinput):
+        # Runs one command and returns its result, which must be JSON-able
+        print(f"\nProcessing Input '{userinput}'...\n")
+        args = userinput.split()
+        command = args[0]
+        if len(args) > 1:
+            args = args[1:]
+        if command == 'add':
+            newIntent = self._parse_intent(*args)
+            self.stateManager.add_intent(newIntent)
+            admitted = newIntent.id in self.stateManager.intents
+            return {"intent": newIntent.id, "admitted": admitted,
+                    "path": newIntent.path if admitted else None}
+        elif command == 'add-batch':
+            # add-batch h1 h2 bw [h1 h2 bw ...]
+            assert len(args) % 3 == 0, "Expected src dst bw triples"
+            newIntents = [self._parse_intent(*args[i:i + 3]) for i in range(0, len(args), 3)]
+            return self.stateManager.add_intents(newIntents)
+        elif command in ["list", "ls"]:
+            self.stateManager.list_intents()
+            return self.stateManager.intent_summaries()
+        elif command in ["rm", "delete", "remove"]:
+            intent_id = args[0]
+            if intent_id == "all":
+                self.stateManager.clear_all_flows()
+            else:
+                if intent_id not in self.stateManager.intents:
+                    raise KeyError(f"Intent {intent_id} not found")
+                self.stateManager.remove_intent(intent_id)
+            return {"removed": intent_id}
+        raise ValueError(f"Command {command} not supported")
+
+    def _run_job(self, job):
+        job.status = JOB_RUNNING
+        try:
+            name = job.command.split()[0] if job.command.split() else ""
+            with metrics.COMMAND_SECONDS.time(command=name), tracing.profiled(job.command), \
+                    tracing.span(f"command {name}", job=job.id):
+                result = self.execute(job.command)
+            job.finish(JOB_DONE, result)
+        except Exception as e:
+            print(f"Failed to process input '{job.command}': " + str(e))
+            traceback.print_exc()
+            job.finish(JOB_FAILED, error=str(e))
+
     def run(self):
         # print("State thread id: ", threading.get_ident())
+        if self.event_source is not None:
+            self.event_source.start(self.inbox.put)
+        sweep_interval = self.POLLING_INTERVAL if self.event_source is None else self.SWEEP_INTERVAL
+        next_sweep = 0
 
-        while not self._stopevent.isSet():
+        while not self._stopevent.is_set():
             # update topology in stateManager
-            self.stateManager.update_topo_from_ONOS()
-
-            while self._pendinginput:
-                # Fastest way to get the first element of a set without popping
-                for userinput in self._pendinginput: break
-                print(f"\nProcessing Input '{userinput}'...\n")
-                args = userinput.split()
-                command = args[0]
-                if len(args) > 1:
-                    args = args[1:]
+            if time.perf_counter() >= next_sweep:
                 try:
-                    if command == 'add':
-                        h1, h2, bw = args
-                        if not h1.endswith('/None'):    # treat h1 as a number
-                            h1 = convert_num_to_hostid(h1)
-                        if not h2.endswith('/None'):    # treat h2 as a number
-                            h2 = convert_num_to_hostid(h2)
-                        bw = int(bw)    # treat bw as a number
-                        hosts = self.stateManager.hosts
-                        assert (h1 in hosts), f"HostId {h1} is invalid"
-                        assert (h2 in hosts), f"HostId {h2} is invalid"
-                    
-                        newIntent = Intent(hosts[h1], hosts[h2], bw)
-                        self.stateManager.add_intent(newIntent)
-
-                    elif command in ["list", "ls"]:
-                        self.stateManager.list_intents()
-                    elif command in ["rm", "delete", "remove"]:
-                        intent_id = args[0]
-                        if intent_id == "all":
-                            self.stateManager.clear_all_flows()
-                        else:
-                            self.stateManager.remove_intent(intent_id)
-                    else:
-                        print(f"Command {command} not supported")
-
+                    self.stateManager.update_topo_from_ONOS()
                 except Exception as e:
-                    print(f"Failed to process input '{userinput}': " + str(e))
+                    print("Failed to update the topology: " + str(e))
                     traceback.print_exc()
-                self._pendinginput.pop()
-            time.sleep(self.POLLING_INTERVAL)
+                next_sweep = time.perf_counter() + sweep_interval
+
+            try:
+                item = self.inbox.get(timeout=max(next_sweep - time.perf_counter(), 0))
+            except queue.Empty:
+                continue
+            # Everything queued meanwhile is handled in order, runs of
+            # topology events as one batch
+            items = [item]
+            while True:
+                try:
+                    items.append(self.inbox.get_nowait())
+                except queue.Empty:
+                    break
+            events = []
+            for item in items:
+                if isinstance(item, Job):
+                    if events:
+                        self._apply_events(events)
+                        events = []
+                    self._run_job(item)
+                elif item is not None:
+                    events.append(item)
+            if events:
+                self._apply_events(events)
 
     def stop(self):
         self._stopevent.set()
-        self.stateManager.clear_all_flows()
-    def add_input(self, userinput):
-        self._pendinginput.add(userinput)  
+        if self.event_source is not None:
+            self.event_source.stop()
+        self.inbox.put(None)    # wakes the worker up
+        # The worker may still be running a command, the state is only
+        # touched once it is done
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+        if self.stateManager.journal is None:
+            self.stateManager.clear_all_flows()
+        else:
+            # The flows stay in ONOS and are adopted again on the next start
+            self.stateManager.journal.compact()
+            self.stateManager.journal.close()
+        portfolio.shutdown()
+        reset_client()
 
 
+# Methods wrapped in a span when TRACING is on
+TRACED = [
+    (Graph, ["allocate_single", "allocate_single_astar", "topk_greedy_allocate", "anytime_allocate",
+             "astar_greedy_alloc", "find_best_solution", "repair_intents", "get_shortest_path", "astar",
+             "widest_path", "_plan_virtual", "_commit_plan"]),
+    (StateManager, ["add_intent", "add_intents", "recalculate", "repair_intents", "remove_intent",
+                    "program_intents", "update_topo_from_ONOS", "apply_topology_events"]),
+]
+
 # just for testing purpose
 def getResponse():
-    url = '{}/links'.format(BASE_URL)
-    response = requests.get(url, auth=AUTH)
+    response = get_client().request('GET', 'links')
     print(response.text)
 
 def main():
+    metrics_server = None
+    if METRICS_ENDPOINT is not None:
+        metrics.enable()
+        metrics_server = metrics.MetricsServer(*METRICS_ENDPOINT)
+        metrics_server.start()
+    if TRACING:
+        tracing.enable(TRACED)
     config_links_ONOS()
     stateManager = StateManager()
+    if metrics_server is not None:
+        stateManager.register_metrics()
+    if JOURNAL_DIR is not None:
+        stateManager.journal = IntentJournal(JOURNAL_DIR)
     stateManager.retrieve_topo_from_ONOS()
+    stateManager.restore_intents()
 
     # print("Parent process id = ", os.getpid())
     # print("Parent thread id: ", threading.get_ident())
-    stateThread = StateThread(stateManager)
+    event_source = None
+    if EVENT_WEBHOOK is not None:
+        event_source = topoEvents.WebhookEventSource(*EVENT_WEBHOOK)
+    stateThread = StateThread(stateManager, event_source)
+    api = None
+    if INTENT_API is not None:
+        api = intentApi.IntentApi(stateThread, *INTENT_API)
 
     try:
         stateThread.start()
+        if api is not None:
+            api.start()
 
         userinput = ''
         while True:
             # Ask for user input
-            if stateThread._pendinginput:
-                continue
             userinput = input("Enter command or 'exit': ")
-            if userinput != 'exit':
-                stateThread.add_input(userinput)
-            else:
+            if userinput == 'exit':
                 break
+            if userinput.strip():
+                # Prompt again once the command has run
+                stateThread.add_input(userinput).wait()
         
         # cleanup before exit
+        if api is not None:
+            api.stop()
         stateThread.stop()
         
     except (KeyboardInterrupt, SystemExit):
+        if api is not None:
+            api.stop()
         stateThread.stop()
+    if metrics_server is not None:
+        metrics_server.stop()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,234 @@
+import functools
+import threading
+import time
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Off by default: every update is then a single flag check and timers hand
+# out a shared null context
+enabled = False
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_registry = []
+_lock = threading.Lock()
+_null = nullcontext()
+
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Metric:
+    TYPE = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=_registry):
+        # registry: the list render() exposes the metric from, None to keep
+        # it out of every registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        if registry is not None:
+            with _lock:
+                registry.append(self)
+
+    def reset(self):
+        with _lock:
+            self._values.clear()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def samples(self):
+        # [(suffix, label values, extra labels, value)]
+        with _lock:
+            return [("", key, (), value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.TYPE}"]
+        for suffix, key, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, key, extra)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def inc(self, amount=1, **labels):
+        if not enabled:
+            return
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    TYPE = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), registry=_registry):
+        super().__init__(name, documentation, labelnames, registry)
+        self._function = None
+
+    def set(self, value, **labels):
+        if not enabled:
+            return
+        with _lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, function):
+        # Evaluated on every scrape: returns a number, or {label values: number}
+        self._function = function
+
+    def samples(self):
+        if self._function is None:
+            return super().samples()
+        value = self._function()
+        if not isinstance(value, dict):
+            value = {(): value}
+        return [("", key, (), number) for key, number in value.items()]
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=_registry):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        if not enabled:
+            return
+        key = self._key(labels)
+        with _lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1     # +Inf, i.e. the count
+            counts[-1] += value
+
+    def time(self, **labels):
+        # with histogram.time(): ...
+        if not enabled:
+            return _null
+        return _Timer(self, labels)
+
+    def samples(self):
+        samples = []
+        with _lock:
+            for key, counts in self._values.items():
+                for bound, count in zip(self.buckets, counts):
+                    samples.append(("_bucket", key, (("le", bound),), count))
+                samples.append(("_bucket", key, (("le", "+Inf"),), counts[-2]))
+                samples.append(("_count", key, (), counts[-2]))
+                samples.append(("_sum", key, (), counts[-1]))
+        return samples
+
+
+def timed(histogram, **labels):
+    # Decorator observing the duration of every call
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, **labels)
+        return wrapper
+    return decorator
+
+
+def render(registry=None):
+    # Prometheus text exposition format of registry, the controller's
+    # metrics by default
+    with _lock:
+        metrics = list(_registry if registry is None else registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    # Serves render() on http://host:port/metrics
+    def __init__(self, host="127.0.0.1", port=9105):
+        self.host = host
+        self.port = port
+        self._server = None
+
+    def start(self):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0].rstrip("/") != "/metrics":
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                data = render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.port = self._server.server_port
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+# The controller's metrics
+TOPOLOGY_SYNC_SECONDS = Histogram("bwo_topology_sync_seconds", "Duration of a topology poll of ONOS")
+TOPOLOGY_SYNC_SKIPPED = Counter("bwo_topology_sync_skipped_total", "ONOS responses unchanged since the last poll",
+                                ["resource"])
+TOPOLOGY_EVENTS = Counter("bwo_topology_events_total", "Topology events applied", ["type"])
+ALLOCATION_SECONDS = Histogram("bwo_allocation_seconds", "Duration of the allocator entry points", ["method"])
+COMMAND_SECONDS = Histogram("bwo_command_seconds", "Duration of a command from the prompt or the API",
+                            ["command"])
+ONOS_REQUEST_SECONDS = Histogram("bwo_onos_request_seconds", "ONOS REST round trips", ["method"])
+ONOS_ERRORS = Counter("bwo_onos_errors_total", "Failed ONOS REST calls", ["method"])
+RULES = Counter("bwo_flow_rules_total", "Flow rules installed or deleted", ["op"])
+RULES_SAVED = Counter("bwo_flow_rule_ops_saved_total", "Flow rule operations saved by reconciliation")
+INTENTS_ADMITTED = Counter("bwo_intents_admitted_total", "Intents admitted")
+INTENTS_REJECTED = Counter("bwo_intents_rejected_total", "Intents rejected")
+RECALCULATIONS = Counter("bwo_recalculations_total", "Global re-plans", ["outcome"])
+PLANS_DROPPED = Counter("bwo_plans_dropped_total", "Plans dropped because the network changed while planning")
+REPAIRS = Counter("bwo_repairs_total", "Repairs after link failures", ["escalated"])
+INTENTS = Gauge("bwo_intents", "Intents currently installed")
+LINK_UTILIZATION = Gauge("bwo_link_utilization", "Utilization of the most utilized links", ["link"])
@@ -0,0 +1,156 @@
+import json
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+
+
+class OnosError(Exception):
+    pass
+
+
+class OnosClient:
+    # One keep-alive session for every ONOS REST call, with bounded retries
+    # (exponential backoff) and timeouts. Flow rules go in batches through
+    # POST /flows and DELETE /flows instead of one request per rule, one
+    # batch per device, with up to CONCURRENCY batches in flight.
+    POOL_SIZE = 16
+    CONCURRENCY = 8             # device batches programmed at once
+    RETRIES = 3
+    BACKOFF = 0.2               # seconds, doubled on every retry
+    TIMEOUT = (3.05, 10)        # (connect, read) seconds
+    BATCH_SIZE = 500            # flow rules per request
+    RETRY_STATUSES = (500, 502, 503, 504)
+
+    def __init__(self, base_url, auth, pool_size=None, retries=None, timeout=None, concurrency=None):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = self.TIMEOUT if timeout is None else timeout
+        pool_size = self.POOL_SIZE if pool_size is None else pool_size
+        self.concurrency = self.CONCURRENCY if concurrency is None else concurrency
+        self._executor = None
+        # Installing or deleting the same rule twice leaves ONOS in the same
+        # state, so POST and DELETE are retried like GET
+        retry = Retry(total=self.RETRIES if retries is None else retries,
+                      backoff_factor=self.BACKOFF,
+                      status_forcelist=self.RETRY_STATUSES,
+                      allowed_methods=None,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.auth = auth
+        self.session.headers.update({"Content-Type": "application/json", "Accept": "application/json"})
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        self.session.close()
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        return self._executor
+
+    @staticmethod
+    def _by_device(flows):
+        devices = {}
+        for flow in flows:
+            devices.setdefault(flow.deviceId, []).append(flow)
+        return list(devices.values())
+
+    def request(self, method, path, payload=None):
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        data = None if payload is None else json.dumps(payload, separators=(",", ":"))
+        try:
+            with metrics.ONOS_REQUEST_SECONDS.time(method=method):
+                res = self.session.request(method, url, data=data, timeout=self.timeout)
+        except requests.RequestException as e:
+            metrics.ONOS_ERRORS.inc(method=method)
+            raise OnosError(f"{method} {url} failed: {e}") from e
+        if res.status_code >= 400:
+            metrics.ONOS_ERRORS.inc(method=method)
+            raise OnosError(f"{method} {url} returned {res.status_code}: {res.text}")
+        return res
+
+    def get(self, path):
+        res = self.request("GET", path)
+        return res.json() if res.content else {}
+
+    def post(self, path, payload):
+        return self.request("POST", path, payload)
+
+    def delete(self, path, payload=None):
+        return self.request("DELETE", path, payload)
+
+    def _install_batch(self, flows):
+        # Sets the ONOS id of every Flow; ONOS answers with the ids in the
+        # order the rules were sent
+        for i in range(0, len(flows), self.BATCH_SIZE):
+            batch = flows[i:i + self.BATCH_SIZE]
+            res = self.post("flows", {"flows": [flow.to_dict() for flow in batch]})
+            installed = res.json().get("flows", []) if res.content else []
+            if len(installed) != len(batch):
+                raise OnosError(f"ONOS installed {len(installed)} of {len(batch)} flow rules")
+            for flow, entry in zip(batch, installed):
+                flow.id = str(entry["flowId"])
+        return flows
+
+    def _delete_batch(self, flows):
+        for i in range(0, len(flows), self.BATCH_SIZE):
+            batch = flows[i:i + self.BATCH_SIZE]
+            self.delete("flows", {"flows": [{"deviceId": flow.deviceId, "flowId": flow.id}
+                                            for flow in batch]})
+            for flow in batch:
+                flow.id = None
+        return flows
+
+    def _fan_out(self, batch, groups):
+        # Runs batch on every (group, device) share of the flows concurrently.
+        # Returns {key: None, or the first exception one of its batches raised}
+        futures = {}
+        for key, flows in groups.items():
+            for device_flows in self._by_device(flows):
+                futures[self.executor.submit(batch, device_flows)] = key
+        errors = dict.fromkeys(groups)
+        done, _ = wait(futures)
+        for future in done:
+            key = futures[future]
+            if future.exception() is not None and errors[key] is None:
+                errors[key] = future.exception()
+        return errors
+
+    def install_groups(self, groups):
+        # groups is {key: flows}, typically one key per intent. A group is all
+        # or nothing: if one of its batches fails, the rules of the group that
+        # did get installed are deleted again.
+        errors = self._fan_out(self._install_batch, groups)
+        failed = {key: [flow for flow in groups[key] if flow.id is not None]
+                  for key, e in errors.items() if e is not None}
+        if failed:
+            # A failed rollback leaves rules in ONOS that nobody owns, so it is
+            # reported along with the install error
+            rollback = self._fan_out(self._delete_batch, failed)
+            for key, e in rollback.items():
+                if e is not None:
+                    print(f"Rolling back the flow rules of {key} failed, they are left in ONOS: {e}")
+                    errors[key] = OnosError(f"{errors[key]} (rollback failed: {e})")
+        return errors
+
+    def install_flows(self, flows):
+        e = self.install_groups({None: list(flows)})[None]
+        if e is not None:
+            raise e
+        return flows
+
+    def delete_flows(self, flows):
+        flows = [flow for flow in flows if flow.id is not None]
+        e = self._fan_out(self._delete_batch, {None: flows})[None]
+        if e is not None:
+            raise e
+        return flows
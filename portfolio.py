@@ -0,0 +1,155 @@
+import multiprocessing
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from Graph import Graph
+from utilClasses import BiLink, Intent
+
+ORDER_BANDWIDTH = "bandwidth"         # largest required_bw first, like topk_greedy_allocate
+ORDER_HOPS = "hops"                   # longest hop distance first
+ORDER_ALTERNATIVES = "alternatives"   # fewest alternative shortest paths first
+ORDER_SHUFFLE = "shuffle"             # seeded random order
+
+POLICY_FIRST = "first"        # first feasible plan wins
+POLICY_HEADROOM = "headroom"  # feasible plan leaving the most residual headroom wins
+
+DEFAULT_ORDERINGS = [
+    (ORDER_BANDWIDTH, None),
+    (ORDER_HOPS, None),
+    (ORDER_ALTERNATIVES, None),
+    (ORDER_SHUFFLE, 1),
+    (ORDER_SHUFFLE, 2),
+    (ORDER_SHUFFLE, 3),
+]
+
+# Workers are not forked from the controller, which runs the state, API,
+# webhook and metrics threads by then
+START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+_executor = None
+_executor_workers = None
+
+
+def get_executor(workers=None):
+    # One pool for the life of the controller, forking a pool per re-plan
+    # would cost more than the re-plan itself
+    global _executor, _executor_workers
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if _executor is None or _executor_workers != workers:
+        shutdown()
+        _executor = ProcessPoolExecutor(max_workers=workers,
+                                        mp_context=multiprocessing.get_context(START_METHOD))
+        _executor_workers = workers
+    return _executor
+
+
+def shutdown():
+    global _executor, _executor_workers
+    if _executor is not None:
+        _executor.shutdown(cancel_futures=True)
+    _executor = None
+    _executor_workers = None
+
+
+def snapshot(graph, intents):
+    # Picklable view of the topology (max capacities) and the intents
+    edges = [(u, v, int(graph.core.max_capacity[data["eid"]])) for u, v, data in graph.edges(data=True)]
+    lite_intents = []
+    for intent in intents:
+        source, destination = graph._endpoints(intent)
+        lite_intents.append((intent.id, source, destination, intent.required_bw))
+    return edges, lite_intents
+
+
+def order_intents(graph, intents, ordering, seed=None):
+    if ordering == ORDER_BANDWIDTH:
+        return sorted(intents, key=lambda x: x.required_bw, reverse=True)
+    if ordering == ORDER_HOPS:
+        def hops(intent):
+            source, destination = graph._endpoints(intent)
+            return graph.hop_distances(destination).get(source, 0)
+        return sorted(intents, key=lambda x: (hops(x), x.required_bw), reverse=True)
+    if ordering == ORDER_ALTERNATIVES:
+        limit = graph.path_cache.max_paths
+        def alternatives(intent):
+            source, destination = graph._endpoints(intent)
+            return graph.count_shortest_paths(source, destination, limit)
+        return sorted(intents, key=lambda x: (alternatives(x), -x.required_bw))
+    if ordering == ORDER_SHUFFLE:
+        intents = list(intents)
+        random.Random(seed).shuffle(intents)
+        return intents
+    raise ValueError(f"Unknown ordering {ordering}")
+
+
+def plan_ordering(edges, lite_intents, ordering, seed=None):
+    # Runs in a worker process. Returns (ordering, seed, plan, headroom),
+    # plan being {intent id: path} or None
+    graph = Graph()
+    for u, v, capacity in edges:
+        graph.add_edge(u, v, bilink=BiLink(u, v, capacity))
+    intents = []
+    for intent_id, source, destination, bw in lite_intents:
+        intent = Intent(source, destination, bw)
+        intent.id = intent_id
+        intents.append(intent)
+    plan = graph._plan_virtual(order_intents(graph, intents, ordering, seed), ordered=True)
+    if plan is None:
+        return ordering, seed, None, None
+    return ordering, seed, plan, graph.core.headroom(graph.core.virtual_capacity)
+
+
+def portfolio_plan(graph, intents, orderings=None, workers=None, policy=POLICY_FIRST):
+    # Plans every ordering in parallel and returns the winning {intent id: path},
+    # or None if no ordering fits every intent. An ordering whose worker fails
+    # is skipped; None then also lets the caller fall back to the sequential
+    # allocator.
+    if orderings is None:
+        orderings = DEFAULT_ORDERINGS
+    edges, lite_intents = snapshot(graph, intents)
+    try:
+        executor = get_executor(workers)
+        pending = {executor.submit(plan_ordering, edges, lite_intents, ordering, seed)
+                   for ordering, seed in orderings}
+    except BrokenProcessPool as e:
+        print(f"Portfolio workers unavailable: {e}")
+        shutdown()
+        return None
+    best_plan = None
+    best_headroom = None
+    try:
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    _, _, plan, room = future.result()
+                except BrokenProcessPool as e:
+                    print(f"Portfolio workers died: {e}")
+                    shutdown()
+                    return best_plan
+                except Exception as e:
+                    print(f"Planning an ordering failed, skipping it: {e!r}")
+                    continue
+                if plan is None:
+                    continue
+                if policy == POLICY_FIRST:
+                    return plan
+                if best_headroom is None or room > best_headroom:
+                    best_plan, best_headroom = plan, room
+    finally:
+        for future in pending:
+            future.cancel()
+    return best_plan
+
+
+def portfolio_allocate(graph, intents, orderings=None, workers=None, policy=POLICY_FIRST):
+    # Same contract as Graph.topk_greedy_allocate: the committed flows or None
+    intents = list(intents)
+    generation = graph.generation
+    plan = portfolio_plan(graph, intents, orderings, workers, policy)
+    if plan is None:
+        return None
+    return graph._commit_plan(intents, plan, generation)
@@ -1,8 +1,30 @@
 #!/usr/bin/env python3
 
 import unittest
+import contextlib
+import io
 import os
+import json
+import itertools
+import random
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import networkx as nx
 import Graph
+import portfolio
+import onosClient
+import utilClasses
+import intentapp
+import topoEvents
+import intentJournal
+import metrics
+import tracing
+import benchmark
+import fakeOnos
+import intentApi
+import requests
 graph_dir = os.path.join("tests", "graphs")
 intents_dir = os.path.join("tests", "intents")
 class TestGraph(unittest.TestCase):
@@ -26,6 +48,1023 @@ class TestGraph(unittest.TestCase):
     def test_1_online(self):
         i = 1
         self.assertTrue(self.do_work(i, True), f"Failed Graph{i}")
+
+class TestAstar(unittest.TestCase):
+    def test_modes_agree(self):
+        g = Graph.Graph(os.path.join(graph_dir, "g1.graph"))
+        for mode in [Graph.ASTAR_ITERATIVE, Graph.ASTAR_RECURSIVE]:
+            self.assertEqual(g.astar("1", "6", 6, mode=mode), ["1", "2", "4", "6"])
+            self.assertIsNone(g.astar("1", "6", 7, mode=mode))
+
+    def test_long_path(self):
+        g = Graph.Graph()
+        for i in range(5000):
+            g.add_edge(i, i + 1, bilink=Graph.BiLink(i, i + 1, 10))
+        self.assertEqual(len(g.astar(0, 5000, 5)), 5001)
+
+class TestTightestShortestPath(unittest.TestCase):
+    def test_matches_brute_force(self):
+        rng = random.Random(7)
+        g = Graph.Graph()
+        for u, v in nx.gnm_random_graph(10, 20, seed=7).edges:
+            g.add_edge(u, v, bilink=Graph.BiLink(u, v, rng.randint(1, 10)))
+        for _ in range(50):
+            src, dst = rng.sample(list(g.nodes), 2)
+            req = rng.randint(1, 10)
+            # The tightest feasible path among the shortest feasible ones
+            expected = None
+            for candidate in nx.shortest_simple_paths(g, src, dst):
+                if expected is not None and len(candidate) > len(expected):
+                    break
+                capacity = g.get_path_capacity(candidate)
+                if capacity >= req and (expected is None or capacity < g.get_path_capacity(expected)):
+                    expected = candidate
+            path = g.get_shortest_path(src, dst, req)
+            if expected is None:
+                self.assertIsNone(path)
+                continue
+            self.assertEqual(len(path), len(expected))
+            self.assertEqual(g.get_path_capacity(path), g.get_path_capacity(expected))
+
+class TestPathCache(unittest.TestCase):
+    def test_reuse_and_invalidation(self):
+        g = Graph.Graph(os.path.join(graph_dir, "g1.graph"))
+        self.assertEqual(g.get_shortest_path("1", "6", 6), ["1", "2", "4", "6"])
+        entry = g.path_cache.entry(g, "1", "6")
+        self.assertEqual(len(entry.paths), 2)
+        self.assertEqual(g.get_shortest_path("1", "6", 2), ["1", "3", "5", "6"])
+        self.assertIs(g.path_cache.entry(g, "1", "6"), entry)
+        g.remove_edge("3", "5")
+        self.assertNotIn(("1", "6"), g.path_cache)
+        self.assertEqual(g.get_shortest_path("1", "6", 2), ["1", "2", "4", "6"])
+        g.add_edge("1", "6", bilink=Graph.BiLink("1", "6", 10))
+        self.assertEqual(g.get_shortest_path("1", "6", 2), ["1", "6"])
+
+    def test_edge_added(self):
+        g = Graph.Graph(os.path.join(graph_dir, "g1.graph"))
+        for src in ("1", "2", "4"):
+            g.path_cache.entry(g, src, "6")
+        g.add_edge("2", "3", bilink=Graph.BiLink("2", "3", 10))   # both two hops from 6
+        self.assertEqual(len(g.path_cache), 3)
+        # 1-3-4-6 is as short as the paths cached for 1, 3 is off those for 2
+        g.add_edge("3", "4", bilink=Graph.BiLink("3", "4", 10))
+        self.assertNotIn(("1", "6"), g.path_cache)
+        self.assertEqual(len(g.path_cache.entry(g, "1", "6").paths), 3)
+        self.assertIn(("2", "6"), g.path_cache)
+        # 2-1-6 ties with 2-4-6, 4 is still closer than through 1
+        g.hop_distances("2")
+        g.hop_distances("4")
+        g.add_edge("1", "6", bilink=Graph.BiLink("1", "6", 10))
+        self.assertNotIn(("2", "6"), g.path_cache)
+        self.assertIn(("4", "6"), g.path_cache)
+        self.assertEqual(g.get_shortest_path("1", "6", 2), ["1", "6"])
+
+    def test_fallback_past_max_paths(self):
+        g = Graph.Graph(os.path.join(graph_dir, "g1.graph"))
+        g.path_cache = Graph.PathCache(max_paths=1)
+        self.assertEqual(g.get_shortest_path("1", "6", 6), ["1", "2", "4", "6"])
+        self.assertIsNone(g.path_cache.entry(g, "1", "6").paths)
+
+    def test_longer_than_cached(self):
+        g = Graph.Graph(os.path.join(graph_dir, "g1.graph"))
+        g.add_edge("1", "6", bilink=Graph.BiLink("1", "6", 3))
+        self.assertEqual(g.get_shortest_path("1", "6", 5), ["1", "3", "5", "6"])
+
+class TestBestSolution(unittest.TestCase):
+    def test_widest_matches_search(self):
+        g = Graph.Graph(os.path.join(graph_dir, "g1.graph"))
+        intents = [Graph.Intent("1", "6", 5), Graph.Intent("1", "6", 3)]
+        g.topk_greedy_allocate(intents)
+        new_intent = Graph.Intent("1", "6", 10)
+        intents = {intent.id: intent for intent in intents + [new_intent]}
+        bw, path = g.max_admissible_bandwidth(intents, new_intent.id)
+        self.assertEqual((bw, path), (3, ["1", "2", "4", "6"]))
+        self.assertEqual(g.find_best_solution(intents, new_intent.id, mode=Graph.BEST_SOLUTION_SEARCH), bw)
+        self.assertEqual(new_intent.required_bw, 10)
+        self.assertIsNone(new_intent.path)
+
+class TestAnytimeAllocate(unittest.TestCase):
+    def test_recovers_from_greedy_failure(self):
+        g = Graph.Graph()
+        edges = [("0", "4"), ("0", "1"), ("0", "2"), ("4", "1"), ("4", "3"), ("1", "3"),
+                 ("1", "5"), ("2", "6"), ("2", "3"), ("3", "6"), ("5", "6")]
+        for u, v in edges:
+            g.add_edge(u, v, bilink=Graph.BiLink(u, v, 10))
+        demands = [("3", "0", 5), ("2", "3", 2), ("4", "2", 8), ("2", "1", 7),
+                   ("6", "4", 2), ("3", "2", 4), ("0", "4", 7)]
+        intents = [Graph.Intent(*demand) for demand in demands]
+        self.assertIsNone(g.topk_greedy_allocate(intents))
+        flows = g.anytime_allocate(intents, budget=1, seed=1)
+        self.assertEqual(len(flows), len(intents))
+        for u, v in g.edges:
+            self.assertGreaterEqual(g[u][v][Graph.CAP_REMAINING], 0)
+
+    def test_rips_up_hottest_first(self):
+        g = Graph.Graph()
+        for u, v in [("1", "2"), ("2", "3"), ("1", "4"), ("4", "3")]:
+            g.add_edge(u, v, bilink=Graph.BiLink(u, v, 10))
+        hot = Graph.Intent("2", "3", 8)
+        hot.path = ["2", "3"]
+        g.allocate_flow(hot)
+        # on_hot and cold fill 1-2, only on_hot also crosses the hot 2-3
+        on_hot, cold, target = Graph.Intent("1", "3", 5), Graph.Intent("1", "2", 5), Graph.Intent("1", "2", 5)
+        for seed in range(8):
+            g.reset_capacities(use_virtual=True)
+            plan = {on_hot.id: ["1", "2", "3"], cold.id: ["1", "2"]}
+            plan_edges = {intent_id: g.path_edges(path) for intent_id, path in plan.items()}
+            for intent in (on_hot, cold):
+                g.core.virtual_capacity[plan_edges[intent.id]] -= intent.required_bw
+            unplaced = [target]
+            g._rip_up_and_reroute(target, ["1", "2"], plan, plan_edges, unplaced,
+                                  {intent.id: intent for intent in (on_hot, cold)}, random.Random(seed))
+            self.assertEqual(plan, {cold.id: ["1", "2"], target.id: ["1", "2"], on_hot.id: ["1", "4", "3"]})
+            self.assertEqual(unplaced, [])
+
+    def test_impossible_intent(self):
+        g = Graph.Graph(os.path.join(graph_dir, "g1.graph"))
+        self.assertIsNone(g.anytime_allocate([Graph.Intent("1", "6", 11)], budget=1))
+
+class TestRepair(unittest.TestCase):
+    def test_reroute_after_link_failure(self):
+        g = Graph.Graph(os.path.join(graph_dir, "g1.graph"))
+        moved = Graph.Intent("1", "6", 4)
+        kept = Graph.Intent("1", "2", 3)
+        g.topk_greedy_allocate([moved, kept])
+        self.assertEqual(moved.path, ["1", "3", "5", "6"])
+        removed = g.remove_edge("3", "5")
+        self.assertEqual(removed, {moved.id})
+        self.assertEqual(g.repair_intents([moved]), [moved])
+        self.assertEqual(moved.path, ["1", "2", "4", "6"])
+        self.assertEqual(kept.path, ["1", "2"])
+        self.assertEqual(g["1"]["2"][Graph.CAP_REMAINING], 3)
+
+    def test_all_or_nothing(self):
+        g = Graph.Graph(os.path.join(graph_dir, "g1.graph"))
+        intents = [Graph.Intent("1", "6", 5), Graph.Intent("1", "6", 4)]
+        g.topk_greedy_allocate(intents)
+        self.assertEqual(g.remove_edge("3", "5"), {intents[0].id})
+        path = intents[0].path
+        self.assertIsNone(g.repair_intents([intents[0]]))
+        self.assertEqual(intents[0].path, path)
+        self.assertEqual(g["1"]["2"][Graph.CAP_REMAINING], 6)
+
+    def test_capacity_change(self):
+        g = Graph.Graph(os.path.join(graph_dir, "g1.graph"))
+        small, large = Graph.Intent("1", "6", 1), Graph.Intent("1", "6", 3)
+        g.topk_greedy_allocate([small, large])
+        self.assertEqual(small.path, large.path)
+        self.assertEqual(g.set_capacity("3", "5", 8), set())
+        self.assertEqual(g["3"]["5"][Graph.CAP_REMAINING], 4)
+        self.assertEqual(g.set_capacity("3", "5", 2), {large.id})
+        self.assertEqual(g["3"]["5"][Graph.CAP_REMAINING], 1)
+        self.assertEqual(g.repair_intents([large]), [large])
+        self.assertEqual(large.path, ["1", "2", "4", "6"])
+
+class TestSnapshot(unittest.TestCase):
+    def test_fork_and_commit(self):
+        g = Graph.Graph(os.path.join(graph_dir, "g1.graph"))
+        intent = Graph.Intent("1", "6", 4)
+        snapshot = g.fork()
+        path = snapshot.allocate(intent)
+        self.assertEqual(path, ["1", "3", "5", "6"])
+        self.assertEqual(snapshot.path_capacity(path), g.get_path_capacity(path) - 4)
+        self.assertEqual(g["1"]["3"][Graph.CAP_REMAINING], g["1"]["3"][Graph.CAP_MAX])
+        self.assertIsNone(intent.path)
+        self.assertTrue(snapshot.commit())
+        self.assertEqual(intent.path, path)
+        self.assertIn(intent.id, g["1"]["3"]["bilink"].intents)
+        self.assertEqual(g["1"]["3"][Graph.CAP_REMAINING], g["1"]["3"][Graph.CAP_MAX] - 4)
+
+    def test_concurrent_forks(self):
+        g = Graph.Graph(os.path.join(graph_dir, "g1.graph"))
+        first, second = g.fork(), g.fork()
+        first.allocate(Graph.Intent("1", "6", 4))
+        second.allocate(Graph.Intent("1", "2", 3))
+        self.assertEqual(second.path_capacity(["1", "3"]), g["1"]["3"][Graph.CAP_MAX])
+        g.allocate_single(Graph.Intent("2", "4", 1))
+        self.assertFalse(first.commit())
+        second.discard()
+        self.assertEqual(g["1"]["3"][Graph.CAP_REMAINING], g["1"]["3"][Graph.CAP_MAX])
+        self.assertEqual(g["1"]["2"][Graph.CAP_REMAINING], g["1"]["2"][Graph.CAP_MAX])
+
+    def test_move_placed_intent(self):
+        g = Graph.Graph(os.path.join(graph_dir, "g1.graph"))
+        intent = Graph.Intent("1", "6", 4)
+        old = g.allocate_single(intent)
+        snapshot = g.fork()
+        snapshot.release(intent)
+        self.assertEqual(snapshot.path_capacity(old), g.get_path_capacity(old) + 4)
+        self.assertEqual(snapshot.allocate(intent, ["1", "2", "4", "6"]), ["1", "2", "4", "6"])
+        self.assertTrue(snapshot.commit())
+        self.assertNotIn(intent.id, g["1"]["3"]["bilink"].intents)
+        self.assertEqual(g["1"]["3"][Graph.CAP_REMAINING], g["1"]["3"][Graph.CAP_MAX])
+        self.assertEqual(intent.path, ["1", "2", "4", "6"])
+
+    def test_stale_plan_dropped(self):
+        g = Graph.Graph(os.path.join(graph_dir, "g1.graph"))
+        intent = Graph.Intent("1", "6", 4)
+        generation = g.generation
+        plan = g._plan_virtual([intent])
+        other = Graph.Intent("1", "2", 3)
+        g.allocate_single(other)
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.assertIsNone(g._commit_plan([intent], plan, generation))
+        self.assertEqual(output.getvalue(), "")     # reported by the StateManager
+        self.assertEqual(g.plans_dropped, 1)
+        self.assertIsNone(intent.path)
+        self.assertIn(other.id, g["1"]["2"]["bilink"].intents)
+
+    def test_replan_on_stale_commit(self):
+        manager = intentapp.StateManager()
+        manager.graph = Graph.Graph(os.path.join(graph_dir, "g1.graph"))
+        fork = manager.graph.fork
+        forks = []
+        def racing_fork(clean=False):
+            # Another writer changes the graph right after the first fork
+            snapshot = fork(clean)
+            if not forks:
+                manager.graph.generation += 1
+            forks.append(snapshot)
+            return snapshot
+        manager.graph.fork = racing_fork
+        intent = Graph.Intent("1", "6", 4)
+        self.assertEqual(manager._place([intent]), [])
+        self.assertEqual(len(forks), 2)
+        self.assertEqual(intent.path, ["1", "3", "5", "6"])
+
+class TestCongestion(unittest.TestCase):
+    def test_hottest_links(self):
+        g = Graph.Graph(os.path.join(graph_dir, "g1.graph"))
+        moved = Graph.Intent("1", "6", 4)
+        kept = Graph.Intent("1", "2", 3)
+        g.topk_greedy_allocate([moved, kept])
+        self.assertEqual(g.hottest_links(1), [("3", "5", 0.8)])
+        self.assertEqual([(u, v) for u, v, _ in g.intent_footprint(moved.id)],
+                         [("1", "3"), ("3", "5"), ("5", "6")])
+        g.remove_edge("3", "5")
+        self.assertEqual(g.intent_footprint(moved.id), [])
+        self.assertEqual(g.hottest_links(1), [("1", "2", 0.3)])
+        g.repair_intents([moved])
+        self.assertEqual(g.hottest_links(2), [("1", "2", 0.7), ("2", "4", 4 / 6)])
+
+    def test_matches_scan(self):
+        g = Graph.Graph(os.path.join(graph_dir, "g1.graph"))
+        rng = random.Random(3)
+        intents = []
+        for _ in range(30):
+            intent = Graph.Intent(*rng.sample("123456", 2), rng.randint(1, 3))
+            if g.allocate_single(intent) is not None:
+                intents.append(intent)
+            if intents and rng.random() < 0.3:
+                g.remove_flow(intents.pop(rng.randrange(len(intents))))
+        scan = sorted(((g[u][v][Graph.CAP_MAX] - g[u][v][Graph.CAP_REMAINING]) / g[u][v][Graph.CAP_MAX]
+                       for u, v in g.edges),
+                      reverse=True)
+        self.assertEqual([util for _, _, util in g.hottest_links(len(scan))], scan)
+
+class TestPortfolio(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        portfolio.shutdown()
+
+    def test_orderings(self):
+        g = Graph.Graph(os.path.join(graph_dir, "g1.graph"))
+        intents = [Graph.Intent("1", "6", 1), Graph.Intent("2", "4", 5), Graph.Intent("1", "6", 4)]
+        by_hops = portfolio.order_intents(g, intents, portfolio.ORDER_HOPS)
+        self.assertEqual(by_hops[-1], intents[1])
+        for policy in [portfolio.POLICY_FIRST, portfolio.POLICY_HEADROOM]:
+            flows = portfolio.portfolio_allocate(g, intents, workers=2, policy=policy)
+            self.assertEqual(len(flows), 3)
+            for u, v in g.edges:
+                self.assertGreaterEqual(g[u][v][Graph.CAP_REMAINING], 0)
+        self.assertIsNone(portfolio.portfolio_allocate(g, [Graph.Intent("1", "6", 11)], workers=2))
+
+    def test_failed_ordering_skipped(self):
+        g = Graph.Graph(os.path.join(graph_dir, "g1.graph"))
+        intents = [Graph.Intent("1", "6", 1), Graph.Intent("2", "4", 5)]
+        orderings = [("no-such-ordering", None), (portfolio.ORDER_BANDWIDTH, None)]
+        flows = portfolio.portfolio_allocate(g, intents, orderings, workers=2, policy=portfolio.POLICY_HEADROOM)
+        self.assertEqual(len(flows), 2)
+
+class FlowsHandler(BaseHTTPRequestHandler):
+    # Answers /flows like ONOS and records every request
+    calls = []
+    installed = {}  # {(deviceId, flowId): flow}
+    ids = itertools.count(1000)
+    refuse = None   # flow -> True to answer the POST carrying it with 400
+
+    @classmethod
+    def reset(cls):
+        cls.calls = []
+        cls.installed = {}
+        cls.refuse = None
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length)) if length else None
+
+    def do_POST(self):
+        body = self._body()
+        self.calls.append(("POST", self.path, body))
+        refuse = FlowsHandler.refuse or (lambda flow: False)
+        if any(flow["deviceId"] == "of:bad" or refuse(flow) for flow in body["flows"]):
+            self.send_response(400)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        flows = []
+        for flow in body["flows"]:
+            # A rule with the selector of an installed one replaces it
+            flow_id = next((key[1] for key, old in self.installed.items()
+                            if key[0] == flow["deviceId"] and old["priority"] == flow["priority"]
+                            and old["selector"] == flow["selector"]), None) or str(next(self.ids))
+            self.installed[(flow["deviceId"], flow_id)] = dict(flow, id=flow_id, appId="org.onosproject.rest")
+            flows.append({"deviceId": flow["deviceId"], "flowId": flow_id})
+        data = json.dumps({"flows": flows}).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_DELETE(self):
+        body = self._body()
+        self.calls.append(("DELETE", self.path, body))
+        if any(flow["deviceId"] == "of:stuck" for flow in body["flows"]):
+            self.send_response(500)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        for flow in body["flows"]:
+            self.installed.pop((flow["deviceId"], flow["flowId"]), None)
+        self.send_response(204)
+        self.end_headers()
+
+    def do_GET(self):
+        if not self.path.endswith("/flows"):
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        data = json.dumps({"flows": list(self.installed.values())}).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+class TopologyHandler(BaseHTTPRequestHandler):
+    # Serves /hosts and /links like ONOS
+    hosts = []
+    links = []
+
+    @classmethod
+    def reset(cls):
+        cls.hosts = []
+        cls.links = []
+
+    def do_GET(self):
+        resource = self.path.rsplit("/", 1)[-1]
+        data = json.dumps({resource: getattr(self, resource)}).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+class FakeOnosTestCase(unittest.TestCase):
+    # Points the controller at a local server answering like ONOS with
+    # handler, for the duration of each test
+    handler = FlowsHandler
+
+    def start_onos(self):
+        # Starts the server and returns its base URL
+        self.handler.reset()
+        server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return f"http://127.0.0.1:{server.server_port}/onos/v1"
+
+    def setUp(self):
+        url = self.start_onos()
+        self.addCleanup(utilClasses.set_base_url, utilClasses.BASE_URL)
+        utilClasses.set_base_url(url)
+
+def switch_graph(links, capacity=10):
+    # Switch u reaches switch v = "s<n>" through its port <n>
+    graph = Graph.Graph()
+    for u, v in links:
+        link = Graph.BiLink(utilClasses.SwitchPort({"device": u, "port": v[1:]}),
+                            utilClasses.SwitchPort({"device": v, "port": u[1:]}), capacity)
+        graph.add_edge(u, v, bilink=link)
+    return graph
+
+def detour_topology():
+    # s1-s2-s3-s4, with a detour from s2 to s4 over s5
+    return switch_graph([("s1", "s2"), ("s2", "s3"), ("s3", "s4"), ("s2", "s5"), ("s5", "s4")])
+
+def square_topology():
+    # s1 to s4 over s2 or over s3
+    return switch_graph([("s1", "s2"), ("s2", "s4"), ("s1", "s3"), ("s3", "s4")])
+
+def host(number, switch):
+    return utilClasses.Host({"id": f"h{number}", "mac": f"00:00:00:00:00:0{number}",
+                             "locations": [{"elementId": switch, "port": "9"}]})
+
+class TestOnosClient(unittest.TestCase):
+    def setUp(self):
+        FlowsHandler.reset()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FlowsHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client = onosClient.OnosClient(f"http://127.0.0.1:{self.server.server_port}/onos/v1", ("onos", "rocks"))
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def make_flows(self, devices):
+        return [utilClasses.Flow(device, "00:00:00:00:00:01", "00:00:00:00:00:02", port, 2)
+                for port, device in enumerate(devices, 1)]
+
+    def test_batches(self):
+        self.client.BATCH_SIZE = 2
+        flows = self.make_flows(["of:1", "of:1", "of:1", "of:2"])
+        self.client.install_flows(flows)
+        posts = sorted(len(body["flows"]) for method, path, body in FlowsHandler.calls)
+        self.assertEqual(posts, [1, 1, 2])
+        self.assertEqual(len({flow.id for flow in flows}), 4)
+        self.client.delete_flows(flows)
+        deleted = [flow for method, _, body in FlowsHandler.calls if method == "DELETE" for flow in body["flows"]]
+        self.assertEqual(sorted(flow["deviceId"] for flow in deleted), ["of:1", "of:1", "of:1", "of:2"])
+        self.assertTrue(all(flow.id is None for flow in flows))
+
+    def test_rollback(self):
+        good, bad = self.make_flows(["of:1", "of:2"]), self.make_flows(["of:1", "of:bad"])
+        errors = self.client.install_groups({"good": good, "bad": bad})
+        self.assertIsNone(errors["good"])
+        self.assertIsInstance(errors["bad"], onosClient.OnosError)
+        self.assertTrue(all(flow.id is not None for flow in good))
+        self.assertTrue(all(flow.id is None for flow in bad))
+        deleted = [flow for method, _, body in FlowsHandler.calls if method == "DELETE" for flow in body["flows"]]
+        self.assertEqual([flow["deviceId"] for flow in deleted], ["of:1"])
+
+    def test_failed_rollback(self):
+        flows = self.make_flows(["of:stuck", "of:bad"])
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            errors = self.client.install_groups({"intent": flows})
+        self.assertIn("rollback failed", str(errors["intent"]))
+        self.assertIn("left in ONOS", output.getvalue())
+        self.assertIsNotNone(flows[0].id)
+
+    def test_error(self):
+        with self.assertRaises(onosClient.OnosError):
+            self.client.get("hosts")
+
+class TestReconcile(FakeOnosTestCase):
+    def test_make_before_break(self):
+        manager = intentapp.StateManager()
+        manager.graph = detour_topology()
+        h1 = host(1, "s1")
+        h2 = host(2, "s4")
+        intent = Graph.Intent(h1, h2, 1)
+        intent.path = ["s1", "s2", "s3", "s4"]
+        manager.intents[intent.id] = intent
+        self.assertEqual(manager.program_intents([intent]), [])
+        self.assertEqual(manager.reconcile_stats, {"installed": 8, "deleted": 0, "saved": 0})
+        FlowsHandler.calls = []
+        FlowsHandler.installed = {}
+        intent.path = ["s1", "s2", "s5", "s4"]
+        self.assertEqual(manager.program_intents([intent]), [])
+        # s1 is untouched, the forward rule on s2 and the reverse one on s4
+        # are overwritten in place
+        self.assertEqual(manager.reconcile_stats, {"installed": 6, "deleted": 4, "saved": 6})
+        self.assertEqual(len(intent.flowRules), 8)
+        methods = [method for method, _, _ in FlowsHandler.calls]
+        self.assertEqual(methods, sorted(methods, reverse=True))    # every POST before the DELETEs
+
+    def rerouted_intent(self):
+        # An intent installed over s1-s2-s3-s4 and moved to the detour: the
+        # forward rule on s2 and the reverse one on s4 keep their selector
+        manager = intentapp.StateManager()
+        manager.graph = detour_topology()
+        intent = Graph.Intent(host(1, "s1"), host(2, "s4"), 1)
+        intent.path = ["s1", "s2", "s3", "s4"]
+        manager.intents[intent.id] = intent
+        self.assertEqual(manager.program_intents([intent]), [])
+        intent.path = ["s1", "s2", "s5", "s4"]
+        return manager, intent
+
+    def assertOldRulesInstalled(self, intent, old):
+        self.assertEqual([(rule.deviceId, rule.in_port, rule.out_port) for rule in intent.flowRules], old)
+        installed = {(flow["deviceId"], flow["id"]): flow["treatment"]["instructions"][0]["port"]
+                     for flow in FlowsHandler.installed.values()}
+        self.assertEqual(installed, {(rule.deviceId, rule.id): str(rule.out_port) for rule in intent.flowRules})
+
+    def test_reroute_failure(self):
+        manager, intent = self.rerouted_intent()
+        old = [(rule.deviceId, rule.in_port, rule.out_port) for rule in intent.flowRules]
+        # The second hop of the detour refuses its rules
+        FlowsHandler.refuse = lambda flow: flow["deviceId"] == "s5"
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(manager.program_intents([intent]), [intent.id])
+        self.assertOldRulesInstalled(intent, old)
+        # Nothing was overwritten, the new rules elsewhere were rolled back
+        self.assertFalse(any(flow["deviceId"] == "s2" and flow["treatment"]["instructions"][0]["port"] == "5"
+                             for method, _, body in FlowsHandler.calls if method == "POST" for flow in body["flows"]))
+
+    def test_failed_overwrite_restored(self):
+        manager, intent = self.rerouted_intent()
+        old = [(rule.deviceId, rule.in_port, rule.out_port) for rule in intent.flowRules]
+        # s2 refuses to send h2 traffic down the detour, after s4 already
+        # overwrote its reverse rule
+        FlowsHandler.refuse = lambda flow: (flow["deviceId"] == "s2"
+                                            and flow["treatment"]["instructions"][0]["port"] == "5")
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(manager.program_intents([intent]), [intent.id])
+        self.assertEqual(manager.programming[intent.id], intentapp.PROGRAM_FAILED)
+        self.assertOldRulesInstalled(intent, old)
+
+    def test_replan_failure(self):
+        manager = intentapp.StateManager()
+        manager.graph = square_topology()
+        first = Graph.Intent(host(1, "s1"), host(4, "s4"), 6)
+        manager.add_intent(first)
+        old = list(first.flowRules)
+        # A new intent whose rules do not get in is dropped with its capacity
+        second = Graph.Intent(host(2, "s1"), host(4, "s4"), 6)
+        manager.intents[second.id] = second
+        FlowsHandler.refuse = lambda flow: any(c.get("mac") == "00:00:00:00:00:02"
+                                               for c in flow["selector"]["criteria"])
+        with contextlib.redirect_stdout(io.StringIO()):
+            manager.recalculate(second.id)
+        self.assertEqual(set(manager.intents), {first.id})
+        self.assertEqual(sum(manager.graph[u][v][Graph.CAP_REMAINING] for u, v in manager.graph.edges), 28)
+        # A rerouted one keeps forwarding over its previous path
+        FlowsHandler.refuse = lambda flow: True
+        lost = tuple(sorted(first.path[1:]))
+        with contextlib.redirect_stdout(io.StringIO()):
+            manager.repair_intents(manager.graph.remove_edge(*lost), [lost])
+        self.assertEqual(manager.repair_events[-1]["failed"], 1)
+        self.assertEqual(manager.programming[first.id], intentapp.PROGRAM_FAILED)
+        self.assertEqual(first.flowRules, old)
+
+    def test_aggregation(self):
+        manager = intentapp.StateManager()
+        manager.AGGREGATE_RULES = True
+        manager.graph = detour_topology()
+        hosts = [host(1, "s1"), host(2, "s2"), host(3, "s4")]
+        first = Graph.Intent(hosts[0], hosts[2], 1)
+        first.path = ["s1", "s2", "s3", "s4"]
+        second = Graph.Intent(hosts[1], hosts[2], 1)
+        second.path = ["s2", "s3", "s4"]
+        for intent in (first, second):
+            manager.intents[intent.id] = intent
+            manager.graph.allocate_flow(intent)
+        self.assertEqual(manager.program_intents([first, second]), [])
+        # The rules towards h3 on s2, s3 and s4 serve both intents
+        self.assertEqual(manager.aggregation_stats, {"rules": 11, "per_intent": 14, "saved": 3})
+        self.assertEqual(len(FlowsHandler.installed), 11)
+        self.assertTrue(all(rule.src_mac is None for rule in first.flowRules))
+        manager.remove_intent(first.id)
+        self.assertEqual(len(FlowsHandler.installed), 6)
+        self.assertEqual(len(second.flowRules), 6)
+        # s2 already forwards h3 traffic towards s3, the detour needs an exact rule there
+        third = Graph.Intent(hosts[0], hosts[2], 1)
+        third.path = ["s1", "s2", "s5", "s4"]
+        manager.intents[third.id] = third
+        self.assertEqual(manager.program_intents([third]), [])
+        exact = [rule for rule in third.flowRules if rule.src_mac is not None]
+        self.assertEqual([(rule.deviceId, rule.in_port, rule.out_port) for rule in exact], [("s2", "1", "5")])
+
+    def test_aggregated_reroute_failure(self):
+        manager = intentapp.StateManager()
+        manager.AGGREGATE_RULES = True
+        manager.graph = Graph.Graph()
+        for u, pu, v, pv in [("s1", "2", "s2", "1"), ("s2", "4", "s4", "2"),
+                             ("s2", "5", "of:bad", "1"), ("of:bad", "2", "s4", "5")]:
+            link = Graph.BiLink(utilClasses.SwitchPort({"device": u, "port": pu}),
+                                utilClasses.SwitchPort({"device": v, "port": pv}), 10)
+            manager.graph.add_edge(u, v, bilink=link)
+        h1 = host(1, "s1")
+        h2 = host(2, "s4")
+        intent = Graph.Intent(h1, h2, 1)
+        intent.path = ["s1", "s2", "s4"]
+        manager.intents[intent.id] = intent
+        self.assertEqual(manager.program_intents([intent]), [])
+        old = list(intent.flowRules)
+        FlowsHandler.calls = []
+        intent.path = ["s1", "s2", "of:bad", "s4"]
+        self.assertEqual(manager.program_intents([intent]), [intent.id])
+        # The rerouted hops got exact rules instead of overwriting the
+        # destination-keyed ones the intent still holds
+        posted = [flow for method, _, body in FlowsHandler.calls if method == "POST" for flow in body["flows"]
+                  if flow["deviceId"] in ("s2", "s4")]
+        self.assertEqual(len(posted), 2)
+        self.assertTrue(all(any(c["type"] == "IN_PORT" for c in flow["selector"]["criteria"]) for flow in posted))
+        self.assertEqual(intent.flowRules, old)
+        self.assertEqual(len(FlowsHandler.installed), 6)
+
+class TestTopologyEvents(unittest.TestCase):
+    def link(self, u, v):
+        return {"src": {"device": u, "port": v[1:]}, "dst": {"device": v, "port": u[1:]},
+                "annotations": {"bandwidth": "10"}}
+
+    def test_webhook(self):
+        with self.assertRaises(TypeError):
+            topoEvents.EventSource()    # start and stop are abstract
+        events = []
+        source = topoEvents.WebhookEventSource(port=0)
+        source.start(events.append)
+        try:
+            url = f"http://127.0.0.1:{source.port}/events"
+            body = {"events": [{"type": topoEvents.LINK_REMOVED, "link": self.link("s1", "s2")}]}
+            self.assertEqual(requests.post(url, json=body).status_code, 202)
+            self.assertEqual(requests.post(url, json={"type": "BOGUS"}).status_code, 400)
+        finally:
+            source.stop()
+        self.assertEqual(events, body["events"])
+
+    def test_apply(self):
+        manager = intentapp.StateManager()
+        manager.graph = Graph.Graph()
+        for u, v in [("s1", "s2"), ("s2", "s3"), ("s1", "s3")]:
+            manager.graph.add_edge(u, v, bilink=intentapp.bilink_from_json(self.link(u, v))[2])
+        manager.apply_topology_events([
+            {"type": topoEvents.LINK_REMOVED, "link": self.link("s2", "s1")},
+            {"type": topoEvents.LINK_REMOVED, "link": self.link("s1", "s2")},
+            {"type": topoEvents.PORT_UPDATED, "port": {"device": "s3", "port": "1", "isEnabled": False}},
+            {"type": topoEvents.HOST_ADDED, "host": {"id": "h1", "mac": "00:00:00:00:00:01",
+                                                    "locations": [{"elementId": "s1", "port": "9"}]}},
+        ])
+        self.assertEqual(list(manager.graph.edges), [("s2", "s3")])
+        self.assertEqual(manager.repair_events[-1]["links"], [("s2", "s1"), ("s3", "s1")])
+        self.assertIn("h1", manager.hosts)
+        manager.apply_topology_events([{"type": topoEvents.LINK_ADDED, "link": self.link("s1", "s2")}])
+        self.assertTrue(manager.graph.has_edge("s1", "s2"))
+
+class TestTopologySync(FakeOnosTestCase):
+    handler = TopologyHandler
+
+    def link(self, u, v, bw):
+        return {"src": {"device": u, "port": v[1:]}, "dst": {"device": v, "port": u[1:]},
+                "annotations": {"bandwidth": str(bw)}}
+
+    def test_delta(self):
+        manager = intentapp.StateManager()
+        manager.graph = Graph.Graph()
+        for u, v in [("s1", "s2"), ("s2", "s3"), ("s1", "s3")]:
+            manager.graph.add_edge(u, v, bilink=intentapp.bilink_from_json(self.link(u, v, 10))[2])
+        TopologyHandler.hosts = [{"id": "h1", "mac": "00:00:00:00:00:01",
+                                  "locations": [{"elementId": "s1", "port": "9"}]}]
+        TopologyHandler.links = [self.link("s1", "s2", 10), self.link("s2", "s1", 10),
+                                 self.link("s3", "s2", 4), self.link("s3", "s4", 10)]
+        manager.update_topo_from_ONOS()
+        self.assertEqual(sorted(tuple(sorted(edge)) for edge in manager.graph.edges),
+                         [("s1", "s2"), ("s2", "s3"), ("s3", "s4")])
+        self.assertEqual(manager.graph["s2"]["s3"][Graph.CAP_REMAINING], 4)
+        self.assertIsInstance(manager.hosts["h1"], utilClasses.Host)
+        # Nothing changed, nothing is parsed
+        manager._sync_links = manager._sync_hosts = lambda *args: self.fail("unchanged response parsed")
+        manager.update_topo_from_ONOS()
+
+    def test_failed_sync_retried(self):
+        manager = intentapp.StateManager()
+        manager.graph = Graph.Graph()
+        TopologyHandler.links = [self.link("s1", "s2", 10)]
+        sync = manager._sync_links
+        def fail(links):
+            raise onosClient.OnosError("lost")
+        manager._sync_links = fail
+        with self.assertRaises(onosClient.OnosError):
+            manager.update_topo_from_ONOS()
+        manager._sync_links = sync
+        manager.update_topo_from_ONOS()
+        self.assertTrue(manager.graph.has_edge("s1", "s2"))
+
+    def test_capacity_change_reported(self):
+        manager = intentapp.StateManager()
+        manager.graph = square_topology()
+        intent = Graph.Intent(host(1, "s1"), host(4, "s4"), 6)
+        intent.path = ["s1", "s2", "s4"]
+        manager.intents[intent.id] = intent
+        manager.graph.allocate_flow(intent)
+        TopologyHandler.links = [self.link(u, v, 4 if (u, v) == ("s1", "s2") else 10)
+                                 for u, v in [("s1", "s2"), ("s2", "s4"), ("s1", "s3"), ("s3", "s4")]]
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            manager.update_topo_from_ONOS()
+        event = manager.repair_events[-1]
+        self.assertEqual((event["links"], event["changed"]), ([], [("s1", "s2")]))
+        self.assertIn("0 link failures and 1 capacity changes", output.getvalue())
+        self.assertEqual(intent.path, ["s1", "s3", "s4"])
+
+class TestCommandQueue(unittest.TestCase):
+    def setUp(self):
+        self.manager = intentapp.StateManager()
+        self.manager.graph = Graph.Graph(os.path.join(graph_dir, "g1.graph"))
+        self.manager.update_topo_from_ONOS = lambda: None
+        self.manager.clear_all_flows = lambda soft_clear=False: None
+        self.thread = intentapp.StateThread(self.manager)
+        self.thread.start()
+        self.api = intentApi.IntentApi(self.thread, port=0)
+        self.api.start()
+
+    def tearDown(self):
+        self.api.stop()
+        self.thread.stop()
+
+    def test_stop_waits_for_worker(self):
+        alive = []
+        self.manager.clear_all_flows = lambda soft_clear=False: alive.append(self.thread.is_alive())
+        self.thread.submit("ls")
+        self.thread.stop()
+        self.assertEqual(alive, [False])
+
+    def test_order_and_duplicates(self):
+        jobs = [self.thread.submit(command) for command in ["ls", "rm nothing", "ls", "ls"]]
+        self.assertTrue(jobs[-1].wait(5))
+        self.assertEqual([job.status for job in jobs], [intentapp.JOB_DONE, intentapp.JOB_FAILED,
+                                                         intentapp.JOB_DONE, intentapp.JOB_DONE])
+        self.assertEqual(len({job.id for job in jobs}), 4)
+        self.assertTrue(all(a.finished <= b.finished for a, b in zip(jobs, jobs[1:])))
+
+    def test_api(self):
+        url = f"http://127.0.0.1:{self.api.port}"
+        res = requests.get(f"{url}/intents?wait=5")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()["result"], [])
+        res = requests.post(f"{url}/intents?wait=5", json={"src": "1", "dst": "99", "bw": 1})
+        self.assertEqual(res.json()["status"], intentapp.JOB_FAILED)
+        res = requests.get(f"{url}/jobs/{res.json()['id']}")
+        self.assertEqual(res.status_code, 200)
+        self.assertIn("invalid", res.json()["error"])
+        self.assertEqual(requests.post(f"{url}/intents", json={"src": "1"}).status_code, 400)
+        self.assertEqual(requests.get(f"{url}/nothing").status_code, 404)
+
+class TestBatchAdmission(FakeOnosTestCase):
+    def test_admit_and_counter_offer(self):
+        manager = intentapp.StateManager()
+        manager.graph = square_topology()
+        h1 = host(1, "s1")
+        h4 = host(4, "s4")
+        intents = [Graph.Intent(h1, h4, 6) for _ in range(3)]
+        results = manager.add_intents(intents)
+        self.assertEqual([result["admitted"] for result in results], [True, True, False])
+        self.assertEqual(results[2]["offer"], 4)
+        self.assertEqual({tuple(intent.path) for intent in intents[:2]}, {("s1", "s2", "s4"), ("s1", "s3", "s4")})
+        self.assertEqual(set(manager.intents), {intent.id for intent in intents[:2]})
+        self.assertEqual(manager.reconcile_stats["installed"], 12)
+
+class TestJournal(FakeOnosTestCase):
+    def setUp(self):
+        super().setUp()
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def test_replay_and_compaction(self):
+        journal = intentJournal.IntentJournal(self.dir, compact_every=3)
+        journal.put({"id": "a", "bw": 1})
+        journal.put({"id": "b", "bw": 2})
+        journal.remove(["a"])   # compacts
+        journal.put({"id": "b", "bw": 3})
+        journal.close()
+        with open(os.path.join(self.dir, intentJournal.IntentJournal.LOG), "a") as f:
+            f.write('{"op": "remove", "id"')  # torn write
+        journal = intentJournal.IntentJournal(self.dir)
+        self.assertEqual(journal.state, {"b": {"id": "b", "bw": 3, "op": intentJournal.OP_PUT}})
+        journal.close()
+
+    def manager(self):
+        manager = intentapp.StateManager()
+        manager.journal = intentJournal.IntentJournal(self.dir)
+        manager.graph = square_topology()
+        for number, switch in [(1, "s1"), (2, "s1"), (4, "s4")]:
+            manager.hosts[f"h{number}"] = host(number, switch)
+        return manager
+
+    def test_warm_restart(self):
+        manager = self.manager()
+        intents = [Graph.Intent(manager.hosts[src], manager.hosts["h4"], 6) for src in ("h1", "h2")]
+        manager.add_intents(intents)
+        manager.journal.close()
+        # Rules of a crashed run that never made it to the journal
+        orphan = utilClasses.Flow("s2", "00:00:00:00:00:09", "00:00:00:00:00:08", 1, 2)
+        utilClasses.get_client().install_flows([orphan])
+        FlowsHandler.calls = []
+
+        restarted = self.manager()
+        restarted.restore_intents()
+        self.assertEqual(set(restarted.intents), {intent.id for intent in intents})
+        for intent in intents:
+            self.assertEqual(restarted.intents[intent.id].path, intent.path)
+        self.assertEqual(restarted.graph["s1"]["s2"][Graph.CAP_REMAINING], 4)
+        # Nothing reinstalled, only the orphan deleted
+        self.assertEqual([method for method, _, _ in FlowsHandler.calls], ["DELETE"])
+        self.assertEqual(len(FlowsHandler.installed), 12)
+        restarted.journal.close()
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = []
+
+    def tearDown(self):
+        metrics.enable(False)
+        metrics.ALLOCATION_SECONDS.reset()
+
+    def test_noop_when_disabled(self):
+        counter = metrics.Counter("test_noop_total", "test", registry=self.registry)
+        counter.inc()
+        self.assertIs(metrics.ALLOCATION_SECONDS.time(method="x"), metrics.ALLOCATION_SECONDS.time(method="y"))
+        self.assertEqual(counter.samples(), [])
+
+    def test_exposition(self):
+        metrics.enable()
+        counter = metrics.Counter("test_calls_total", "test", ["kind"], registry=self.registry)
+        counter.inc(kind="a")
+        counter.inc(2, kind="a")
+        histogram = metrics.Histogram("test_seconds", "test", buckets=(0.1, 1), registry=self.registry)
+        histogram.observe(0.5)
+        text = metrics.render(self.registry)
+        self.assertIn('test_calls_total{kind="a"} 3', text)
+        self.assertIn('test_seconds_bucket{le="0.1"} 0', text)
+        self.assertIn('test_seconds_bucket{le="1"} 1', text)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 1', text)
+        self.assertNotIn("bwo_", text)
+        g = Graph.Graph(os.path.join(graph_dir, "g1.graph"))
+        g.allocate_single(Graph.Intent("1", "6", 4))
+        server = metrics.MetricsServer(port=0)
+        server.start()
+        try:
+            text = requests.get(f"http://127.0.0.1:{server.port}/metrics").text
+        finally:
+            server.stop()
+        self.assertNotIn("test_calls_total", text)
+        self.assertIn('bwo_allocation_seconds_count{method="allocate_single"}', text)
+
+    def test_gauges_follow_registered_manager(self):
+        self.addCleanup(metrics.INTENTS.set_function, None)
+        self.addCleanup(metrics.LINK_UTILIZATION.set_function, None)
+        manager = intentapp.StateManager()
+        manager.intents = {"a": None}
+        self.assertNotIn("bwo_intents 1", metrics.render())
+        manager.register_metrics()
+        intentapp.StateManager()
+        self.assertIn("bwo_intents 1", metrics.render())
+
+class TestTracing(unittest.TestCase):
+    def tearDown(self):
+        tracing.disable()
+        tracing.PROFILE_THRESHOLD = None
+        tracing.traces.clear()
+
+    def test_spans(self):
+        original = Graph.Graph.__dict__["allocate_single"]
+        self.assertIs(tracing.span("off"), tracing.span("off"))
+        tracing.enable([(Graph.Graph, ["allocate_single", "get_shortest_path"])])
+        self.assertIsNot(Graph.Graph.__dict__["allocate_single"], original)
+        g = Graph.Graph(os.path.join(graph_dir, "g1.graph"))
+        intent = Graph.Intent("1", "6", 4)
+        with tracing.span("command", job="j"):
+            g.allocate_single(intent)
+        root = tracing.traces[-1]
+        self.assertEqual(root.attrs, {"job": "j"})
+        alloc = root.children[0]
+        self.assertEqual(alloc.name, "Graph.allocate_single")
+        self.assertEqual(alloc.attrs, {"intent": intent.id, "bw": 4, "path_len": 4})
+        search = alloc.children[0]
+        self.assertEqual(search.name, "Graph.get_shortest_path")
+        self.assertEqual(search.attrs["bw"], 4)
+        self.assertEqual(search.attrs["path_len"], 4)
+        self.assertIn("candidates_examined", search.attrs)
+        tracing.disable()
+        self.assertIs(Graph.Graph.__dict__["allocate_single"], original)
+
+    def test_profile_dump(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        tracing.PROFILE_DIR = directory
+        tracing.PROFILE_THRESHOLD = 0
+        try:
+            with tracing.profiled("add 1 6 4") as profile:
+                Graph.Graph(os.path.join(graph_dir, "g1.graph")).allocate_single(Graph.Intent("1", "6", 4))
+        finally:
+            tracing.PROFILE_DIR = "profiles"
+        self.assertTrue(os.path.exists(profile.path))
+
+class TestBenchmark(unittest.TestCase):
+    def test_topologies(self):
+        for edges, endpoints, switches, links in [(*benchmark.fat_tree(4), 20, 32),
+                                                  (*benchmark.leaf_spine(8), 10, 16),
+                                                  (*benchmark.grid(3), 9, 12),
+                                                  (*benchmark.ring(5), 5, 5)]:
+            g = benchmark.build_graph(edges)
+            self.assertEqual((len(g.nodes), len(g.edges)), (switches, links))
+        edges, endpoints = benchmark.waxman(200, seed=1)
+        self.assertTrue(nx.is_connected(benchmark.build_graph(edges).to_networkx()))
+
+    def test_run_and_compare(self):
+        old = benchmark.run([("ring", 10, "uniform", 20)], ["allocate_single", "topk_greedy_allocate"])
+        self.assertEqual([result["algorithm"] for result in old["results"]],
+                         ["allocate_single", "topk_greedy_allocate"])
+        for result in old["results"]:
+            self.assertGreater(result["peak_kb"], 0)
+            self.assertLessEqual(result["admission_ratio"], 1)
+        self.assertEqual(benchmark.compare(old, old), [])
+        new = json.loads(json.dumps(old))
+        new["results"][0]["wall_s"] = old["results"][0]["wall_s"] * 2 + 1
+        new["results"][1]["admission_ratio"] = old["results"][1]["admission_ratio"] - 0.5
+        self.assertEqual([what for _, what, _, _ in benchmark.compare(old, new)], ["wall_s", "admission_ratio"])
+
+class TestFakeOnos(FakeOnosTestCase):
+    def start_onos(self):
+        self.onos = fakeOnos.FakeOnos(port=0, seed=1)
+        self.onos.load_graph("topology1.graph")
+        self.onos.start()
+        self.addCleanup(self.onos.stop)
+        return self.onos.url
+
+    def test_control_loop(self):
+        manager = intentapp.StateManager()
+        manager.retrieve_topo_from_ONOS(draw=False)
+        self.assertEqual(len(manager.hosts), 4)
+        self.assertEqual(manager.graph["of:0000000000000001"]["of:0000000000000002"]["bilink"].capacity, 100)
+        intent = utilClasses.Intent(manager.hosts["00:00:00:00:00:01/None"],
+                                    manager.hosts["00:00:00:00:00:03/None"], 60)
+        manager.add_intent(intent)
+        path = list(intent.path)
+        self.assertEqual(self.onos.flow_count(), 2 * len(path))
+        self.onos.fail_link(*[name for name, number in self.onos.numbers.items()
+                              if fakeOnos.device_id(number) in path[1:3]])
+        manager.update_topo_from_ONOS()
+        self.assertNotEqual(intent.path, path)
+        self.assertEqual(self.onos.flow_count(), 2 * len(intent.path))
+        paths = utilClasses.get_client().get("paths/00:00:00:00:00:01%2FNone/of:0000000000000004")["paths"]
+        self.assertEqual(len(paths[0]["links"]), 3)
+        ports = utilClasses.get_client().get("devices/of:0000000000000005/ports")["ports"]
+        self.assertEqual([(port["port"], port["isEnabled"]) for port in ports], [("1", True), ("4", False)])
+
+    def test_faults(self):
+        client = utilClasses.get_client()
+        res = client.post("flows/of:0000000000000001", {"priority": 10, "selector": {"criteria": []},
+                                                         "treatment": {"instructions": []}})
+        self.assertEqual(res.status_code, 201)
+        self.assertIn("/flows/of:0000000000000001/", res.headers["Location"])
+        with self.assertRaises(onosClient.OnosError):
+            client.post("flows/of:00000000000000ff", {"priority": 10})
+        self.onos.error_rate = 1
+        self.onos.error_status = 400
+        with self.assertRaises(onosClient.OnosError):
+            client.get("hosts")
+        self.assertEqual(self.onos.stats["errors"], 1)
+
+class TestTopologyCore(unittest.TestCase):
+    def test_capacity_arrays(self):
+        g = Graph.Graph(os.path.join(graph_dir, "g1.graph"))
+        intent = Graph.Intent("1", "6", 4)
+        self.assertEqual(g.allocate_single(intent), ["1", "3", "5", "6"])
+        eid = g["3"]["5"]["eid"]
+        self.assertEqual(g.core.remaining_capacity[eid], 1)
+        self.assertEqual(g["3"]["5"][Graph.CAP_REMAINING], 1)
+        self.assertEqual(g.get_path_capacity(intent.path), 1)
+        g.reset_capacities(use_virtual=True)
+        self.assertEqual(g.core.virtual_capacity[eid], 5)
+        g.remove_flow(intent)
+        self.assertEqual(g.to_networkx()["3"]["5"][Graph.CAP_REMAINING], 5)
+
+    def test_edge_ids_reused(self):
+        g = Graph.Graph(os.path.join(graph_dir, "g1.graph"))
+        eid = g["3"]["5"]["eid"]
+        g.remove_edge("3", "5")
+        g.add_edge("2", "5", bilink=Graph.BiLink("2", "5", 7))
+        self.assertEqual(g["2"]["5"]["eid"], eid)
+        self.assertEqual(g.bfs("6")["1"], 3)
+
+class TestHopCache(unittest.TestCase):
+    def setUp(self):
+        self.g = Graph.Graph(os.path.join(graph_dir, "g1.graph"))
+
+    def test_reuse_and_invalidation(self):
+        hops = self.g.hop_distances("6")
+        self.assertEqual(hops["1"], 3)
+        self.assertIs(self.g.hop_distances("6"), hops)
+        # 2--3 does not shorten any route towards 6
+        self.g.add_edge("2", "3", bilink=Graph.BiLink("2", "3", 10))
+        self.assertIs(self.g.hop_distances("6"), hops)
+        self.g.add_edge("1", "6", bilink=Graph.BiLink("1", "6", 10))
+        self.assertEqual(self.g.hop_distances("6")["1"], 1)
+        self.g.remove_edge("1", "6")
+        self.assertEqual(self.g.hop_distances("6")["1"], 3)
+
+    def test_lru_eviction(self):
+        self.g.hops = Graph.HopCache(max_entries=12)
+        for node in ["1", "2", "3"]:
+            self.g.hop_distances(node)
+        self.assertNotIn("1", self.g.hops)
+        self.assertIn("3", self.g.hops)
     
 if __name__=="__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,271 @@
+from heapq import heappush, heappop, heapify
+
+import numpy as np
+
+CAP_VIRTUAL = "virtual_capacity"
+CAP_MAX = "max_capacity"
+CAP_REMAINING = "remaining_capacity"
+
+CAPACITY_KEYS = (CAP_VIRTUAL, CAP_MAX, CAP_REMAINING)
+
+# Capacity reported for a path that stays on one switch
+SINGLE_NODE_CAPACITY = 10**10
+
+
+class TopologyCore:
+    # Switch ids mapped to dense integers, undirected links to edge ids, and one
+    # NumPy array per capacity kind indexed by edge id. The arrays are named
+    # after the CAP_* keys so getattr(core, capacity_key) returns the array.
+    INITIAL_EDGES = 64
+
+    def __init__(self):
+        self.node_index = {}    # switch id -> int
+        self.nodes = []         # int -> switch id
+        self.edge_ends = []     # edge id -> (int, int), None once removed
+        self._edge_ids = {}     # (int, int) in both orders -> edge id
+        self._free_edges = []
+        self._csr = None
+        self._shared = set()    # capacity arrays referenced by snapshots
+        for key in CAPACITY_KEYS:
+            setattr(self, key, np.zeros(self.INITIAL_EDGES, dtype=np.int64))
+
+    def __len__(self):
+        return len(self._edge_ids) // 2
+
+    def node_id(self, node):
+        idx = self.node_index.get(node)
+        if idx is None:
+            idx = len(self.nodes)
+            self.node_index[node] = idx
+            self.nodes.append(node)
+            self._csr = None
+        return idx
+
+    def edge_id(self, u, v):
+        return self._edge_ids.get((self.node_index.get(u), self.node_index.get(v)))
+
+    def share(self, key):
+        # Hands out the array as is; the next write through writable() copies it
+        self._shared.add(key)
+        return getattr(self, key)
+
+    def writable(self, key):
+        if key in self._shared:
+            setattr(self, key, getattr(self, key).copy())
+            self._shared.discard(key)
+        return getattr(self, key)
+
+    def adopt(self, key, array):
+        # Installs an array a snapshot built, nothing else references it
+        setattr(self, key, array)
+        self._shared.discard(key)
+
+    def _grow(self):
+        self._shared.clear()
+        size = 2 * len(self.max_capacity)
+        for key in CAPACITY_KEYS:
+            old = getattr(self, key)
+            new = np.zeros(size, dtype=np.int64)
+            new[:len(old)] = old
+            setattr(self, key, new)
+
+    def add_edge(self, u, v, capacity):
+        # Re-adding an existing link resets its capacities, like a new BiLink would
+        ui, vi = self.node_id(u), self.node_id(v)
+        eid = self._edge_ids.get((ui, vi))
+        if eid is None:
+            if self._free_edges:
+                eid = self._free_edges.pop()
+            else:
+                eid = len(self.edge_ends)
+                self.edge_ends.append(None)
+                if eid >= len(self.max_capacity):
+                    self._grow()
+            self.edge_ends[eid] = (ui, vi)
+            self._edge_ids[(ui, vi)] = eid
+            self._edge_ids[(vi, ui)] = eid
+            self._csr = None
+        for key in CAPACITY_KEYS:
+            self.writable(key)[eid] = capacity
+        return eid
+
+    def remove_edge(self, u, v):
+        ui, vi = self.node_index.get(u), self.node_index.get(v)
+        eid = self._edge_ids.pop((ui, vi), None)
+        if eid is None:
+            return None
+        del self._edge_ids[(vi, ui)]
+        self.edge_ends[eid] = None
+        for key in CAPACITY_KEYS:
+            self.writable(key)[eid] = 0
+        self._free_edges.append(eid)
+        self._csr = None
+        return eid
+
+    def edge_ids(self):
+        return np.array([eid for eid, ends in enumerate(self.edge_ends) if ends is not None], dtype=np.intp)
+
+    def csr(self):
+        # (indptr, indices, eids): the neighbours of node i are
+        # indices[indptr[i]:indptr[i + 1]], reached over the links eids[...]
+        if self._csr is not None:
+            return self._csr
+        live = [(eid, ends) for eid, ends in enumerate(self.edge_ends) if ends is not None]
+        eids = np.array([eid for eid, _ in live], dtype=np.intp)
+        ends = np.array([ends for _, ends in live], dtype=np.intp).reshape(-1, 2)
+        src = np.concatenate((ends[:, 0], ends[:, 1]))
+        dst = np.concatenate((ends[:, 1], ends[:, 0]))
+        eids = np.concatenate((eids, eids))
+        order = np.argsort(src, kind="stable")
+        counts = np.bincount(src, minlength=len(self.nodes))
+        indptr = np.zeros(len(self.nodes) + 1, dtype=np.intp)
+        np.cumsum(counts, out=indptr[1:])
+        self._csr = (indptr, dst[order], eids[order])
+        return self._csr
+
+    def hop_distances(self, source):
+        # Level-synchronous BFS over the CSR arrays. Returns an array of hop
+        # counts indexed by node id, -1 where source is unreachable.
+        indptr, indices, _ = self.csr()
+        dist = np.full(len(self.nodes), -1, dtype=np.int64)
+        src = self.node_index[source]
+        dist[src] = 0
+        frontier = np.array([src], dtype=np.intp)
+        level = 0
+        while frontier.size:
+            starts = indptr[frontier]
+            counts = indptr[frontier + 1] - starts
+            total = counts.sum()
+            if total == 0:
+                break
+            offsets = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(total)
+            neighbours = indices[offsets]
+            frontier = np.unique(neighbours[dist[neighbours] < 0])
+            level += 1
+            dist[frontier] = level
+        return dist
+
+    def reset(self, key):
+        np.copyto(self.writable(key), self.max_capacity)
+
+    def headroom(self, caps):
+        # Smallest residual fraction over all links, then total residual capacity
+        eids = self.edge_ids()
+        if not eids.size:
+            return (1.0, 0)
+        residual = caps[eids]
+        capacity = np.maximum(self.max_capacity[eids], 1)
+        return (float((residual / capacity).min()), int(residual.sum()))
+
+
+class CongestionIndex:
+    # Max-heap of link utilization (used / max capacity on the remaining
+    # capacities) with lazy invalidation: an update pushes a fresh entry and
+    # bumps the link's stamp, entries with an old stamp are skipped on the way
+    # out and the heap is rebuilt once they outnumber the live ones
+    def __init__(self, core):
+        self.core = core
+        self._heap = []
+        self._stamps = {}   # edge id -> stamp of its live heap entry
+        self._counter = 0
+
+    def __len__(self):
+        return len(self._stamps)
+
+    def utilization(self, eid):
+        capacity = int(self.core.max_capacity[eid])
+        if capacity <= 0:
+            return 1.0
+        return (capacity - int(self.core.remaining_capacity[eid])) / capacity
+
+    def update(self, eids):
+        for eid in np.atleast_1d(eids).tolist():
+            self._counter += 1
+            self._stamps[eid] = self._counter
+            heappush(self._heap, (-self.utilization(eid), self._counter, eid))
+        if len(self._heap) > 2 * len(self._stamps) + 64:
+            self._compact()
+
+    def discard(self, eid):
+        self._stamps.pop(eid, None)
+
+    def rebuild(self):
+        self._stamps.clear()
+        self._heap = []
+        self.update(self.core.edge_ids())
+
+    def _compact(self):
+        self._heap = [entry for entry in self._heap if self._stamps.get(entry[2]) == entry[1]]
+        heapify(self._heap)
+
+    def hottest(self, k):
+        # [(edge id, utilization)] for the k most utilized links, O(k log E)
+        # Pops and pushes back heap entries, callers hold the graph lock
+        top = []
+        while self._heap and len(top) < k:
+            entry = heappop(self._heap)
+            if self._stamps.get(entry[2]) == entry[1]:
+                top.append(entry)
+        for entry in top:
+            heappush(self._heap, entry)
+        return [(eid, -util) for util, _, eid in top]
+
+
+class PathBatch:
+    # A set of candidate paths as a padded (paths x hops) matrix of edge ids,
+    # the dense form of their path x edge incidence, so every bottleneck is
+    # one gather and one row-wise min
+    def __init__(self, paths, edge_ids):
+        self.paths = paths
+        self.lengths = np.array([len(path) for path in paths], dtype=np.intp)
+        width = max((len(eids) for eids in edge_ids), default=0)
+        self.matrix = np.zeros((len(paths), width), dtype=np.intp)
+        self.mask = np.zeros((len(paths), width), dtype=bool)
+        for i, eids in enumerate(edge_ids):
+            self.matrix[i, :len(eids)] = eids
+            self.mask[i, :len(eids)] = True
+
+    def __len__(self):
+        return len(self.paths)
+
+    def bottlenecks(self, caps):
+        return np.min(caps[self.matrix], axis=1, where=self.mask, initial=SINGLE_NODE_CAPACITY)
+
+    def select(self, caps, required):
+        # Index of the tightest feasible path among the shortest feasible ones
+        if not self.paths:
+            return None
+        bottlenecks = self.bottlenecks(caps)
+        feasible = np.flatnonzero(bottlenecks >= required)
+        if not feasible.size:
+            return None
+        lengths = self.lengths[feasible]
+        shortest = feasible[lengths == lengths.min()]
+        return int(shortest[np.argmin(bottlenecks[shortest])])
+
+
+class EdgeData(dict):
+    # Edge attribute dict whose CAP_* keys read and write the core arrays, so
+    # graph[u][v][CAP_REMAINING] keeps working on top of the TopologyCore
+    core = None
+
+    def __getitem__(self, key):
+        if key in CAPACITY_KEYS and self.core is not None:
+            return int(getattr(self.core, key)[dict.__getitem__(self, "eid")])
+        return dict.__getitem__(self, key)
+
+    def __setitem__(self, key, value):
+        if key in CAPACITY_KEYS and self.core is not None:
+            self.core.writable(key)[dict.__getitem__(self, "eid")] = value
+            return
+        dict.__setitem__(self, key, value)
+
+    def __contains__(self, key):
+        if key in CAPACITY_KEYS and self.core is not None:
+            return True
+        return dict.__contains__(self, key)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
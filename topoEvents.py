@@ -0,0 +1,100 @@
+import json
+import threading
+from abc import ABC, abstractmethod
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Event types, named after the ONOS LinkEvent/HostEvent/DeviceEvent types
+LINK_ADDED = "LINK_ADDED"
+LINK_UPDATED = "LINK_UPDATED"
+LINK_REMOVED = "LINK_REMOVED"
+HOST_ADDED = "HOST_ADDED"
+HOST_UPDATED = "HOST_UPDATED"
+HOST_REMOVED = "HOST_REMOVED"
+PORT_UPDATED = "PORT_UPDATED"
+PORT_REMOVED = "PORT_REMOVED"
+
+EVENT_TYPES = (LINK_ADDED, LINK_UPDATED, LINK_REMOVED, HOST_ADDED, HOST_UPDATED, HOST_REMOVED,
+               PORT_UPDATED, PORT_REMOVED)
+
+
+class EventSource(ABC):
+    # Pushes topology events to sink(event) as they happen. An event is a dict
+    # {"type": <one of EVENT_TYPES>, ...} carrying the ONOS JSON of what
+    # changed: "link" (a /links entry), "host" (a /hosts entry) or "port"
+    # ({"device", "port", "isEnabled"}). sink is called from the source's own
+    # thread and must only queue the event.
+    @abstractmethod
+    def start(self, sink):
+        # Starts delivering events to sink, returns at once
+        pass
+
+    @abstractmethod
+    def stop(self):
+        # Stops delivering events and releases what start took
+        pass
+
+
+def parse_events(body):
+    # A single event, a list of events or {"events": [...]}
+    if isinstance(body, dict) and "events" in body:
+        body = body["events"]
+    if isinstance(body, dict):
+        body = [body]
+    if not isinstance(body, list):
+        raise ValueError("Expected an event or a list of events")
+    for event in body:
+        if not isinstance(event, dict) or event.get("type") not in EVENT_TYPES:
+            raise ValueError(f"Unknown event {event}")
+    return body
+
+
+class WebhookEventSource(EventSource):
+    # Local HTTP receiver: an ONOS app (or anything standing in for one) POSTs
+    # events as JSON to http://host:port/events
+    PATH = "/events"
+
+    def __init__(self, host="127.0.0.1", port=8765):
+        self.host = host
+        self.port = port
+        self._server = None
+        self._thread = None
+
+    def start(self, sink):
+        source = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path.rstrip("/") != source.PATH:
+                    self._reply(404, {"error": "not found"})
+                    return
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                    events = parse_events(json.loads(self.rfile.read(length)))
+                except ValueError as e:
+                    self._reply(400, {"error": str(e)})
+                    return
+                for event in events:
+                    sink(event)
+                self._reply(202, {"accepted": len(events)})
+
+            def _reply(self, status, payload):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.port = self._server.server_port
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
@@ -0,0 +1,163 @@
+import cProfile
+import functools
+import os
+import threading
+import time
+from collections import deque
+
+# Off by default. Methods are only wrapped by instrument() while tracing is
+# enabled, so an untraced controller runs the plain methods.
+enabled = False
+
+# Root spans at least this long (seconds) are printed when they end
+PRINT_THRESHOLD = 0.1
+# Commands slower than this (seconds) leave a cProfile dump in PROFILE_DIR,
+# None to never profile
+PROFILE_THRESHOLD = None
+PROFILE_DIR = "profiles"
+
+traces = deque(maxlen=100)  # the last finished root spans
+_local = threading.local()
+_instrumented = []          # (cls, name, original)
+
+
+class Span:
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.children = []
+        self.start = None
+        self.duration = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        stack = _stack()
+        if stack:
+            stack[-1].children.append(self)
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        stack = _stack()
+        stack.pop()
+        if not stack:
+            traces.append(self)
+            if self.duration >= PRINT_THRESHOLD:
+                print(format_span(self))
+
+    def format(self, depth=0):
+        attrs = " ".join(f"{key}={value}" for key, value in self.attrs.items())
+        lines = [f"{'  ' * depth}{self.name} {self.duration * 1000:.2f} ms {attrs}".rstrip()]
+        for child in self.children:
+            lines.extend(child.format(depth + 1))
+        return lines
+
+
+class _NullSpan:
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_null = _NullSpan()
+
+
+def _stack():
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def span(name, **attrs):
+    if not enabled:
+        return _null
+    return Span(name, attrs)
+
+
+def annotate(**attrs):
+    # Adds attributes to the innermost open span, if any
+    if not enabled:
+        return
+    stack = _stack()
+    if stack:
+        stack[-1].attrs.update(attrs)
+
+
+def format_span(root):
+    return "\n".join(root.format())
+
+
+def traced(name, method):
+    # The method records its own attributes with annotate()
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with Span(name, {}):
+            return method(self, *args, **kwargs)
+    wrapper.__wrapped_by_tracing__ = True
+    return wrapper
+
+
+def instrument(cls, names):
+    # Wraps cls.<name> in a span for every name, until disable()
+    for name in names:
+        original = cls.__dict__[name]
+        if getattr(original, "__wrapped_by_tracing__", False):
+            continue
+        setattr(cls, name, traced(f"{cls.__name__}.{name}", original))
+        _instrumented.append((cls, name, original))
+
+
+def enable(targets=()):
+    # targets: [(cls, [method names])]
+    global enabled
+    enabled = True
+    for cls, names in targets:
+        instrument(cls, names)
+
+
+def disable():
+    global enabled
+    enabled = False
+    while _instrumented:
+        cls, name, original = _instrumented.pop()
+        setattr(cls, name, original)
+
+
+class profiled:
+    # Runs the block under cProfile when PROFILE_THRESHOLD is set and dumps
+    # the profile to PROFILE_DIR if the block took longer than that
+    def __init__(self, name):
+        self.name = name
+        self.profile = None
+        self.path = None
+
+    def __enter__(self):
+        if PROFILE_THRESHOLD is not None:
+            self.profile = cProfile.Profile()
+            self.start = time.perf_counter()
+            self.profile.enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self.profile is None:
+            return
+        self.profile.disable()
+        duration = time.perf_counter() - self.start
+        if duration >= PROFILE_THRESHOLD:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            safe = "".join(c if c.isalnum() or c in "-_" else "_" for c in self.name)[:40]
+            self.path = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{safe}-{duration * 1000:.0f}ms.prof")
+            self.profile.dump_stats(self.path)
+            print(f"Slow command '{self.name}' ({duration * 1000:.0f} ms), profile written to {self.path}")
@@ -1,10 +1,33 @@
 import json
-import requests
 import uuid
 
+from onosClient import OnosClient
+
 BASE_URL = 'http://localhost:8181/onos/v1'
 AUTH = ('onos', 'rocks')
 
+_client = None
+
+def get_client():
+    # The ONOS client shared by the whole controller, built on first use
+    global _client
+    if _client is None:
+        _client = OnosClient(BASE_URL, AUTH)
+    return _client
+
+def reset_client():
+    # Closes the shared client, the next get_client() builds a fresh one
+    global _client
+    if _client is not None:
+        _client.close()
+        _client = None
+
+def set_base_url(url):
+    # Points the controller at another ONOS
+    global BASE_URL
+    BASE_URL = url
+    reset_client()
+
 class SwitchPort:
     def __init__(self, json=None):
         if json is not None:
@@ -32,18 +55,25 @@ class Host:
 
 class Flow:
     priority = 40001
+    # Destination-keyed rules (no ETH_SRC/IN_PORT) sit just below, so that an
+    # exact rule on the same device takes precedence
+    aggregate_priority = 40000
     timeout = 0
     isPermanent = True
         
     def __init__(self, device_id, src_mac, dst_mac, in_port, out_port):
+        # src_mac and in_port may be None: the rule then matches on the
+        # destination alone
         self.src_mac = src_mac
         self.dst_mac = dst_mac
         self.in_port = in_port
         self.out_port = out_port
         self.deviceId = device_id
         self.id = None
+        if src_mac is None and in_port is None:
+            self.priority = self.aggregate_priority
 
-    def json(self):
+    def to_dict(self):
         res = {}
         res["priority"] = self.priority
         res["timeout"] = self.timeout
@@ -58,35 +88,34 @@ class Flow:
         instructions.append(inst)
         treatment["instructions"] = instructions
 
-        crit_port = {
-            "type": "IN_PORT",
-            "port": str(self.in_port),
-        }
-        crit_src = {
-            "type": "ETH_SRC",
-            "mac": self.src_mac 
-        }
-        crit_dst = {
+        criteria = []
+        if self.in_port is not None:
+            criteria.append({
+                "type": "IN_PORT",
+                "port": str(self.in_port),
+            })
+        criteria.append({
             "type": "ETH_DST",
             "mac": self.dst_mac 
-        }
-        criteria = [crit_port, crit_dst, crit_src]
+        })
+        if self.src_mac is not None:
+            criteria.append({
+                "type": "ETH_SRC",
+                "mac": self.src_mac 
+            })
     
         res["selector"] = {"criteria": criteria}
         res["treatment"] = treatment
-        return json.dumps(res, indent=2)
+        return res
+
+    def json(self):
+        return json.dumps(self.to_dict(), separators=(',', ':'))
     
     def apply(self):
-        data = self.json()
-        url = "{}/flows/{}".format(BASE_URL, self.deviceId)
-        res = requests.post(url, data, auth=AUTH)
-        self.id = res.headers["Location"].split('/')[-1]
-        return res
+        return get_client().install_flows([self])
     
     def delete(self):
-        url = "{}/flows/{}/{}".format(BASE_URL, self.deviceId, self.id)
-        res = requests.delete(url, auth=AUTH)
-        return res
+        return get_client().delete_flows([self])
 
 class Intent:
 